@@ -4,6 +4,7 @@
 
 from .tracer import Tracer as snoop
 from .variables import Attrs, Exploding, Indices, Keys
+from .switch import enable, disable, is_enabled, toggle_on_signal
 import collections
 
 __VersionInfo = collections.namedtuple('VersionInfo',
@@ -0,0 +1,6 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+from .cli import main
+
+main()
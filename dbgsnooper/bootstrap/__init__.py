@@ -0,0 +1,6 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+The directory that `dbgsnooper.children.start` puts on the `PYTHONPATH` of
+the processes it has record themselves, for its `sitecustomize`.
+'''
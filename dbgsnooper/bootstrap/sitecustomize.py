@@ -0,0 +1,32 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Imported by `site` when a Python process starts, if the process that started
+it called `dbgsnooper.children.start`, to have it record itself too.
+'''
+
+import os
+import sys
+
+
+def _bootstrap():
+    try:
+        from dbgsnooper import children
+        children.start_child()
+    except Exception as e:
+        sys.stderr.write('dbgsnooper: not recording process {}: {!r}\n'.format(
+            os.getpid(), e
+        ))
+    # Import the `sitecustomize` that this one shadows, if there's one:
+    bootstrap_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:] = [path for path in sys.path
+                   if os.path.abspath(path or os.curdir) != bootstrap_dir]
+    this_module = sys.modules.pop('sitecustomize')
+    try:
+        import sitecustomize
+    except ImportError:
+        # The import system expects to find this module there once it ran:
+        sys.modules['sitecustomize'] = this_module
+
+
+_bootstrap()
@@ -0,0 +1,231 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Snooping on the processes that the snooped code starts.
+
+`start` makes a tracer that records this process to a shard of its own in a
+shard directory, and has the processes started from then on record
+themselves the same way:
+
+* Forked ones, like `multiprocessing` and `ProcessPoolExecutor` workers on
+  Linux, keep the tracer they forked with, which switches to a shard of the
+  child's own.
+* New interpreters, like `subprocess` running `python` or `multiprocessing`
+  with `spawn`, get the tracer's configuration in `CONFIG_ENV_VAR`, and
+  `BOOTSTRAP_DIR` on their `PYTHONPATH`. Its `sitecustomize` has them start
+  a tracer of their own before anything else runs.
+
+Shards are binary recordings named after the pid of their process.
+`merge_shards` renders all of them as one timeline, ordered by the events'
+monotonic timestamps (all processes on a machine share the clock), with each
+line labeled with its pid.
+'''
+
+import heapq
+import json
+import os
+import signal
+import sys
+import threading
+
+from . import recording, writers
+from .events import ThreadBuffers, TextRenderer
+from .tracer import Tracer
+
+CONFIG_ENV_VAR = 'DBGSNOOPER_CHILD_CONFIG'
+BOOTSTRAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bootstrap')
+SHARD_SUFFIX = '.dbgsnoop'
+
+# The tracer that records this process, and the directory of its shard:
+_tracer = None
+_shard_dir = None
+# What `start` changed in `os.environ`, to restore on `stop`:
+_saved_environ = None
+_fork_hook_installed = False
+
+
+def get_shard_path(shard_dir, pid=None):
+    if pid is None:
+        pid = os.getpid()
+    return os.path.join(shard_dir, '{}{}'.format(pid, SHARD_SUFFIX))
+
+
+class ShardTracer(Tracer):
+    '''
+    A `Tracer` that writes its events to its process's shard as soon as the
+    process leaves the snooped scope, since processes like pool workers tend
+    to get killed rather than exit.
+    '''
+    def manual_exit(self, frame):
+        Tracer.manual_exit(self, frame)
+        if not self.target_frames:
+            self.render_threads()
+            self.flush_output()
+
+
+def make_tracer(shard_dir, tracer_kwargs):
+    return ShardTracer(get_shard_path(shard_dir), format='binary',
+                       trace_threads=True, **tracer_kwargs)
+
+
+def start(shard_dir, **tracer_kwargs):
+    '''
+    Get a tracer, made with `tracer_kwargs`, that records this process to
+    its shard in `shard_dir`, and have the processes that get started until
+    `stop` is called record themselves with the same `tracer_kwargs`. They
+    have to be JSON-serializable, so they can be passed on to new
+    interpreters.
+
+        tracer = children.start('/tmp/shards', observed_file='pipeline.py',
+                                start_line=10, end_line=42)
+        with tracer:
+            run_pipeline()
+        children.stop()
+        children.merge_shards('/tmp/shards', sys.stderr.write)
+    '''
+    global _saved_environ
+    shard_dir = os.path.abspath(shard_dir)
+    config = json.dumps({'shard_dir': shard_dir, 'tracer': tracer_kwargs})
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    tracer = make_tracer(shard_dir, tracer_kwargs)
+    if _saved_environ is None:
+        _saved_environ = dict((name, os.environ.get(name))
+                              for name in (CONFIG_ENV_VAR, 'PYTHONPATH'))
+    # The bootstrap, and the directory `dbgsnooper` can be imported from:
+    python_path = [BOOTSTRAP_DIR, os.path.dirname(os.path.dirname(
+        BOOTSTRAP_DIR
+    ))]
+    if _saved_environ['PYTHONPATH']:
+        python_path.append(_saved_environ['PYTHONPATH'])
+    os.environ[CONFIG_ENV_VAR] = config
+    os.environ['PYTHONPATH'] = os.pathsep.join(python_path)
+    _install(tracer, shard_dir)
+    return tracer
+
+
+def stop():
+    '''Stop having the processes that get started record themselves.'''
+    global _saved_environ, _tracer, _shard_dir
+    if _saved_environ is not None:
+        for name, value in _saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        _saved_environ = None
+    _tracer = _shard_dir = None
+
+
+def start_child():
+    '''
+    Start recording this whole process, if it was started by a process that
+    called `start`. Called by the bootstrap's `sitecustomize`.
+    '''
+    config = os.environ.get(CONFIG_ENV_VAR)
+    if not config:
+        return None
+    config = json.loads(config)
+    tracer = make_tracer(config['shard_dir'], config['tracer'])
+    _install(tracer, config['shard_dir'])
+    # There's no scope to enter, all of the process is snooped on:
+    sys.settrace(tracer.get_trace_function())
+    threading.settrace(tracer.get_trace_function())
+    return tracer
+
+
+def _install(tracer, shard_dir):
+    global _tracer, _shard_dir, _fork_hook_installed
+    _tracer = tracer
+    _shard_dir = shard_dir
+    writers.add_exit_callback(_flush_tracer)
+    if not _fork_hook_installed and hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_after_fork_in_child)
+        _fork_hook_installed = True
+
+
+def _flush_tracer(blocking=False):
+    tracer = _tracer
+    if tracer is not None:
+        # Without `blocking`, this can run in a signal handler, while the
+        # thread it interrupted is rendering:
+        tracer.render_threads(blocking)
+        tracer.flush_output()
+
+
+def _flush_tracer_before_exit():
+    if not hasattr(signal, 'pthread_sigmask'):
+        _flush_tracer(blocking=True)
+        return
+    # `multiprocessing` terminates its workers with `SIGTERM`, which would
+    # kill this one in the middle of writing what it has left:
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, writers.EXIT_SIGNALS)
+    try:
+        _flush_tracer(blocking=True)
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+
+def _after_fork_in_child():
+    tracer = _tracer
+    if tracer is None:
+        return
+    # The child has its parent's stack, so the tracer's state of it still
+    # holds. Only the events that are the parent's are dropped, and the
+    # rest go to a shard of the child's own. Locks may have been held by
+    # threads that the child doesn't have:
+    tracer.thread_buffers = ThreadBuffers()
+    tracer._render_lock = threading.Lock()
+    tracer._thread_trace_lock = threading.Lock()
+    recording.Recorder._instances_lock = threading.Lock()
+    tracer._write = recording.get_recording_writer(get_shard_path(_shard_dir),
+                                                   overwrite=False)
+    if 'multiprocessing' in sys.modules:
+        from multiprocessing import util
+        # `multiprocessing` ends the processes it forked with `os._exit`,
+        # which skips `atexit`. Its finalizers are cleared after the fork, so
+        # this has to wait for it to run its after-fork hooks:
+        util.register_after_fork(tracer, _register_finalizer)
+
+
+def _register_finalizer(tracer):
+    from multiprocessing import util
+    # After the finalizers that the process registered itself:
+    util.Finalize(None, _flush_tracer_before_exit, exitpriority=-100)
+    # Pools terminate their idle workers with `SIGTERM`. Flushing in a
+    # handler could keep a worker alive while another one waits on a lock
+    # it holds, and the shard is written after each snooped call anyway:
+    writers.restore_signal_handlers()
+
+
+def _read_shard(path, pid, normalize):
+    with open(path, 'rb') as shard_file:
+        data = shard_file.read()
+    for event in recording.read_events(data, normalize):
+        yield pid, event
+
+
+def iter_shard_events(shard_dir, normalize=False):
+    '''
+    Yield `(pid, event)` for the events of all the shards in `shard_dir`,
+    ordered by their timestamps.
+    '''
+    shards = []
+    for name in sorted(os.listdir(shard_dir)):
+        if not name.endswith(SHARD_SUFFIX):
+            continue
+        pid = int(name[:-len(SHARD_SUFFIX)])
+        shards.append(_read_shard(os.path.join(shard_dir, name), pid,
+                                  normalize))
+    return heapq.merge(*shards, key=lambda item: item[1].timestamp)
+
+
+def merge_shards(shard_dir, write, prefix='', color=False, normalize=False):
+    '''
+    Render the shards in `shard_dir` as one timeline, passing each line to
+    `write`, labeled with the pid of the process it's from.
+    '''
+    renderer = TextRenderer(prefix, color)
+    for pid, event in iter_shard_events(shard_dir, normalize):
+        write(u'{}[{}] {}\n'.format(prefix, pid, renderer.render(event)))
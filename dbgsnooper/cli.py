@@ -1,7 +1,9 @@
 import os
 import runpy
+import shutil
 import sys
 import argparse
+import tempfile
 import traceback
 import dbgsnooper 
 
@@ -26,13 +28,63 @@ def dbgsnooper_execution_wrapper(test_path, observed_file,start_Line, end_line,
         print(f"Error occurred during script execution:{e}")
         traceback.print_exc()
 
-    
+
+def trace_children_execution_wrapper(test_path, observed_file, start_line,
+                                     end_line):
+    '''
+    Like `dbgsnooper_execution_wrapper`, but the processes that the test
+    starts are traced too, each to its own shard, and the shards are merged
+    into one timeline with each line labeled with its pid.
+    '''
+    from . import children
+    test_path = os.path.abspath(test_path)
+    observed_file = os.path.abspath(observed_file)
+    dir_path = os.path.dirname(test_path)
+    os.chdir(dir_path)
+    if dir_path not in sys.path:
+        sys.path.insert(0, dir_path)
+    shard_dir = tempfile.mkdtemp(prefix='dbgsnooper-')
+    tracer = children.start(shard_dir, observed_file=observed_file,
+                            start_line=start_line, end_line=end_line)
+    try:
+        tracer(runpy.run_path)(test_path, run_name="__main__")
+    except Exception as e:
+        print(f"Error occurred during script execution:{e}")
+        traceback.print_exc()
+    finally:
+        children.stop()
+        children.merge_shards(shard_dir, sys.stderr.write, color=tracer.color)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def add_recording_argument(parser):
+    parser.add_argument('--recording', default=None,
+                        help='Answer from this recording of the test, made '
+                             'with `dbgsnooper record`. The test gets '
+                             'recorded to it first if it has to be.')
+    return parser
+
+
+def ensure_recording(parsed):
+    '''
+    Make sure `parsed.recording` is a recording of the test that observed
+    its file, and return the absolute paths of the two. Recording changes
+    the working directory.
+    '''
+    recording_path = os.path.abspath(parsed.recording)
+    observed_file = os.path.abspath(parsed.observed_file)
+    replay.ensure_recording(recording_path, parsed.test_file, [observed_file])
+    return recording_path, observed_file
+
 
 def build_trace_method_parser(parser):
     parser.add_argument('--observed_file', required=True)
     parser.add_argument('--test_file', required=True)
     parser.add_argument('--method_name', required=True)
-    return parser
+    parser.add_argument('--trace_children', action='store_true',
+                        help='Trace the processes that the test starts too, '
+                             'like `multiprocessing` workers.')
+    return add_recording_argument(parser)
 
 
 def build_trace_var_parser(parser):
@@ -40,18 +92,135 @@ def build_trace_var_parser(parser):
     parser.add_argument('--test_file', required=True)
     parser.add_argument('--var_name', required=True)
     parser.add_argument('--lineno', type=int, required=True)
-    return parser
+    return add_recording_argument(parser)
 
 
 def build_call_graph_parser(parser):
     parser.add_argument('--observed_file', required=True)
     parser.add_argument('--test_file', required=True)
     parser.add_argument('--method_name', required=True)
+    return add_recording_argument(parser)
+
+
+def build_render_parser(parser):
+    parser.add_argument('recording', help='A recording made with '
+                                          "`format='binary'`.")
+    parser.add_argument('--output', '-o', default=None,
+                        help='Where to write the text, stdout by default.')
+    parser.add_argument('--color', action='store_true')
+    parser.add_argument('--normalize', action='store_true',
+                        help='Drop memory addresses and directories, like '
+                             '`normalize=True` does.')
+    parser.add_argument('--prefix', default='')
     return parser
 
+
+def render_recording(recording_path, output_path=None, color=False,
+                     normalize=False, prefix=''):
+    from . import recording
+    with open(recording_path, 'rb') as recording_file:
+        data = recording_file.read()
+    if output_path is None:
+        recording.render(data, sys.stdout.write, prefix, color, normalize)
+    else:
+        with open(output_path, 'w', encoding='utf-8') as output_file:
+            recording.render(data, output_file.write, prefix, color,
+                             normalize)
+
+
+def build_index_parser(parser):
+    parser.add_argument('recording', help='A recording made with '
+                                          "`format='binary'`.")
+    return parser
+
+
+def index_recording(recording_path):
+    from .trace_reader import build_index
+    index = build_index(recording_path)
+    print('{}: {} segments, {} frames, {} runs'.format(
+        recording_path, len(index.segments), len(index.frames),
+        len(index.runs)
+    ))
+
+
+def build_record_parser(parser):
+    parser.add_argument('--test_file', required=True)
+    parser.add_argument('--observed_file', required=True, action='append',
+                        help='A file to record what its code does. Can be '
+                             'given more than once.')
+    parser.add_argument('--output', '-o', required=True,
+                        help='Where to write the recording.')
+    return parser
+
+
+def build_merge_parser(parser):
+    parser.add_argument('shard_dir', help='A directory of shards written by '
+                                          'processes traced with '
+                                          '`dbgsnooper.children`.')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Where to write the text, stdout by default.')
+    parser.add_argument('--color', action='store_true')
+    parser.add_argument('--normalize', action='store_true')
+    return parser
+
+
+def merge_shards(shard_dir, output_path=None, color=False, normalize=False):
+    from . import children
+    if output_path is None:
+        children.merge_shards(shard_dir, sys.stdout.write, color=color,
+                              normalize=normalize)
+    else:
+        with open(output_path, 'w', encoding='utf-8') as output_file:
+            children.merge_shards(shard_dir, output_file.write, color=color,
+                                  normalize=normalize)
+
+
+def build_control_parser(parser):
+    parser.add_argument('socket', help='The Unix domain socket of a process '
+                                       'that called `dbgsnooper.control.'
+                                       'serve`.')
+    parser.add_argument('words', nargs=argparse.REMAINDER, metavar='COMMAND',
+                        help='Like `snoop MODULE:QUALNAME depth=2 calls=10`, '
+                             '`enable`, `disable` or `status`.')
+    return parser
+
+
+def send_control_command(socket_path, words):
+    import shlex
+    from . import control
+    command = ' '.join(shlex.quote(word) for word in words)
+    control.send_command(socket_path, command, sys.stdout.write)
+    sys.stdout.flush()
+
+
+def build_dbgsnooper_parser(parser):
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    build_render_parser(subparsers.add_parser(
+        'render', help='Render a binary recording as text.'
+    ))
+    build_index_parser(subparsers.add_parser(
+        'index', help='Build the index of a binary recording again.'
+    ))
+    build_record_parser(subparsers.add_parser(
+        'record', help='Run a test once, recording it for `trace_method`, '
+                       '`trace_var` and `call_graph --recording`.'
+    ))
+    build_merge_parser(subparsers.add_parser(
+        'merge', help='Merge the shards of traced processes into one '
+                      'timeline.'
+    ))
+    build_control_parser(subparsers.add_parser(
+        'control', help='Send a command to the control server of a running '
+                        'process, and show what it answers.'
+    ))
+    return parser
+
+
 from .trace_var import trace_var
 from .render_call_tree import render_call_tree
 from .ast_env_boot import run_get_method_range
+from . import replay
 
 def main():
     prog = sys.argv[0].split('/')[-1]
@@ -63,21 +232,50 @@ def main():
             parser = build_trace_method_parser(argparse.ArgumentParser(prog='trace_method'))
             parsed = parser.parse_args(args)
             method_start_line, method_end_line = run_get_method_range(parsed.observed_file, parsed.method_name)
-            dbgsnooper_execution_wrapper(parsed.test_file, parsed.observed_file, method_start_line, method_end_line)
+            if parsed.recording:
+                recording_path, observed_file = ensure_recording(parsed)
+                replay.trace_method(recording_path, observed_file, method_start_line, method_end_line)
+            elif parsed.trace_children:
+                trace_children_execution_wrapper(parsed.test_file, parsed.observed_file, method_start_line, method_end_line)
+            else:
+                dbgsnooper_execution_wrapper(parsed.test_file, parsed.observed_file, method_start_line, method_end_line)
 
         elif prog == 'trace_var':
             parser = build_trace_var_parser(argparse.ArgumentParser(prog='trace_var'))
             parsed = parser.parse_args(args)
-            trace_var(parsed.test_file, parsed.observed_file, parsed.var_name, parsed.lineno)
+            if parsed.recording:
+                recording_path, observed_file = ensure_recording(parsed)
+                replay.trace_var(recording_path, observed_file, parsed.var_name, parsed.lineno)
+            else:
+                trace_var(parsed.test_file, parsed.observed_file, parsed.var_name, parsed.lineno)
 
         elif prog == 'call_graph':
             parser = build_call_graph_parser(argparse.ArgumentParser(prog='call_graph'))
             parsed = parser.parse_args(args)
             method_start_line, method_end_line = run_get_method_range(parsed.observed_file, parsed.method_name)
-            dbgsnooper_execution_wrapper(parsed.test_file, parsed.observed_file, method_start_line, method_end_line, call_graph_mode = True)
+            if parsed.recording:
+                recording_path, observed_file = ensure_recording(parsed)
+                replay.call_graph(recording_path, observed_file, method_start_line, method_end_line)
+            else:
+                dbgsnooper_execution_wrapper(parsed.test_file, parsed.observed_file, method_start_line, method_end_line, call_graph_mode = True)
 
         return
 
+    parser = build_dbgsnooper_parser(argparse.ArgumentParser(prog='dbgsnooper'))
+    parsed = parser.parse_args(sys.argv[1:])
+    if parsed.command == 'render':
+        render_recording(parsed.recording, parsed.output, parsed.color,
+                         parsed.normalize, parsed.prefix)
+    elif parsed.command == 'index':
+        index_recording(parsed.recording)
+    elif parsed.command == 'record':
+        replay.record(parsed.test_file, parsed.observed_file, parsed.output)
+    elif parsed.command == 'merge':
+        merge_shards(parsed.shard_dir, parsed.output, parsed.color,
+                     parsed.normalize)
+    elif parsed.command == 'control':
+        send_control_command(parsed.socket, parsed.words)
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,462 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''Per-code-object metadata that the tracer would otherwise recompute on every
+event.'''
+
+import dis
+import functools
+import itertools
+import opcode
+import re
+import weakref
+
+RETURN_OPCODES = {
+    'RETURN_GENERATOR', 'RETURN_VALUE', 'RETURN_CONST',
+    'INSTRUMENTED_RETURN_GENERATOR', 'INSTRUMENTED_RETURN_VALUE',
+    'INSTRUMENTED_RETURN_CONST', 'YIELD_VALUE', 'INSTRUMENTED_YIELD_VALUE'
+}
+
+YIELD_OPCODES = {'YIELD_VALUE', 'INSTRUMENTED_YIELD_VALUE'}
+
+# Instructions that bind or unbind the variable named by their argument:
+STORE_OPCODES = {
+    'STORE_FAST', 'STORE_NAME', 'STORE_DEREF', 'STORE_GLOBAL',
+    'DELETE_FAST', 'DELETE_NAME', 'DELETE_DEREF', 'DELETE_GLOBAL',
+    'STORE_FAST_MAYBE_NULL', 'STORE_FAST_STORE_FAST', 'LOAD_FAST_AND_CLEAR',
+}
+# `STORE_FAST_LOAD_FAST` stores the first of its two names.
+STORE_FIRST_OPCODES = {'STORE_FAST_LOAD_FAST'}
+
+# Instructions that can't change any variable other than the ones stored by
+# the line they're on. Calls, imports, attribute and item assignment,
+# in-place operators and anything not listed here or in `CALLING_OPCODES` may
+# change any variable, so after a line that has them all variables are
+# checked again.
+PURE_OPCODES = {
+    'LOAD_FAST', 'LOAD_FAST_CHECK', 'LOAD_FAST_LOAD_FAST', 'LOAD_CONST',
+    'LOAD_SMALL_INT', 'LOAD_NAME', 'LOAD_GLOBAL', 'LOAD_DEREF', 'LOAD_CLOSURE',
+    'LOAD_CLASSDEREF', 'LOAD_FROM_DICT_OR_DEREF', 'LOAD_FROM_DICT_OR_GLOBALS',
+    'LOAD_ASSERTION_ERROR', 'LOAD_BUILD_CLASS', 'LOAD_LOCALS',
+    'POP_TOP', 'PUSH_NULL', 'COPY', 'SWAP', 'DUP_TOP', 'DUP_TOP_TWO',
+    'ROT_TWO', 'ROT_THREE', 'ROT_FOUR', 'ROT_N', 'NOP', 'RESUME', 'CACHE',
+    'EXTENDED_ARG', 'END_FOR', 'POP_ITER', 'NOT_TAKEN', 'POP_BLOCK',
+    'SETUP_LOOP', 'SETUP_FINALLY', 'GEN_START', 'RETURN_GENERATOR',
+    'MAKE_CELL', 'COPY_FREE_VARS', 'KW_NAMES',
+    'JUMP_FORWARD', 'JUMP_BACKWARD', 'JUMP_BACKWARD_NO_INTERRUPT',
+    'JUMP_ABSOLUTE', 'JUMP', 'JUMP_NO_INTERRUPT', 'POP_JUMP_IF_NONE',
+    'POP_JUMP_IF_NOT_NONE', 'POP_JUMP_FORWARD_IF_NONE',
+    'POP_JUMP_FORWARD_IF_NOT_NONE', 'POP_JUMP_BACKWARD_IF_NONE',
+    'POP_JUMP_BACKWARD_IF_NOT_NONE', 'JUMP_IF_NOT_EXC_MATCH', 'IS_OP',
+    'BUILD_STRING', 'BUILD_TUPLE', 'BUILD_LIST', 'BUILD_CONST_KEY_MAP',
+    'BUILD_SLICE', 'LIST_APPEND', 'LIST_TO_TUPLE', 'MAKE_FUNCTION',
+    'SET_FUNCTION_ATTRIBUTE', 'RETURN_VALUE', 'RETURN_CONST',
+    # Exception handling, which runs no user code:
+    'PUSH_EXC_INFO', 'POP_EXCEPT', 'CHECK_EXC_MATCH', 'RERAISE',
+}
+# Instructions that don't change variables themselves, but may run Python
+# code that does: properties, `__eq__`, `__hash__`, `__format__` and the like.
+# A tracer that gets the call events of that code knows to check all
+# variables after it ran, one that doesn't has to count these lines as
+# changing any variable. Iterating, subscripting and truth testing aren't
+# here, because C code can change other variables there without any call
+# event, like a `defaultdict` adding a missing key or a `map` calling
+# `list.append`.
+CALLING_OPCODES = {
+    'LOAD_ATTR', 'LOAD_METHOD', 'LOAD_SUPER_ATTR', 'BINARY_OP', 'COMPARE_OP',
+    'FORMAT_VALUE', 'FORMAT_SIMPLE', 'FORMAT_WITH_SPEC', 'CONVERT_VALUE',
+    'BUILD_SET', 'BUILD_MAP', 'SET_ADD', 'MAP_ADD', 'GET_ITER', 'GET_LEN',
+}
+PURE_INTRINSICS = {
+    'INTRINSIC_LIST_TO_TUPLE', 'INTRINSIC_STOPITERATION_ERROR',
+    'INTRINSIC_UNARY_POSITIVE',
+}
+
+
+def _is_pure(instruction):
+    opname = instruction.opname
+    if opname == 'CALL_INTRINSIC_1':
+        return instruction.argrepr in PURE_INTRINSICS
+    return opname in PURE_OPCODES
+
+
+def _is_calling(instruction):
+    opname = instruction.opname
+    if opname == 'BINARY_OP':
+        # In-place operators may change an object that other variables hold,
+        # and subscripting may run C code that does:
+        argrepr = instruction.argrepr
+        return not argrepr.endswith('=') and argrepr != '[]'
+    return opname in CALLING_OPCODES or opname.startswith('UNARY_') or (
+        opname.startswith('BINARY_') and
+        opname not in ('BINARY_OP', 'BINARY_SUBSCR', 'BINARY_SLICE')
+    )
+
+
+def _get_stored_names(instruction):
+    opname = instruction.opname
+    if opname in STORE_OPCODES:
+        argval = instruction.argval
+        return argval if isinstance(argval, tuple) else (argval,)
+    elif opname in STORE_FIRST_OPCODES:
+        return instruction.argval[:1]
+    return ()
+
+
+def _get_offset_lines(code):
+    if hasattr(code, 'co_lines'):
+        offset_lines = {}
+        for start, end, line_no in code.co_lines():
+            for offset in range(start, end, 2):
+                offset_lines[offset] = line_no
+        return offset_lines.get
+    line_starts = list(dis.findlinestarts(code))
+    def get_line(offset):
+        result = None
+        for start, line_no in line_starts:
+            if start > offset:
+                break
+            result = line_no
+        return result
+    return get_line
+
+
+def get_loaded_names(code):
+    '''Get the names that `code`, or code nested in it, loads by name.'''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            names |= get_loaded_names(const)
+    return names
+
+
+def find_def_line(source, line_no):
+    '''
+    Get the line to report for a call event at `line_no`.
+
+    For decorated functions that's the `def` line rather than the line of the
+    first decorator.
+    '''
+    if not source[line_no - 1].lstrip().startswith('@'):
+        return line_no
+    for candidate_line_no in itertools.count(line_no):
+        try:
+            candidate_source_line = source[candidate_line_no - 1]
+        except IndexError:
+            break
+        if candidate_source_line.lstrip().startswith('def'):
+            # Found the def line!
+            return candidate_line_no
+    return line_no
+
+
+class UnavailableSource(object):
+    def __getitem__(self, i):
+        return u'SOURCE IS UNAVAILABLE'
+
+
+LOOP_HEADER_REGEX = re.compile(r'(?:async\s+)?(?:for|while)\b')
+JUMP_OPCODES = frozenset(dis.hasjrel) | frozenset(dis.hasjabs)
+
+
+def _get_backward_jumps(code, get_line):
+    '''
+    Yield the `(line_no, target_line_no, offset, target_offset)` of each
+    backward jump in `code`.
+
+    A jump without a line number of its own (like the one at the end of a
+    loop body that ends in an `if` block) gets the line of the instruction
+    before it.
+    '''
+    line_no = None
+    for instruction in dis.get_instructions(code):
+        line_no = get_line(instruction.offset) or line_no
+        if instruction.opcode in JUMP_OPCODES and \
+                                     isinstance(instruction.argval, int) and \
+                                     instruction.argval < instruction.offset:
+            yield (line_no, get_line(instruction.argval), instruction.offset,
+                   instruction.argval)
+
+
+def _get_indentation(source_line):
+    return len(source_line) - len(source_line.lstrip())
+
+
+def _get_block_lines(source, header_line_no):
+    '''Get the lines of the indented block that starts at `header_line_no`.'''
+    indentation = _get_indentation(source[header_line_no - 1])
+    last_line_no = header_line_no
+    for line_no in itertools.count(header_line_no + 1):
+        try:
+            source_line = source[line_no - 1]
+        except IndexError:
+            break
+        if not source_line.strip() or source_line.lstrip().startswith('#'):
+            continue
+        if _get_indentation(source_line) <= indentation:
+            break
+        last_line_no = line_no
+    return frozenset(range(header_line_no, last_line_no + 1))
+
+
+def find_loops(code, source):
+    '''
+    Map the first line of each loop in `code` to the lines of the loop.
+
+    Loops are found from backward jumps. A loop whose first line starts with
+    `for` or `while` spans the indented block under it. A backward jump
+    within a single line (like a comprehension) is a loop of that line only.
+    Other backward jumps, like the ones from `except` blocks back into a loop
+    body, aren't loops of their own.
+
+    Without the source (`UnavailableSource`), a loop spans the lines of the
+    instructions from the target of its backward jump to the jump.
+    '''
+    get_line = _get_offset_lines(code)
+    loops = {}
+    for line_no, target_line_no, offset, target_offset in \
+                                          _get_backward_jumps(code, get_line):
+        if line_no is None or target_line_no is None:
+            continue
+        if isinstance(source, UnavailableSource):
+            lines = frozenset(
+                get_line(instruction_offset) for instruction_offset in
+                range(target_offset, offset + 1, 2)
+            ) - frozenset((None,))
+            header_line_no = min(lines)
+            loops[header_line_no] = \
+                             loops.get(header_line_no, frozenset()) | lines
+            continue
+        header_line_no = min(line_no, target_line_no)
+        try:
+            header = source[header_line_no - 1].lstrip()
+        except IndexError:
+            continue
+        if LOOP_HEADER_REGEX.match(header):
+            lines = _get_block_lines(source, header_line_no)
+        elif line_no == target_line_no:
+            lines = frozenset((header_line_no,))
+        else:
+            continue
+        loops[header_line_no] = loops.get(header_line_no, frozenset()) | lines
+    return loops
+
+
+class CodeCache(object):
+    '''
+    A mapping of code objects to values that doesn't keep the code objects
+    alive, for caches that would otherwise grow with every code object that
+    was ever traced, like the ones that `exec` makes.
+
+    Entries are keyed by the id of their code object, and dropped when it's
+    garbage collected, before the id can be reused. That's cheaper to look up
+    than a `weakref.WeakKeyDictionary`.
+    '''
+    __slots__ = ('values', '_refs', '__weakref__')
+
+    def __init__(self):
+        self.values = {}
+        self._refs = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, code):
+        return id(code) in self.values
+
+    def __getitem__(self, code):
+        return self.values[id(code)]
+
+    def get(self, code, default=None):
+        return self.values.get(id(code), default)
+
+    def __setitem__(self, code, value):
+        key = id(code)
+        if key not in self._refs:
+            self._refs[key] = weakref.ref(
+                code, functools.partial(_forget_code, weakref.ref(self), key)
+            )
+        self.values[key] = value
+
+    def setdefault(self, code, default):
+        try:
+            return self[code]
+        except KeyError:
+            self[code] = default
+            return default
+
+
+def _forget_code(cache_ref, key, code_ref):
+    cache = cache_ref()
+    if cache is not None:
+        cache.values.pop(key, None)
+        cache._refs.pop(key, None)
+
+
+class CodeInfo(object):
+    def __init__(self, code):
+        # Not `code` itself, which would keep it alive in `code_infos`:
+        self._code_ref = weakref.ref(code)
+
+        base_vars_order = code.co_varnames + code.co_cellvars + \
+                                                              code.co_freevars
+        self.n_base_vars = len(base_vars_order)
+        self.vars_order = {}
+        for index, name in enumerate(base_vars_order):
+            self.vars_order.setdefault(name, index)
+
+        code_bytes = code.co_code
+        if not isinstance(code_bytes[0], int):
+            code_bytes = bytearray(code_bytes) # Python 2
+        self.return_offsets = frozenset(
+            offset for offset, code_byte in enumerate(code_bytes)
+            if opcode.opname[code_byte] in RETURN_OPCODES
+        )
+
+        self.path_and_source = None
+        self.call_lines = {}
+        # The result of `get_line_stores`, without and with `sees_calls`:
+        self._line_stores = None
+        self._loops = None
+        self._yield_offsets = None
+        self._start_offset = None
+
+    @property
+    def code(self):
+        return self._code_ref()
+
+    def sort_local_items(self, items):
+        '''
+        Sort `(name, value)` pairs taken from `frame.f_locals` into the order
+        the variables are declared in the code object.
+
+        Names that aren't in the code object (e.g. in class bodies) go last, in
+        the order `f_locals` has them.
+        '''
+        vars_order = self.vars_order
+        n_base_vars = self.n_base_vars
+        keyed_items = [
+            (vars_order.get(item[0], n_base_vars + position), item)
+            for position, item in enumerate(items)
+        ]
+        keyed_items.sort(key=_first)
+        return [item for _, item in keyed_items]
+
+    def get_call_line(self, source, line_no):
+        try:
+            return self.call_lines[line_no]
+        except KeyError:
+            result = self.call_lines[line_no] = find_def_line(source, line_no)
+            return result
+
+    def get_line_stores(self, sees_calls=True):
+        '''
+        Map each line to the names of the variables that running it may bind
+        or unbind, or to `None` if it may change other variables too.
+
+        Instructions without a line number (like the cleanup at the end of an
+        `except ... as e:` block) count for every line. The order of names
+        that aren't in the code object comes from `f_locals`, so lines that
+        store more than one of them are also mapped to `None`.
+
+        Lines with `CALLING_OPCODES` are mapped to `None` too, unless
+        `sees_calls`: the caller gets the call events of any Python code that
+        they run, and checks all variables after those.
+        '''
+        if self._line_stores is None:
+            self._line_stores = self._analyze_stores()
+        blind_line_stores, line_stores = self._line_stores
+        return line_stores if sees_calls else blind_line_stores
+
+    def _analyze_stores(self):
+        get_line = _get_offset_lines(self.code)
+        line_stores = {}
+        impure_lines = set()
+        calling_lines = set()
+        unattributed_stores = set()
+        for instruction in dis.get_instructions(self.code):
+            line_no = get_line(instruction.offset)
+            stored_names = _get_stored_names(instruction)
+            if line_no is None:
+                unattributed_stores.update(stored_names)
+                continue
+            line_stores.setdefault(line_no, set()).update(stored_names)
+            if stored_names or _is_pure(instruction):
+                continue
+            elif _is_calling(instruction):
+                calling_lines.add(line_no)
+            else:
+                impure_lines.add(line_no)
+        result = {}
+        for line_no, stored_names in line_stores.items():
+            stored_names |= unattributed_stores
+            if line_no in impure_lines or len(
+                          [name for name in stored_names
+                           if name not in self.vars_order]) > 1:
+                result[line_no] = None
+            else:
+                result[line_no] = frozenset(stored_names)
+        blind_result = dict(result)
+        for line_no in calling_lines:
+            blind_result[line_no] = None
+        return blind_result, result
+
+    def get_loops(self):
+        '''
+        Map the first line of each loop to the lines of the loop, see
+        `find_loops`. Needs `path_and_source`.
+        '''
+        if self._loops is None:
+            self._loops = find_loops(self.code, self.path_and_source[1])
+        return self._loops
+
+    def is_yielding(self, frame):
+        '''
+        Whether a return event of `frame` is the frame being suspended by a
+        `yield` or an `await`, rather than the frame being done.
+        '''
+        if self._yield_offsets is None:
+            self._yield_offsets = set()
+            instructions = list(dis.get_instructions(self.code))
+            for instruction, next_instruction in zip(instructions,
+                                                     instructions[1:] + [None]):
+                if instruction.opname in YIELD_OPCODES:
+                    self._yield_offsets.add(instruction.offset)
+                    # Since Python 3.13 a suspended frame is at the `RESUME`
+                    # after the yield.
+                    if next_instruction is not None and \
+                                          next_instruction.opname == 'RESUME':
+                        self._yield_offsets.add(next_instruction.offset)
+        return frame.f_lasti in self._yield_offsets
+
+    def is_starting(self, frame):
+        '''
+        Whether `frame` hasn't run any of its code yet, like on the call event
+        of a new frame, as opposed to a generator frame that's resumed.
+        '''
+        if self._start_offset is None:
+            # Python 3.11+ starts code objects with a `RESUME`, older versions
+            # have `f_lasti == -1` on a new frame:
+            self._start_offset = next(
+                (instruction.offset for instruction in
+                 dis.get_instructions(self.code)
+                 if instruction.opname == 'RESUME'), -1
+            )
+        return frame.f_lasti <= self._start_offset
+
+    def is_ended_by_exception(self, frame):
+        return frame.f_lasti not in self.return_offsets
+
+
+def _first(pair):
+    return pair[0]
+
+
+code_infos = CodeCache()
+
+
+def get_code_info(code):
+    try:
+        return code_infos[code]
+    except KeyError:
+        code_info = code_infos[code] = CodeInfo(code)
+        return code_info
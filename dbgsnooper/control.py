@@ -0,0 +1,347 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+A control server on a local Unix domain socket, to snoop on a process that's
+running without changing its code or restarting it.
+
+It's opt-in, with `serve(path)`. Each connection sends one command line, and
+gets the answer back over the same connection:
+
+ - `snoop MODULE:QUALNAME [calls=N] [KEYWORD=VALUE ...]`: snoop on the next
+   `N` calls (1 by default) of the function, with a `Tracer` that writes to
+   the connection as the calls are done. The keywords are `Tracer` arguments
+   with Python literals as values, like `depth=2` or `watch=('self.x',)`.
+   The connection is closed once the calls are done, and the function is put
+   back as it was then, or when the client disconnects.
+ - `enable`, `disable`: turn snooping on or off, see `switch`.
+ - `status`: say whether snooping is on.
+
+Errors are answered with a line that starts with `error: `. The function is
+replaced where it's defined, in its module or class, so the callers that got
+it from there before the command came keep calling the function itself.
+
+`dbgsnooper control SOCKET COMMAND ...` is a client.
+'''
+
+import ast
+import codecs
+import functools
+import importlib
+import inspect
+import os
+import select
+import shlex
+import socket
+import stat
+import threading
+
+from . import pycompat, switch
+from .tracer import Tracer
+
+# The `Tracer` arguments that `snoop` takes:
+TRACER_ARGUMENTS = frozenset((
+    'depth', 'watch', 'watch_explode', 'prefix', 'thread_info', 'color',
+    'max_variable_length', 'normalize', 'relative_time', 'exceptions_only',
+))
+# How often a connection that waits for snooped calls checks whether its
+# client is gone:
+POLL_INTERVAL = 0.1
+MAX_COMMAND_LENGTH = 64 * 1024
+
+
+class _CommandError(Exception):
+    pass
+
+
+def serve(path):
+    '''Start a `ControlServer` on the Unix domain socket at `path`.'''
+    return ControlServer(path)
+
+
+class ControlServer(object):
+    '''
+    Answers the commands that come to the Unix domain socket at `path`, on
+    background threads (see the module's docstring). Only the user that
+    runs the process may connect.
+    '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if os.path.lexists(self.path):
+            _remove_stale_socket(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket is made with these permissions, so no other user may
+        # connect to it before they could be changed:
+        umask = os.umask(0o177)
+        try:
+            self.socket.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.socket.listen(8)
+        self._thread = threading.Thread(target=self._serve,
+                                        name='dbgsnooper-control')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                # The server was closed.
+                return
+            thread = threading.Thread(target=_handle, args=(connection,),
+                                      name='dbgsnooper-control-connection')
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        '''Stop taking connections. The ones that came already go on.'''
+        try:
+            # Wakes up `accept`, which closing alone doesn't:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self._thread.join()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _remove_stale_socket(path):
+    # Left by a process that's gone, unless a server still answers at it:
+    if not stat.S_ISSOCK(os.lstat(path).st_mode):
+        raise OSError('{} exists, and is not a socket.'.format(path))
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise OSError('A control server already listens at {}.'.format(path))
+    finally:
+        client.close()
+
+
+def send_command(path, command, write):
+    '''
+    Send `command` to the control server at `path`, and `write` its answer
+    as it comes, until the server closes the connection.
+    '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall(command.encode('utf-8') + b'\n')
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            data = client.recv(64 * 1024)
+            if not data:
+                break
+            write(decoder.decode(data))
+        write(decoder.decode(b'', final=True))
+    finally:
+        client.close()
+
+
+def _handle(connection):
+    try:
+        try:
+            answer = _run(connection, _read_line(connection))
+        except _CommandError as e:
+            answer = u'error: {}\n'.format(e)
+        except Exception as e:
+            answer = u'error: {}: {}\n'.format(type(e).__name__, e)
+        if answer:
+            connection.sendall(answer.encode('utf-8'))
+    except OSError:
+        # The client is gone.
+        pass
+    finally:
+        connection.close()
+
+
+def _read_line(connection):
+    data = b''
+    while b'\n' not in data:
+        if len(data) > MAX_COMMAND_LENGTH:
+            raise _CommandError('The command is too long.')
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.split(b'\n', 1)[0].decode('utf-8', 'replace')
+
+
+def _run(connection, line):
+    '''Run the command in `line`, and return what to answer, if anything.'''
+    words = shlex.split(line)
+    if not words:
+        raise _CommandError('No command.')
+    command, arguments = words[0], words[1:]
+    if command in ('enable', 'disable'):
+        getattr(switch, command)()
+        return _get_status()
+    elif command == 'status':
+        return _get_status()
+    elif command == 'snoop':
+        _snoop(connection, arguments)
+        return None
+    raise _CommandError('Unknown command {!r}.'.format(command))
+
+
+def _get_status():
+    return u'snooping is {}\n'.format('on' if switch.is_enabled() else 'off')
+
+
+def _parse_arguments(words):
+    arguments = {}
+    for word in words:
+        name, equals, value = word.partition('=')
+        if not equals:
+            raise _CommandError('Expected KEYWORD=VALUE, not {!r}.'.format(
+                                                                         word))
+        if name != 'calls' and name not in TRACER_ARGUMENTS:
+            raise _CommandError('Unknown keyword {!r}.'.format(name))
+        try:
+            arguments[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise _CommandError('{} must be a Python literal, not {!r}.'.format(
+                                                                  name, value))
+    return arguments
+
+
+def _snoop(connection, words):
+    if not words:
+        raise _CommandError('Usage: snoop MODULE:QUALNAME [calls=N] '
+                            '[KEYWORD=VALUE ...]')
+    if not switch.is_enabled():
+        raise _CommandError('Snooping is off, send `enable` first.')
+    arguments = _parse_arguments(words[1:])
+    n_calls = arguments.pop('calls', 1)
+    if not isinstance(n_calls, int) or n_calls < 1:
+        raise _CommandError('calls must be a positive integer.')
+    arguments.setdefault('color', False)
+    owner, name = _resolve(words[0])
+    # The snooped code mustn't wait for the client:
+    tracer = Tracer(connection, async_output=True, overflow='drop-oldest',
+                    **arguments)
+    session = _Session(owner, name, n_calls, tracer)
+    session.install()
+    try:
+        while not session.done.wait(POLL_INTERVAL):
+            readable, _, _ = select.select([connection], [], [], 0)
+            if readable and not connection.recv(4096):
+                # The client is gone.
+                return
+    finally:
+        session.restore()
+        tracer.flush()
+
+
+def _resolve(target):
+    '''Get the module or class that has the function `target`, and its name.'''
+    module_name, colon, qualname = target.partition(':')
+    if not colon or not module_name or not qualname:
+        raise _CommandError('Expected MODULE:QUALNAME, not {!r}.'.format(
+                                                                       target))
+    try:
+        owner = importlib.import_module(module_name)
+    except ImportError as e:
+        raise _CommandError(str(e))
+    path = qualname.split('.')
+    for part in path[:-1]:
+        try:
+            owner = getattr(owner, part)
+        except AttributeError:
+            raise _CommandError('No {!r} in {}.'.format(part, module_name))
+    if path[-1] not in getattr(owner, '__dict__', {}):
+        raise _CommandError('No {!r} in {}.'.format(qualname, module_name))
+    return owner, path[-1]
+
+
+class _Session(object):
+    '''
+    The next `n_calls` calls of the function `name` of `owner`, snooped on
+    with `tracer`. `done` is set once they're over.
+    '''
+    def __init__(self, owner, name, n_calls, tracer):
+        self.owner = owner
+        self.name = name
+        self.n_calls = n_calls
+        self.original = vars(owner)[name]
+        if isinstance(self.original, (staticmethod, classmethod)):
+            function = self.original.__func__
+        else:
+            function = self.original
+        if not inspect.isfunction(function):
+            raise _CommandError('{} is not a function.'.format(name))
+        if pycompat.isasyncgenfunction(function):
+            raise _CommandError('Asynchronous generator functions are not '
+                                'supported.')
+        wrapper = self._wrap(function, tracer(function))
+        if function is self.original:
+            self.patched = wrapper
+        else:
+            self.patched = type(self.original)(wrapper)
+        self.n_started = 0
+        self.n_running = 0
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def install(self):
+        setattr(self.owner, self.name, self.patched)
+
+    def restore(self):
+        with self._lock:
+            if vars(self.owner).get(self.name) is self.patched:
+                setattr(self.owner, self.name, self.original)
+
+    def _start_call(self):
+        '''Count a call, and return whether it's one to snoop on.'''
+        with self._lock:
+            if self.n_started == self.n_calls:
+                return False
+            self.n_started += 1
+            self.n_running += 1
+            is_last = self.n_started == self.n_calls
+        if is_last:
+            self.restore()
+        return True
+
+    def _end_call(self):
+        with self._lock:
+            self.n_running -= 1
+            if self.n_started == self.n_calls and not self.n_running:
+                self.done.set()
+
+    def _wrap(self, function, snooped_function):
+        start_call, end_call = self._start_call, self._end_call
+        if pycompat.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                if not start_call():
+                    return await function(*args, **kwargs)
+                try:
+                    return await snooped_function(*args, **kwargs)
+                finally:
+                    end_call()
+        elif inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not start_call():
+                    return (yield from function(*args, **kwargs))
+                try:
+                    return (yield from snooped_function(*args, **kwargs))
+                finally:
+                    end_call()
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not start_call():
+                    return function(*args, **kwargs)
+                try:
+                    return snooped_function(*args, **kwargs)
+                finally:
+                    end_call()
+        return wrapper
@@ -0,0 +1,92 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Snooping on coroutine functions and asynchronous generator functions.
+
+Their wrappers drive the coroutine one step at a time, like `Tracer` does
+with generators, snooping on each step with the state of the task it runs
+in (see `Tracer.enter_task`). Tasks interleave on their thread, so each
+task's output is held back and written in one piece once its outermost
+snooped coroutine is done.
+'''
+
+import functools
+import types
+
+from . import tracer as tracer_module
+
+
+@types.coroutine
+def _suspend(value):
+    '''Pass `value` on to the event loop, and get what it resumes with.'''
+    return (yield value)
+
+
+async def snoop_steps(tracer, awaitable):
+    '''
+    Await `awaitable`, a coroutine or the like, snooping on each of its
+    steps with `tracer`.
+    '''
+    task_state = tracer.enter_task()
+    exc_type = None
+    try:
+        method, incoming = awaitable.send, None
+        while True:
+            try:
+                outgoing = tracer.run_task_step(task_state, method, incoming)
+            except StopIteration as stop_iteration:
+                return stop_iteration.value
+            try:
+                method, incoming = awaitable.send, await _suspend(outgoing)
+            except BaseException as e:
+                # Like cancellation, which is for the coroutine to handle:
+                method, incoming = awaitable.throw, e
+    except BaseException as e:
+        exc_type = type(e)
+        raise
+    finally:
+        tracer.exit_task(task_state, exc_type)
+
+
+async def _await(tracer, awaitable):
+    # For the calls that weren't sampled, or made while snooping is off:
+    return await awaitable
+
+
+def wrap_coroutine_function(tracer, function):
+    sampler = tracer.sampler
+
+    @functools.wraps(function)
+    async def coroutine_wrapper(*args, **kwargs):
+        if tracer_module.DISABLED or \
+                            (sampler is not None and not sampler.sample()):
+            return await function(*args, **kwargs)
+        return await snoop_steps(tracer, function(*args, **kwargs))
+    return coroutine_wrapper
+
+
+def wrap_async_generator_function(tracer, function):
+    sampler = tracer.sampler
+
+    @functools.wraps(function)
+    async def async_generator_wrapper(*args, **kwargs):
+        agen = function(*args, **kwargs)
+        if not tracer_module.DISABLED and \
+                                    (sampler is None or sampler.sample()):
+            run = snoop_steps
+        else:
+            run = _await
+        method, incoming = agen.asend, None
+        while True:
+            try:
+                outgoing = await run(tracer, method(incoming))
+            except StopAsyncIteration:
+                return
+            try:
+                method, incoming = agen.asend, (yield outgoing)
+            except GeneratorExit:
+                await run(tracer, agen.aclose())
+                raise
+            except Exception as e:
+                method, incoming = agen.athrow, e
+    return async_generator_wrapper
@@ -0,0 +1,71 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Dumping what tracers made with `flight_recorder` kept, when something goes
+wrong.
+
+Those tracers write nothing while things go well, they only keep the last
+events of each thread (see `RingBuffers`). Their events are rendered and
+written by `Tracer.dump`, which is called here on an uncaught exception, in
+any thread, and on the tracer's `dump_signal`.
+'''
+
+import signal
+import sys
+import threading
+import weakref
+
+from . import utils
+
+DEFAULT_DUMP_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+_tracers = weakref.WeakSet()
+_lock = threading.Lock()
+_previous_excepthook = None
+_previous_threading_excepthook = None
+
+
+def register(tracer):
+    '''Have `tracer` dump its events when something goes wrong.'''
+    with _lock:
+        if tracer.dump_signal is not None:
+            utils.chain_signal_handler(tracer.dump_signal, _handle_signal)
+        _tracers.add(tracer)
+        _install_excepthooks()
+
+
+def _install_excepthooks():
+    global _previous_excepthook, _previous_threading_excepthook
+    if _previous_excepthook is not None:
+        return
+    _previous_excepthook = sys.excepthook
+    sys.excepthook = _excepthook
+    if hasattr(threading, 'excepthook'):
+        _previous_threading_excepthook = threading.excepthook
+        threading.excepthook = _threading_excepthook
+
+
+def _dump_all(reason, tracers=None, blocking=True):
+    for tracer in list(_tracers) if tracers is None else tracers:
+        try:
+            tracer.dump(reason, blocking)
+        except Exception:
+            pass
+
+
+def _excepthook(exc_type, exc_value, exc_traceback):
+    _dump_all('an uncaught {}'.format(exc_type.__name__))
+    _previous_excepthook(exc_type, exc_value, exc_traceback)
+
+
+def _threading_excepthook(args):
+    _dump_all('an uncaught {} in thread {}'.format(args.exc_type.__name__,
+                                                   args.thread.name))
+    _previous_threading_excepthook(args)
+
+
+def _handle_signal(signum, frame):
+    tracers = [tracer for tracer in list(_tracers)
+               if tracer.dump_signal == signum]
+    # The thread that got the signal may have been dumping:
+    _dump_all(signal.Signals(signum).name, tracers, blocking=False)
@@ -0,0 +1,395 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Structured records of what `Tracer` reports, and rendering them as text.
+
+`Tracer.trace` only builds an `Event` for each line of output. Turning events
+into text is left to `TextRenderer`. Text output is rendered as soon as each
+event is emitted, so it keeps its place among what the snooped program writes
+itself; events are only buffered where they have to wait, like for binary
+recordings, the tasks of an event loop, or `keep_slower_than`.
+'''
+
+import collections
+import heapq
+import threading
+import time
+
+from . import pycompat
+from .code_info import get_code_info
+
+try:
+    monotonic_ns = time.monotonic_ns
+except AttributeError: # Python < 3.7
+    def monotonic_ns():
+        return int(time.monotonic() * 1e9)
+
+# Event kinds. An event of a frame (`call`, `line`, `return` or `exception`)
+# has the frame event as its kind, the rest are:
+SOURCE_PATH = 'source_path'
+STARTING_VARS = 'starting_vars'
+NEW_VARS = 'new_vars'
+MODIFIED_VARS = 'modified_vars'
+CALL_ENDED_BY_EXCEPTION = 'call_ended_by_exception'
+BODY_OMITTED = 'body_omitted'
+RETURN_VALUE = 'return_value'
+EXCEPTION_VALUE = 'exception_value'
+ELAPSED_TIME = 'elapsed_time'
+SKIPPED = 'skipped'
+STATES_DROPPED = 'states_dropped'
+REPR_SUPPRESSED = 'repr_suppressed'
+TEXT = 'text'
+LOCALS = 'locals'
+VALUES = 'values'
+
+FRAME_EVENTS = frozenset(('call', 'line', 'return', 'exception'))
+
+# Past this many events, or once its first event waited this long, a buffer
+# gets flushed without waiting for the end of the snooped scope:
+MAX_BUFFERED_EVENTS = 1000
+MAX_BUFFER_DELAY = 0.1
+
+
+class Event(object):
+    '''
+    One line of output, before it's rendered.
+
+    `depth` is the indentation level, `timestamp` is when the event happened,
+    from `monotonic_ns`. Events about a frame have its `code`, and the serial
+    number of its state as `serial` (see `FrameState`). `thread` is the ident
+    of the thread the event happened in, which isn't always the one that
+    writes it (see `ThreadBuffers`). `data` depends on `kind`:
+
+     - Frame events: `None`, the source line is found from `code` and
+       `line_no`. (Events read from a recording have the source line.)
+     - `SOURCE_PATH`, `RETURN_VALUE`, `EXCEPTION_VALUE`, `TEXT`: the string to
+       show.
+     - `STARTING_VARS`, `NEW_VARS`, `MODIFIED_VARS`, `LOCALS`: `(name, repr)`
+       pairs.
+     - `VALUES`: `(name, value)` pairs, with the values that `trace_var`
+       compares (see `resolve_variable`).
+     - `ELAPSED_TIME`: a `timedelta`.
+     - `STATES_DROPPED`: `(n_evicted, max_state_size)`.
+     - `REPR_SUPPRESSED`: `(type_name, reason)`.
+    '''
+    __slots__ = ('kind', 'depth', 'line_no', 'code', 'thread_info', 'data',
+                 'timestamp', 'serial', 'thread')
+
+    def __init__(self, kind, depth, line_no=None, code=None, thread_info='',
+                 data=None, serial=0):
+        self.kind = kind
+        self.depth = depth
+        self.line_no = line_no
+        self.code = code
+        self.thread_info = thread_info
+        self.data = data
+        self.timestamp = monotonic_ns()
+        self.serial = serial
+        self.thread = threading.get_ident()
+
+    def __repr__(self):
+        return '<Event {} depth={} line_no={}>'.format(self.kind, self.depth,
+                                                        self.line_no)
+
+
+def format_var_reprs(var_reprs, separator, prefix='', max_length=200,
+                     cut_length=94):
+    '''
+    Join `name = repr` for `(name, repr)` pairs, cutting the result to
+    `cut_length` characters and ' ......' if it's longer than `max_length`.
+
+    Stops joining once the result is known to be cut.
+    '''
+    parts = [prefix]
+    length = len(prefix)
+    for name, value_repr in var_reprs:
+        part = u'{} = {}{}'.format(name, value_repr, separator)
+        parts.append(part)
+        length += len(part)
+        if length > max_length:
+            # The rest starts with a name, so stripping the end of the whole
+            # string can't reach into what we have so far:
+            result = u''.join(parts).rstrip().strip(',')
+            if len(result) > max_length:
+                return result[:cut_length] + u' ......'
+    return u''.join(parts).rstrip().strip(',')
+
+
+class TextRenderer(object):
+    '''Renders events into the lines that `Tracer` writes, with `prefix` and
+    ANSI colors if `color` is set.'''
+    def __init__(self, prefix='', color=False):
+        self.prefix = prefix
+        if color:
+            blue, cyan, green, red, yellow = (
+                '\x1b[34m', '\x1b[36m', '\x1b[32m', '\x1b[31m', '\x1b[33m'
+            )
+            bright, dim, normal, reset_all = (
+                '\x1b[1m', '\x1b[2m', '\x1b[22m', '\x1b[0m'
+            )
+        else:
+            blue = cyan = green = red = yellow = ''
+            bright = dim = normal = reset_all = ''
+        self._dim = dim
+        self._reset_all = reset_all
+        self._indents = []
+        # Whatever goes before and after the text of each kind, with the
+        # indentation at `{}`. Frame events and the source path are special:
+        self._templates = {
+            STARTING_VARS: (u'{}' + green + dim + u'Starting var:.. ' + normal,
+                            reset_all),
+            NEW_VARS: (u'{}' + green + dim + u'New var:....... ' + normal,
+                       reset_all),
+            MODIFIED_VARS: (u'{}' + green + dim + u'Modified var:.. ' + normal,
+                            reset_all),
+            LOCALS: (u'{}' + green + dim + u'Locals:........ ' + normal,
+                     reset_all),
+            VALUES: (u'{}' + green + dim + u'Values:........ ' + normal,
+                     reset_all),
+            CALL_ENDED_BY_EXCEPTION: (red + u'{}Call ended by exception',
+                                      reset_all),
+            BODY_OMITTED: (u'{}' + dim, reset_all +
+                                         u'    ... (function body omitted)'),
+            RETURN_VALUE: (u'{}' + cyan + dim + u'Return value:.. ' + normal,
+                           reset_all),
+            EXCEPTION_VALUE: (u'{}' + red + u'Exception:..... ' + bright,
+                              reset_all),
+            ELAPSED_TIME: (u'{}' + yellow + dim + u'Elapsed time: ' + normal,
+                           reset_all),
+            SKIPPED: (u'{}' + blue + dim +
+                      u'......Skipping repeated execution details......',
+                      reset_all),
+            STATES_DROPPED: (u'{}' + yellow + dim + u'States dropped:... ' +
+                             normal, reset_all),
+            REPR_SUPPRESSED: (u'{}' + yellow + dim + u'Repr suppressed:.. ' +
+                              normal, reset_all),
+            SOURCE_PATH: (yellow + dim + u'{}Source path:... ' + normal,
+                          reset_all),
+        }
+
+    def _get_indent(self, depth):
+        indents = self._indents
+        while len(indents) <= depth:
+            indents.append(u' ' * 4 * len(indents))
+        return indents[depth]
+
+    def render(self, event):
+        '''Render `event` as a line, without the prefix and newline.'''
+        kind = event.kind
+        # Negative depths are possible, and indent nothing just like
+        # `' ' * -4` does:
+        indent = self._get_indent(event.depth) if event.depth > 0 else u''
+        if kind in FRAME_EVENTS:
+            source_line = event.data
+            if source_line is None:
+                source = get_code_info(event.code).path_and_source[1]
+                source_line = source[event.line_no - 1]
+            return u'{}{}{}{:9} {:4}{} {}'.format(
+                indent, self._dim, event.thread_info, kind, event.line_no,
+                self._reset_all, source_line
+            )
+        if kind == TEXT:
+            return event.data
+        start, end = self._templates[kind]
+        data = event.data
+        if kind == STARTING_VARS or kind == NEW_VARS:
+            text = format_var_reprs(data, ',    ')
+        elif kind == MODIFIED_VARS or kind == LOCALS or kind == VALUES:
+            text = format_var_reprs(data, ', ')
+        elif kind == ELAPSED_TIME:
+            text = pycompat.timedelta_format(data)
+        elif kind == STATES_DROPPED:
+            text = u'{} (over max_state_size={})'.format(*data)
+        elif kind == REPR_SUPPRESSED:
+            text = u'{} ({})'.format(*data)
+        elif kind == BODY_OMITTED:
+            return start.format(indent) + event.thread_info + end
+        elif kind == SKIPPED or kind == CALL_ENDED_BY_EXCEPTION:
+            return start.format(indent) + end
+        else:
+            text = data
+        return start.format(indent) + text + end
+
+    def render_lines(self, events):
+        '''Render `events` as lines to write, with the prefix and newline.'''
+        prefix = self.prefix
+        render = self.render
+        return [u'{}{}\n'.format(prefix, render(event)) for event in events]
+
+
+class EventBuffer(object):
+    '''
+    Events waiting to be rendered, in the order they happened, and the sinks
+    (usually tracers) they're for.
+
+    Tracers that run on the same thread share a buffer, so their output keeps
+    its order when they write to the same place. `flush` hands each sink the
+    events that are for it with `sink.write_events(events)`, and
+    `flush_sinks` calls `sink.flush_output()` on the sinks that got events
+    since, for sinks that buffer what they write. Sinks that write their events
+    right away call `add_written_sink` instead of `add`, so they get flushed
+    along with the rest.
+
+    `add` asks for a flush once there are `max_events` events, or once the
+    first of them is `max_delay` seconds old, so not much is lost if the
+    process dies before the end of the snooped scope.
+    '''
+    def __init__(self, max_events=MAX_BUFFERED_EVENTS,
+                 max_delay=MAX_BUFFER_DELAY):
+        self.max_events = max_events
+        self.max_delay_ns = int(max_delay * 1e9)
+        # Events, with a sink before each run of events that's for it:
+        self.items = []
+        self.n_events = 0
+        self._first_timestamp = None
+        self._last_sink = None
+        self.written_sinks = []
+
+    def __len__(self):
+        return self.n_events
+
+    def add(self, sink, event):
+        '''Add `event`, and return whether the buffer should be flushed.'''
+        if sink is not self._last_sink:
+            self.items.append(_SinkMarker(sink))
+            self._last_sink = sink
+        self.items.append(event)
+        self.n_events += 1
+        if self._first_timestamp is None:
+            self._first_timestamp = event.timestamp
+        return self.n_events >= self.max_events or \
+               event.timestamp - self._first_timestamp >= self.max_delay_ns
+
+    def add_written_sink(self, sink):
+        '''Note that `sink` wrote events itself, for `flush_sinks`.'''
+        if sink not in self.written_sinks:
+            self.written_sinks.append(sink)
+
+    def drain(self):
+        '''Take all the events out, as a list of `(sink, events)` pairs.'''
+        items, self.items = self.items, []
+        self.n_events = 0
+        self._first_timestamp = None
+        self._last_sink = None
+        runs = []
+        for item in items:
+            if type(item) is _SinkMarker:
+                events = []
+                runs.append((item.sink, events))
+            else:
+                events.append(item)
+        return runs
+
+    def flush(self):
+        written_sinks = self.written_sinks
+        for sink, events in self.drain():
+            sink.write_events(events)
+            if sink not in written_sinks:
+                written_sinks.append(sink)
+
+    def flush_sinks(self):
+        written_sinks, self.written_sinks = self.written_sinks, []
+        for sink in written_sinks:
+            sink.flush_output()
+
+
+class ThreadBuffers(object):
+    '''
+    The events of a tracer that snoops on several threads, in a list per
+    thread, so the threads don't contend on one buffer.
+
+    Each thread only ever appends to its own list. `drain` takes out what all
+    of them have so far and merges it by `timestamp`, so the events of
+    different threads come out in the order they happened, each in one piece.
+    '''
+    def __init__(self):
+        # Reentrant, since `drain` may run in a signal handler that
+        # interrupted `get`:
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        # `(thread, events)` pairs:
+        self.buffers = []
+
+    def get(self):
+        '''Get the list of the current thread's events.'''
+        try:
+            return self._local.events
+        except AttributeError:
+            events = self._local.events = []
+            with self._lock:
+                self.buffers.append((threading.current_thread(), events))
+            return events
+
+    def drain(self):
+        '''Take all the events out, ordered by their timestamps.'''
+        with self._lock:
+            buffers = list(self.buffers)
+        runs = []
+        finished = []
+        for thread, events in buffers:
+            # The thread can append more while we're at it, so only what's
+            # there now is taken out:
+            n_events = len(events)
+            if n_events:
+                runs.append(events[:n_events])
+                del events[:n_events]
+            elif not thread.is_alive():
+                finished.append(events)
+        if finished:
+            with self._lock:
+                self.buffers = [
+                    (thread, events) for thread, events in self.buffers
+                    if not any(events is events_ for events_ in finished)
+                ]
+        return list(heapq.merge(*runs, key=lambda event: event.timestamp))
+
+
+class RingBuffers(object):
+    '''
+    The last `size` events of each thread, for a tracer that only writes them
+    when something goes wrong (see `flight_recorder`).
+
+    Like with `ThreadBuffers`, each thread only appends to its own ring.
+    '''
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('`flight_recorder` must be at least 1.')
+        self.size = size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # `(thread, ring)` pairs:
+        self.rings = []
+
+    def get(self):
+        '''Get the ring of the current thread's events.'''
+        try:
+            return self._local.ring
+        except AttributeError:
+            ring = self._local.ring = collections.deque(maxlen=self.size)
+            with self._lock:
+                # The rings of threads that are done are kept until a new one
+                # comes along, so the memory they take stays bounded:
+                self.rings = [(thread, ring_) for thread, ring_ in self.rings
+                              if thread.is_alive()]
+                self.rings.append((threading.current_thread(), ring))
+            return ring
+
+    def drain(self):
+        '''Take all the events out, ordered by their timestamps.'''
+        with self._lock:
+            rings = list(self.rings)
+        runs = []
+        for thread, ring in rings:
+            events = []
+            # The thread can append more while we're at it:
+            for _ in range(len(ring)):
+                events.append(ring.popleft())
+            runs.append(events)
+        return list(heapq.merge(*runs, key=lambda event: event.timestamp))
+
+
+class _SinkMarker(object):
+    __slots__ = ('sink',)
+
+    def __init__(self, sink):
+        self.sink = sink
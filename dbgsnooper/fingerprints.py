@@ -0,0 +1,178 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''Cheap change detection for variable values, so unchanged ones aren't
+repr'd again on every line.'''
+
+import collections
+import itertools
+import operator
+
+from . import utils
+
+IMMUTABLE_TYPES = frozenset((
+    int, float, complex, bool, type(None), str, bytes, type(u''), range,
+    type(Ellipsis), type(NotImplemented),
+))
+CONTAINER_TYPES = frozenset((
+    list, tuple, set, frozenset, collections.deque, dict,
+))
+
+# The bounds of the structural fingerprint of a value. Beyond them it's repr'd
+# on every line, like before:
+MAX_FINGERPRINT_SIZE = 10000
+MAX_NESTED_CONTAINERS = 64
+MAX_FINGERPRINT_DEPTH = 8
+
+IMMUTABLE = 'immutable'
+
+# Rough sizes in bytes, see `ReprCache.size`:
+ENTRY_SIZE = 200
+REFERENCE_SIZE = 8
+
+
+def _get_children(value):
+    if type(value) is dict:
+        return tuple(itertools.chain(value, value.values()))
+    return tuple(value)
+
+
+class _Budget(object):
+    __slots__ = ('size', 'containers')
+
+    def __init__(self):
+        self.size = MAX_FINGERPRINT_SIZE
+        self.containers = MAX_NESTED_CONTAINERS
+
+
+def get_fingerprint(value, default_repr_is_stable=True):
+    '''
+    Get the fingerprint of `value`, or `None` if it can't have one.
+
+    As long as a variable is bound to the same object and `matches` says that
+    the object still matches its fingerprint, the object's repr is the same
+    too. Values of immutable types need nothing more than the identity check.
+    Builtin containers are fingerprinted by the identities of their items,
+    recursively and within bounds. Objects with the default repr are
+    fingerprinted by their type, unless there's a custom repr that might look
+    at anything else.
+    '''
+    value_type = type(value)
+    if value_type in IMMUTABLE_TYPES:
+        return IMMUTABLE
+    try:
+        return _get_fingerprint(value, value_type, default_repr_is_stable,
+                                _Budget(), 0)
+    except Exception:
+        # E.g. a container that another thread changed while we iterated it.
+        return None
+
+
+def _get_fingerprint(value, value_type, default_repr_is_stable, budget, depth):
+    if value_type not in CONTAINER_TYPES:
+        if default_repr_is_stable and value_type.__repr__ is object.__repr__:
+            # The default repr only depends on the type and the id.
+            return value_type
+        return None
+    budget.containers -= 1
+    if budget.containers < 0 or depth > MAX_FINGERPRINT_DEPTH:
+        return None
+    children = _get_children(value)
+    budget.size -= len(children)
+    if budget.size < 0:
+        return None
+    nested = []
+    if not set(map(type, children)) <= IMMUTABLE_TYPES:
+        for index, child in enumerate(children):
+            child_type = type(child)
+            if child_type in IMMUTABLE_TYPES:
+                continue
+            child_fingerprint = _get_fingerprint(
+                child, child_type, default_repr_is_stable, budget, depth + 1
+            )
+            if child_fingerprint is None:
+                return None
+            nested.append((index, child_fingerprint))
+    return (children, tuple(nested))
+
+
+def matches(fingerprint, value):
+    '''Whether `value`, which was fingerprinted before, still matches.'''
+    if fingerprint is IMMUTABLE:
+        return True
+    elif type(fingerprint) is not tuple:
+        return type(value) is fingerprint
+    children, nested = fingerprint
+    try:
+        if type(value) is dict:
+            if len(value) * 2 != len(children) or not all(map(
+                  operator.is_, children, itertools.chain(value,
+                                                          value.values()))):
+                return False
+        elif len(value) != len(children) or \
+                                not all(map(operator.is_, children, value)):
+            return False
+    except Exception:
+        return False
+    # The items are the same objects, but mutable ones may have changed
+    # inside:
+    for index, child_fingerprint in nested:
+        if not matches(child_fingerprint, children[index]):
+            return False
+    return True
+
+
+def _get_entry_size(name, fingerprint, value_repr):
+    size = ENTRY_SIZE + len(name) + len(value_repr)
+    if type(fingerprint) is tuple:
+        children, nested = fingerprint
+        size += REFERENCE_SIZE * (len(children) + 2 * len(nested))
+    return size
+
+
+class ReprCache(object):
+    '''
+    The reprs of the variables of one frame.
+
+    A variable is only repr'd again when it's bound to another object, or when
+    its object doesn't match its fingerprint anymore. `size` is a rough count
+    of the bytes the reprs and the fingerprints take.
+    '''
+    def __init__(self, custom_repr=(), max_length=None, normalize=False,
+                 repr_guard=None):
+        self.custom_repr = custom_repr
+        self.max_length = max_length
+        self.normalize = normalize
+        self.repr_guard = repr_guard
+        # A custom repr may look at anything, not just the type and the id:
+        self.default_repr_is_stable = not custom_repr
+        self.entries = {}
+        self.size = 0
+        # Where the reprs were last taken, see `Tracer.get_dirty_names`:
+        self.line_no = None
+        self.event_index = None
+
+    def get_repr(self, name, value):
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] is value and \
+                          entry[1] is not None and matches(entry[1], value):
+            return entry[2]
+        fingerprint = get_fingerprint(value, self.default_repr_is_stable)
+        value_repr = utils.get_shortish_repr(value, self.custom_repr,
+                                             self.max_length, self.normalize,
+                                             self.repr_guard)
+        if entry is not None:
+            self.size -= _get_entry_size(name, entry[1], entry[2])
+        self.entries[name] = (value, fingerprint, value_repr)
+        self.size += _get_entry_size(name, fingerprint, value_repr)
+        return value_repr
+
+    def discard(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.size -= _get_entry_size(name, entry[1], entry[2])
+
+    def prune(self, names):
+        '''Forget the variables that aren't in `names` anymore.'''
+        if len(self.entries) != len(names):
+            for name in set(self.entries).difference(names):
+                self.discard(name)
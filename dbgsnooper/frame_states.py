@@ -0,0 +1,174 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Per-frame tracer state that only lives as long as its frame runs, and the
+per-thread (or per-task) state that holds it.
+'''
+
+import collections
+import itertools
+
+# Rough sizes in bytes, for keeping the state under a ceiling:
+FRAME_STATE_SIZE = 500
+DEFAULT_MAX_STATE_SIZE = 64 * 1024 * 1024
+
+
+class FrameState(object):
+    '''Everything a `Tracer` keeps about one frame.'''
+    __slots__ = ('serial', 'code', 'size', 'local_reprs', 'repr_cache',
+                 'start_time', 'loops', 'call_info', 'exception')
+
+    def __init__(self, serial, code):
+        self.serial = serial
+        self.code = code
+        self.size = FRAME_STATE_SIZE
+        self.local_reprs = None
+        self.repr_cache = None
+        self.start_time = None
+        self.loops = None
+        self.call_info = None
+        # `(line_no, thread_info, exc_info)` of the last exception that was
+        # raised past the shown iterations of a loop, until a line is shown:
+        self.exception = None
+
+    def forget_locals(self):
+        '''Drop what's only needed while the frame runs without a break.'''
+        self.local_reprs = None
+        self.repr_cache = None
+        self.start_time = None
+        self.exception = None
+
+    def get_size(self):
+        if self.repr_cache is None:
+            return FRAME_STATE_SIZE
+        return FRAME_STATE_SIZE + self.repr_cache.size
+
+
+class FrameStates(object):
+    '''
+    The states of the frames a tracer is in.
+
+    States are keyed by the id of their frame, rather than by the frame, so
+    they don't keep the frame and its locals alive. A frame's state has to be
+    released when the frame is done, and a state whose code object doesn't
+    match the frame's is from an earlier frame that had the same id. A frame
+    of the same code that was never done, like an abandoned generator, can
+    leave its state behind too, so the tracer releases the state a frame
+    finds on its call event if the frame is new (see `Tracer.trace`).
+
+    The total size of the states is kept under `max_size` bytes by evicting
+    the states that were used least recently. A frame whose state was evicted
+    starts over with a new one, so its variables get reported as new again.
+
+    States are numbered by `serials`, which the states of a tracer's other
+    threads and tasks share, so a serial tells a frame apart in a recording.
+    '''
+    def __init__(self, max_size=DEFAULT_MAX_STATE_SIZE, state_type=FrameState,
+                 serials=None):
+        self.max_size = max_size
+        self.state_type = state_type
+        self.states = collections.OrderedDict()
+        self.serials = itertools.count(1) if serials is None else serials
+        self.size = 0
+        self.n_evicted = 0
+        self._n_reported_evictions = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, frame):
+        state = self.states.get(id(frame))
+        if state is not None and state.code is frame.f_code:
+            return state
+        return None
+
+    def get_or_add(self, frame):
+        state = self.states.get(id(frame))
+        if state is not None and state.code is frame.f_code:
+            return state
+        if state is not None:
+            self.size -= state.size
+        state = self.states[id(frame)] = self.state_type(next(self.serials),
+                                                         frame.f_code)
+        self.states.move_to_end(id(frame))
+        self.size += state.size
+        self._evict(state)
+        return state
+
+    def release(self, frame):
+        '''Forget the state of `frame`, and return it if there was one.'''
+        state = self.get(frame)
+        if state is not None:
+            del self.states[id(frame)]
+            self.size -= state.size
+        return state
+
+    def account(self, frame, state):
+        '''Update the size of `state` after it changed, and mark it as used.'''
+        size = state.get_size()
+        self.size += size - state.size
+        state.size = size
+        if self.max_size is not None:
+            self.states.move_to_end(id(frame))
+            self._evict(state)
+
+    def _evict(self, current_state):
+        if self.max_size is None:
+            return
+        while self.size > self.max_size and len(self.states) > 1:
+            key, state = next(iter(self.states.items()))
+            if state is current_state:
+                break
+            del self.states[key]
+            self.size -= state.size
+            self.n_evicted += 1
+
+    def pop_new_evictions(self):
+        '''Get how many states were evicted since this was last called.'''
+        n_new_evictions = self.n_evicted - self._n_reported_evictions
+        self._n_reported_evictions = self.n_evicted
+        return n_new_evictions
+
+
+class ThreadState(object):
+    '''
+    Everything a `Tracer` keeps about one thread: the states of its frames,
+    the frames it snoops, and what it last wrote.
+
+    Threads never share these, so tracing one thread doesn't need a lock, and
+    doesn't mix up what another thread's frames are doing.
+    '''
+    __slots__ = ('frame_states', 'target_frames', 'event_count',
+                 'is_last_skip', 'is_last_call_skip', 'is_in_expanded_status',
+                 'last_source_path', 'invocation')
+
+    def __init__(self, max_state_size=DEFAULT_MAX_STATE_SIZE, serials=None):
+        self.frame_states = FrameStates(max_state_size, serials=serials)
+        self.target_frames = set()
+        self.event_count = 0
+        self.is_last_skip = False
+        self.is_last_call_skip = False
+        self.is_in_expanded_status = False
+        self.last_source_path = None
+        # The `speculation.Invocation` whose output is being held back:
+        self.invocation = None
+
+
+class TaskState(ThreadState):
+    '''
+    Everything a `Tracer` keeps about one task of an event loop, like an
+    `asyncio.Task`, which shares its thread with the loop's other tasks: what
+    a `ThreadState` has, plus the task's depth, and the events it emitted
+    since it was last written.
+    '''
+    __slots__ = ('depth', 'events', 'n_coroutines', 'n_steps', '__weakref__')
+
+    def __init__(self, max_state_size=DEFAULT_MAX_STATE_SIZE, depth=-1,
+                 serials=None):
+        ThreadState.__init__(self, max_state_size, serials)
+        self.depth = depth
+        self.events = []
+        # The snooped coroutines that run in the task, and how many of them
+        # are in the middle of a step (nested ones are, in their caller's):
+        self.n_coroutines = 0
+        self.n_steps = 0
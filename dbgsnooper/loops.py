@@ -0,0 +1,105 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''Counting loop iterations per frame, so only the first few iterations of
+each loop are shown and the rest can run without line events.'''
+
+
+class FrameLoops(object):
+    '''
+    The loops of one frame, and how many iterations of each it ran.
+
+    Iterations are counted on the first line of each loop (see
+    `CodeInfo.get_loops`), over all the times the frame entered the loop.
+    Once a loop ran more than `max_iterations` iterations, the lines it ran
+    before aren't shown anymore, except on iteration number `shown_iteration`.
+    After that these lines are in `suppressed_lines` until the frame leaves
+    the loop, so their line events can be skipped or turned off. A line that
+    the loop runs for the first time, like a `return` or a `raise` on a late
+    iteration, is still shown.
+
+    Calls into a generator frame that resume it are counted per line the
+    same way, so a generator that yields a lot only has its first few
+    resumptions shown.
+    '''
+    __slots__ = ('loops', 'max_iterations', 'shown_iteration', 'counts',
+                 'call_counts', 'active', 'seen_lines', 'suppressed_lines',
+                 'left_suppressed_lines', 'shown')
+
+    def __init__(self, loops, max_iterations, shown_iteration=None):
+        self.loops = loops
+        self.max_iterations = max_iterations
+        self.shown_iteration = shown_iteration
+        self.counts = {}
+        self.call_counts = {}
+        # The loops the frame is in, innermost last, as `(first_line, lines)`:
+        self.active = []
+        # The lines each loop ran, by the loop's first line:
+        self.seen_lines = {}
+        self.suppressed_lines = None
+        # Whether the last line event left lines that were suppressed, so
+        # their line events are needed again:
+        self.left_suppressed_lines = False
+        self.shown = True
+
+    def _is_count_shown(self, count):
+        return count <= self.max_iterations or count == self.shown_iteration
+
+    def update(self, line_no):
+        '''Record a line event at `line_no`, and return whether to show it.'''
+        active = self.active
+        while active and line_no not in active[-1][1]:
+            active.pop()
+        lines = self.loops.get(line_no)
+        if lines is not None:
+            for index, (first_line_no, _) in enumerate(active):
+                if first_line_no == line_no:
+                    del active[index + 1:]
+                    break
+            else:
+                active.append((line_no, lines))
+            self.counts[line_no] = self.counts.get(line_no, 0) + 1
+
+        old_suppressed_lines = self.suppressed_lines
+        # The outermost loops that hide and that suppress their lines:
+        hiding_line_no = suppressing_line_no = None
+        for first_line_no, _ in active:
+            count = self.counts[first_line_no]
+            if count <= self.max_iterations:
+                continue
+            if hiding_line_no is None and count != self.shown_iteration:
+                hiding_line_no = first_line_no
+            if self.shown_iteration is None or count > self.shown_iteration:
+                suppressing_line_no = first_line_no
+                break
+        is_new_line = False
+        seen_lines = self.seen_lines
+        for first_line_no, _ in active:
+            loop_seen_lines = seen_lines.get(first_line_no)
+            if loop_seen_lines is None:
+                loop_seen_lines = seen_lines[first_line_no] = set()
+            if line_no not in loop_seen_lines:
+                loop_seen_lines.add(line_no)
+                if first_line_no == hiding_line_no:
+                    is_new_line = True
+        suppressed_lines = None if suppressing_line_no is None else \
+                                               seen_lines[suppressing_line_no]
+        self.suppressed_lines = suppressed_lines
+        self.left_suppressed_lines = \
+               old_suppressed_lines is not None and \
+               old_suppressed_lines is not suppressed_lines and \
+               not old_suppressed_lines <= (suppressed_lines or frozenset())
+        self.shown = is_new_line or hiding_line_no is None
+        return self.shown
+
+    def update_call(self, line_no):
+        '''Record a call event at `line_no`, and return whether to show it.'''
+        count = self.call_counts[line_no] = self.call_counts.get(line_no, 0) + 1
+        self.shown = self._is_count_shown(count) and \
+                                             self._is_in_shown_iterations()
+        return self.shown
+
+    def _is_in_shown_iterations(self):
+        for first_line_no, _ in self.active:
+            if not self._is_count_shown(self.counts[first_line_no]):
+                return False
+        return True
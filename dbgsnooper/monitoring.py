@@ -0,0 +1,272 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''`sys.monitoring` (PEP 669) backend for `Tracer`, Python 3.12+.
+
+`sys.settrace` makes every line of every frame in the thread pay for a Python
+level callback. This backend only turns on line events for the code objects
+that the active tracer may actually print, and feeds the events it gets into
+`Tracer.trace` with the same `(frame, event, arg)` signature that
+`sys.settrace` uses, so both backends produce the same output.
+
+Tracers with `exceptions_only` only need to hear about exceptions, so while
+only they are active, the only global event is `RAISE`, which is emitted in
+each frame that an exception gets to, and calls aren't hooked at all.
+'''
+
+import sys
+import threading
+
+from .code_info import CodeCache
+
+MONITORING_AVAILABLE = hasattr(sys, 'monitoring')
+
+if MONITORING_AVAILABLE:
+    _monitoring = sys.monitoring
+    _events = _monitoring.events
+    DISABLE = _monitoring.DISABLE
+
+    # Whether a call has to be snooped on isn't known before the code object
+    # is first called (it depends on the caller, with `depth`), so these are
+    # set for all code objects rather than with `set_local_events`:
+    GLOBAL_EVENTS = (_events.PY_START | _events.PY_RESUME |
+                     _events.PY_THROW | _events.RAISE | _events.PY_UNWIND)
+    # Enabled on every code object that has a traced frame:
+    FRAME_EVENTS = (_events.PY_RETURN | _events.PY_YIELD |
+                     _events.STOP_ITERATION)
+    # Enabled only where the active tracer may print line events:
+    LINE_EVENTS = _events.LINE | _events.JUMP
+    # All that tracers with `exceptions_only` need:
+    EXCEPTION_EVENTS = _events.RAISE
+
+
+class Monitor(object):
+    '''
+    Dispatches `sys.monitoring` events to the active `Tracer` of each thread.
+
+    There is a single instance per process (see `get_monitor`), since tool ids
+    are a process-wide resource. Like `sys.settrace`, tracers are stacked per
+    thread, and a frame that one tracer started tracing keeps reporting to
+    that tracer until it returns.
+    '''
+    def __init__(self):
+        self.tool_id = self._acquire_tool_id()
+        # All threads change the stacks, the counts and `frame_tracers`.
+        # Reentrant, since the events that it sets may call back into this:
+        self.lock = threading.RLock()
+        self.thread_stacks = {}
+        self.frame_tracers = {}
+        self.local_events = CodeCache()
+        self.line_cache = CodeCache()
+        self.active_count = 0
+        # Active tracers that aren't `exceptions_only`:
+        self.full_count = 0
+        self.disabled_locations = False
+        # Code objects with lines disabled inside a loop that a frame ran
+        # past its shown iterations:
+        self.loop_codes = set()
+        register = _monitoring.register_callback
+        register(self.tool_id, _events.PY_START, self._on_start)
+        register(self.tool_id, _events.PY_RESUME, self._on_start)
+        register(self.tool_id, _events.PY_THROW, self._on_throw)
+        register(self.tool_id, _events.PY_RETURN, self._on_return)
+        register(self.tool_id, _events.PY_YIELD, self._on_return)
+        register(self.tool_id, _events.PY_UNWIND, self._on_unwind)
+        register(self.tool_id, _events.RAISE, self._on_raise)
+        register(self.tool_id, _events.STOP_ITERATION, self._on_raise)
+        register(self.tool_id, _events.LINE, self._on_line)
+        register(self.tool_id, _events.JUMP, self._on_jump)
+
+    @staticmethod
+    def _acquire_tool_id():
+        for tool_id in (_monitoring.DEBUGGER_ID, 1, 2, 3, 4):
+            try:
+                _monitoring.use_tool_id(tool_id, 'dbgsnooper')
+            except ValueError:
+                continue
+            return tool_id
+        raise RuntimeError('No free `sys.monitoring` tool id for dbgsnooper.')
+
+    ### Session handling: #####################################################
+    #                                                                         #
+    def push(self, tracer):
+        with self.lock:
+            stack = self.thread_stacks.setdefault(threading.get_ident(), [])
+            stack.append(tracer)
+            # Locations that were uninteresting to the other tracers may
+            # matter to this one:
+            self.restart_events()
+            self.active_count += 1
+            if not tracer.exceptions_only:
+                self.full_count += 1
+            self._set_global_events()
+
+    def pop(self, tracer, calling_frame=None):
+        thread_id = threading.get_ident()
+        with self.lock:
+            stack = self.thread_stacks[thread_id]
+            stack.pop()
+            if not stack:
+                del self.thread_stacks[thread_id]
+            if self.frame_tracers.get(calling_frame) is tracer:
+                del self.frame_tracers[calling_frame]
+            if not any(tracer in stack
+                       for stack in self.thread_stacks.values()):
+                # Frames that were left without a return event, like
+                # suspended generators, mustn't be kept alive:
+                for frame in [frame for frame, frame_tracer in
+                              self.frame_tracers.items()
+                              if frame_tracer is tracer]:
+                    del self.frame_tracers[frame]
+            self.active_count -= 1
+            if not tracer.exceptions_only:
+                self.full_count -= 1
+            if self.thread_stacks:
+                # Locations that were uninteresting to this tracer may matter
+                # to the ones that are still active:
+                self.restart_events()
+            self._set_global_events()
+
+    def _set_global_events(self):
+        if self.full_count:
+            events = GLOBAL_EVENTS
+        elif self.active_count:
+            events = EXCEPTION_EVENTS
+        else:
+            events = _events.NO_EVENTS
+        if _monitoring.get_events(self.tool_id) != events:
+            _monitoring.set_events(self.tool_id, events)
+
+    def trace_frame(self, tracer, frame):
+        '''Equivalent of setting `frame.f_trace` under `sys.settrace`.'''
+        with self.lock:
+            self.frame_tracers[frame] = tracer
+            self._enable(frame.f_code, FRAME_EVENTS | LINE_EVENTS)
+    #                                                                         #
+    ### Finished session handling. ############################################
+
+    def restart_events(self):
+        '''Turn the locations that callbacks disabled back on.'''
+        with self.lock:
+            if self.disabled_locations:
+                _monitoring.restart_events()
+                self.disabled_locations = False
+                self.loop_codes.clear()
+
+    def _enable(self, code, events):
+        current = self.local_events.get(code, 0)
+        if current & events != events:
+            self.local_events[code] = current | events
+            _monitoring.set_local_events(self.tool_id, code, current | events)
+
+    def _get_line(self, code, offset):
+        try:
+            lines = self.line_cache[code]
+        except KeyError:
+            lines = self.line_cache[code] = {}
+            for start, end, line in code.co_lines():
+                for instruction_offset in range(start, end, 2):
+                    lines[instruction_offset] = line
+        return lines.get(offset)
+
+    def _disable(self):
+        # `DISABLE` turns the event off at its location for all threads, and
+        # another thread's tracer may still need it there:
+        if len(self.thread_stacks) > 1:
+            return None
+        self.disabled_locations = True
+        return DISABLE
+
+    def _line(self, frame, code, line_number):
+        tracer = self.frame_tracers.get(frame)
+        if tracer is None:
+            return
+        if not tracer.wants_line(code, line_number):
+            return self._disable()
+        self._dispatch(frame, 'line', None)
+        if tracer.is_line_suppressed(frame, line_number):
+            self.loop_codes.add(code)
+            return self._disable()
+
+    def _dispatch(self, frame, event, arg):
+        tracer = self.frame_tracers.get(frame)
+        if tracer is None:
+            return
+        if tracer.trace(frame, event, arg) is None or event == 'return':
+            with self.lock:
+                self.frame_tracers.pop(frame, None)
+
+    ### Callbacks: ############################################################
+    #                                                                         #
+    def _on_start(self, code, instruction_offset):
+        stack = self.thread_stacks.get(threading.get_ident())
+        if not stack:
+            return
+        tracer = stack[-1]
+        if tracer.exceptions_only:
+            return self._disable()
+        frame = sys._getframe(1)
+        if code in self.loop_codes:
+            # This frame may need the lines that another one disabled:
+            self.restart_events()
+        if tracer._is_internal_frame(frame) or \
+                                           not tracer.wants_call_events(code):
+            return self._disable()
+        if tracer.trace(frame, 'call', None) is None:
+            return
+        events = FRAME_EVENTS
+        if tracer.wants_line_events(frame):
+            events |= LINE_EVENTS
+        with self.lock:
+            self.frame_tracers[frame] = tracer
+            self._enable(code, events)
+
+    def _on_throw(self, code, instruction_offset, exception):
+        self._on_start(code, instruction_offset)
+
+    def _on_return(self, code, instruction_offset, retval):
+        self._dispatch(sys._getframe(1), 'return', retval)
+
+    def _on_unwind(self, code, instruction_offset, exception):
+        self._dispatch(sys._getframe(1), 'return', None)
+
+    def _on_raise(self, code, instruction_offset, exception):
+        frame = sys._getframe(1)
+        exc_info = (type(exception), exception,
+                    getattr(exception, '__traceback__', None))
+        if frame in self.frame_tracers:
+            self._dispatch(frame, 'exception', exc_info)
+            return
+        stack = self.thread_stacks.get(threading.get_ident())
+        if stack:
+            tracer = stack[-1]
+            if tracer.exceptions_only and \
+                             not tracer._is_internal_frame(frame) and \
+                             tracer.wants_line_events(frame):
+                tracer.report_exception(frame, exc_info)
+
+    def _on_line(self, code, line_number):
+        return self._line(sys._getframe(1), code, line_number)
+
+    def _on_jump(self, code, instruction_offset, destination_offset):
+        # `sys.settrace` reports a backward jump to the start of the same
+        # line as a new line event, `LINE` doesn't.
+        if destination_offset > instruction_offset:
+            return DISABLE
+        line = self._get_line(code, destination_offset)
+        if line is None or line != self._get_line(code, instruction_offset):
+            return DISABLE
+        self._line(sys._getframe(1), code, line)
+    #                                                                         #
+    ### Finished callbacks. ###################################################
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def get_monitor():
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = Monitor()
+        return _monitor
@@ -3,9 +3,11 @@
 '''Python 2/3 compatibility'''
 
 import abc
+import gc
 import os
 import inspect
 import sys
+import threading
 import datetime as datetime_module
 
 PY3 = (sys.version_info[0] == 3)
@@ -43,6 +45,12 @@ else:
             )
 
 
+try:
+    get_thread_trace = threading.gettrace
+except AttributeError: # Python < 3.10
+    def get_thread_trace():
+        return threading._trace_hook
+
 try:
     iscoroutinefunction = inspect.iscoroutinefunction
 except AttributeError:
@@ -54,6 +62,18 @@ except AttributeError:
     isasyncgenfunction = lambda whatever: False # Lolz
 
 
+def unwrap_async_generator_value(value):
+    '''
+    Get the value that an asynchronous generator yielded, from the one its
+    frame returns with, which CPython wraps to tell it from what the
+    generator awaits. Other values are returned as they are.
+    '''
+    if type(value).__name__ != 'async_generator_wrapped_value':
+        return value
+    referents = gc.get_referents(value)
+    return referents[0] if len(referents) == 1 else value
+
+
 if PY3:
     string_types = (str,)
     text_type = str
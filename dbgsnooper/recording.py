@@ -0,0 +1,550 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+The binary recording format of `Tracer(format='binary')`, and reading it.
+
+A recording is a sequence of segments. Each segment starts with a header,
+followed by fixed-width records (see `RECORD`), one for each event of
+`dbgsnooper.events` plus one for each pair of a variables event. Strings,
+code objects and threads are interned: the first time one is used, a record
+that defines it comes first (a string's record is followed by its UTF-8
+bytes), and events refer to it by number from then on. Tables are only valid
+within their segment, so a recording can be appended to by a new recorder,
+and a recorder starts a new segment when its tables get too big.
+
+Recordings written to a path get a sidecar index next to them (see
+`Indexer`), which `dbgsnooper.trace_reader` uses to find the events of a call
+or of a time window without reading the whole recording.
+'''
+
+import collections
+import datetime as datetime_module
+import itertools
+import os
+import struct
+import threading
+import weakref
+
+from . import utils, pycompat
+from . import events
+from .code_info import get_code_info
+from .events import Event
+from .writers import (_SharedFile, DEFAULT_BUFFER_SIZE,
+                      DEFAULT_FLUSH_INTERVAL)
+
+MAGIC = b'DBGSNOOP'
+VERSION = 2
+# Magic, version, and the random id of the recorder that wrote the segment:
+HEADER = struct.Struct('<8sHxxI')
+# Kind, flags, depth, thread, code, frame, two fields `a` and `b` whose
+# meaning depends on the kind, and the monotonic timestamp in nanoseconds.
+# Frame events have their source line in `a` and line number in `b`. `frame`
+# numbers the frames of a recorder, 0 is for events that aren't about one:
+RECORD = struct.Struct('<BBhHHIIIq')
+
+# Record kinds that define an entry of a table rather than an event:
+STRING = 0
+CODE = 1
+THREAD = 2
+
+EVENT_KINDS = (
+    'call', 'line', 'return', 'exception', events.SOURCE_PATH,
+    events.STARTING_VARS, events.NEW_VARS, events.MODIFIED_VARS,
+    events.CALL_ENDED_BY_EXCEPTION, events.BODY_OMITTED, events.RETURN_VALUE,
+    events.EXCEPTION_VALUE, events.ELAPSED_TIME, events.SKIPPED,
+    events.STATES_DROPPED, events.REPR_SUPPRESSED, events.TEXT, events.LOCALS,
+    events.VALUES,
+)
+FIRST_EVENT_KIND = 16
+EVENT_KIND_NUMBERS = dict(
+    (kind, FIRST_EVENT_KIND + index) for index, kind in enumerate(EVENT_KINDS)
+)
+VAR_KINDS = frozenset((events.STARTING_VARS, events.NEW_VARS,
+                       events.MODIFIED_VARS, events.LOCALS, events.VALUES))
+
+# Flag of the records of a variables event after its first pair:
+CONTINUED = 1
+
+# Past this many strings, a recorder starts a new segment:
+MAX_TABLE_SIZE = 1 << 16
+# Codes and threads are numbered with 16 bits:
+MAX_ID = 0xffff
+# Past this many frames, a recorder forgets which frames it numbered, and
+# numbers them again from 1:
+MAX_FRAMES = 1 << 20
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'DBGSNIDX'
+INDEX_VERSION = 1
+# Magic, version, and the width of the time buckets in nanoseconds:
+INDEX_HEADER = struct.Struct('<8sH6xq')
+# Kind, frame, recorder id, and two offsets or numbers that depend on the
+# kind:
+INDEX_ENTRY = struct.Struct('<B3xIIQQ')
+
+# Index entry kinds:
+SEGMENT_ENTRY = 0 # A segment starts at `x`, written by recorder `recorder`.
+DEFINITION_ENTRY = 1 # A table definition record is at `x`.
+FRAME_ENTRY = 2 # A frame's first event is at `x`, its code defined at `y`.
+FRAME_END_ENTRY = 3 # A frame's events so far end at `x`.
+RUN_ENTRY = 4 # A run starts at `y`, with events from time bucket `x`.
+TIME_ENTRY = 5 # The events of the run from time bucket `x` on start at `y`.
+COVERED_ENTRY = 6 # The index covers the recording up to `x`.
+
+TIME_BUCKET_NS = 10000000
+
+RecordedCode = collections.namedtuple('RecordedCode',
+                                      ('path', 'name', 'first_line_no'))
+
+
+class RecordingError(Exception):
+    pass
+
+
+class Indexer(object):
+    '''
+    Builds the entries of the index of a recording, as it's written.
+
+    The index is a sequence of `INDEX_ENTRY`s after an `INDEX_HEADER`, see the
+    entry kinds. A frame is known by its recorder's id and its number, and has
+    a `FRAME_ENTRY` for its first event, and a `FRAME_END_ENTRY` for the end
+    of its last event in each batch that has its events; the events of the
+    frame and of the calls it made are between these two offsets.
+
+    The events of a recording are split into runs, each of events of one
+    thread in the order they happened. (Threads flush their events whenever
+    they get to it, so the recording as a whole isn't in order.) Each run has
+    a `RUN_ENTRY`, and a `TIME_ENTRY` for each time bucket its timestamps
+    reach after the first. A `COVERED_ENTRY` ends each batch, so a reader
+    can tell whether the index is up to date with the recording.
+    '''
+    def __init__(self, bucket_ns=TIME_BUCKET_NS):
+        self.bucket_ns = bucket_ns
+        self.output = bytearray()
+        self.frame_ends = {}
+        self.reset()
+
+    def reset(self):
+        del self.output[:]
+        self.frame_ends.clear()
+        self.last_thread = self.last_bucket = None
+        self.last_timestamp = 0
+
+    def get_header(self):
+        return INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.bucket_ns)
+
+    def add_segment(self, offset, recorder_id):
+        self.output += INDEX_ENTRY.pack(SEGMENT_ENTRY, 0, recorder_id, offset, 0)
+
+    def add_definition(self, offset):
+        self.output += INDEX_ENTRY.pack(DEFINITION_ENTRY, 0, 0, offset, 0)
+
+    def add_frame(self, recorder_id, frame_id, offset, code_offset):
+        self.output += INDEX_ENTRY.pack(FRAME_ENTRY, frame_id, recorder_id,
+                                        offset, code_offset)
+
+    def add_event(self, recorder_id, frame_id, offset, end, timestamp, thread):
+        '''Add the event at `offset`, whose records end at `end`.'''
+        if frame_id:
+            self.frame_ends[(recorder_id, frame_id)] = end
+        bucket = timestamp - timestamp % self.bucket_ns
+        if thread != self.last_thread or timestamp < self.last_timestamp:
+            self.last_thread = thread
+            self.output += INDEX_ENTRY.pack(RUN_ENTRY, 0, 0, bucket, offset)
+        elif bucket > self.last_bucket:
+            self.output += INDEX_ENTRY.pack(TIME_ENTRY, 0, 0, bucket, offset)
+        self.last_bucket = bucket
+        self.last_timestamp = timestamp
+
+    def finish(self, covered):
+        '''Take the entries of the batch that ends at offset `covered`.'''
+        output = self.output
+        for (recorder_id, frame_id), end in self.frame_ends.items():
+            output += INDEX_ENTRY.pack(FRAME_END_ENTRY, frame_id, recorder_id,
+                                       end, 0)
+        self.frame_ends.clear()
+        output += INDEX_ENTRY.pack(COVERED_ENTRY, 0, 0, covered, 0)
+        self.output = bytearray()
+        return bytes(output)
+
+
+class Recorder(object):
+    '''
+    Encodes events as records, and passes them to `write` as bytes.
+
+    Recorders of a file are shared by all tracers that write to it (see
+    `get_recording_writer`), since they have to share their tables. They
+    also write the file's index to `index_file`, with offsets that assume no
+    other process writes to the file at the same time.
+    '''
+    _instances = weakref.WeakValueDictionary()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, write, shared_file=None, index_file=None):
+        self._write = write
+        self.shared_file = shared_file
+        self.index_file = index_file
+        self.indexer = None if index_file is None else Indexer()
+        self.recorder_id = struct.unpack('<I', os.urandom(4))[0]
+        self.lock = threading.RLock()
+        # Frame numbers by `(writer_id, serial)`:
+        self.frames = {}
+        self.frame_ids = itertools.count(1)
+        self.writer_ids = itertools.count(1)
+        # Where the batch being encoded starts in the file:
+        self._base = 0
+        self._start_segment()
+
+    @classmethod
+    def get(cls, path, buffer_size, flush_interval, fsync):
+        shared_file = _SharedFile.get(path, buffer_size, flush_interval,
+                                      fsync, binary=True)
+        key = os.path.realpath(path)
+        with cls._instances_lock:
+            recorder = cls._instances.get(key)
+            if recorder is None:
+                index_file = _SharedFile.get(path + INDEX_SUFFIX, buffer_size,
+                                             flush_interval, fsync,
+                                             binary=True)
+                recorder = cls._instances[key] = cls(shared_file.write,
+                                                     shared_file, index_file)
+            return recorder
+
+    def _start_segment(self):
+        self.strings = {}
+        # Code numbers, and the offsets of the records that define them:
+        self.codes = {}
+        self.code_offsets = {}
+        self.threads = {}
+        self.in_segment = False
+
+    def truncate(self):
+        with self.lock:
+            self.shared_file.truncate()
+            if self.index_file is not None:
+                self.index_file.truncate()
+                self.indexer.reset()
+            self.frames.clear()
+            self._start_segment()
+
+    def flush(self):
+        if self.shared_file is not None:
+            self.shared_file.flush()
+            if self.index_file is not None:
+                self.index_file.flush()
+
+    def _intern(self, output, string):
+        string_id = self.strings.get(string)
+        if string_id is None:
+            string_id = self.strings[string] = len(self.strings) + 1
+            encoded = string.encode('utf-8', 'replace')
+            if self.indexer is not None:
+                self.indexer.add_definition(self._base + len(output))
+            output += RECORD.pack(STRING, 0, 0, 0, 0, 0, string_id,
+                                  len(encoded), 0)
+            output += encoded
+        return string_id
+
+    def _get_code_id(self, output, code):
+        code_id = self.codes.get(code)
+        if code_id is None:
+            code_id = self.codes[code] = len(self.codes) + 1
+            name = getattr(code, 'co_qualname', code.co_name)
+            path_id = self._intern(output, code.co_filename)
+            name_id = self._intern(output, name)
+            offset = self.code_offsets[code_id] = self._base + len(output)
+            if self.indexer is not None:
+                self.indexer.add_definition(offset)
+            # The first line number goes where the timestamp would:
+            output += RECORD.pack(CODE, 0, 0, 0, code_id, 0, path_id, name_id,
+                                  code.co_firstlineno)
+        return code_id
+
+    def _get_thread_id(self, output, event):
+        key = (event.thread, event.thread_info)
+        thread_id = self.threads.get(key)
+        if thread_id is None:
+            thread_id = self.threads[key] = len(self.threads) + 1
+            thread_info_id = self._intern(output, event.thread_info)
+            if self.indexer is not None:
+                self.indexer.add_definition(self._base + len(output))
+            # The thread's ident goes where the timestamp would:
+            output += RECORD.pack(THREAD, 0, 0, thread_id, 0, 0,
+                                  thread_info_id, 0, key[0])
+        return thread_id
+
+    def get_writer_id(self):
+        return next(self.writer_ids)
+
+    def _get_frame_id(self, writer_id, serial):
+        key = (writer_id, serial)
+        frame_id = self.frames.get(key)
+        if frame_id is None:
+            if len(self.frames) >= MAX_FRAMES:
+                self.frames.clear()
+            frame_id = self.frames[key] = next(self.frame_ids)
+        return frame_id
+
+    def write_events(self, events_, writer_id=0):
+        with self.lock:
+            output = bytearray()
+            indexer = self.indexer
+            if indexer is not None:
+                self._base = self.shared_file.get_position()
+                if self._base == 0:
+                    # Whatever index is there is of another recording:
+                    self.index_file.truncate()
+                    indexer.reset()
+            for event in events_:
+                if not self.in_segment:
+                    if indexer is not None:
+                        indexer.add_segment(self._base + len(output),
+                                            self.recorder_id)
+                    output += HEADER.pack(MAGIC, VERSION, self.recorder_id)
+                    self.in_segment = True
+                self._encode(output, event, writer_id)
+                if len(self.strings) > MAX_TABLE_SIZE or \
+                   len(self.codes) >= MAX_ID or len(self.threads) >= MAX_ID:
+                    self._start_segment()
+            self._write(bytes(output))
+            if indexer is not None:
+                index_file = self.index_file
+                if index_file.get_position() == 0:
+                    index_file.write(indexer.get_header())
+                index_file.write(indexer.finish(self._base + len(output)))
+
+    def _encode(self, output, event, writer_id):
+        kind = event.kind
+        intern = self._intern
+        thread_id = self._get_thread_id(output, event)
+        code_id = 0 if event.code is None else \
+                                        self._get_code_id(output, event.code)
+        frame_id = 0
+        if event.serial:
+            frame_id = self.frames.get((writer_id, event.serial))
+            is_new_frame = frame_id is None
+            if is_new_frame:
+                frame_id = self._get_frame_id(writer_id, event.serial)
+        data = event.data
+        a = b = 0
+        if kind in VAR_KINDS:
+            flags = 0
+            for name, value_repr in data:
+                a = intern(output, name)
+                b = intern(output, value_repr)
+                if not flags:
+                    offset = self._base + len(output)
+                output += RECORD.pack(EVENT_KIND_NUMBERS[kind], flags,
+                                      event.depth, thread_id, code_id,
+                                      frame_id, a, b, event.timestamp)
+                flags = CONTINUED
+        else:
+            if kind in events.FRAME_EVENTS:
+                source = get_code_info(event.code).path_and_source[1]
+                a = intern(output, source[event.line_no - 1])
+                b = event.line_no
+            elif kind == events.ELAPSED_TIME:
+                microseconds = (data.days * 86400 + data.seconds) * 1000000 + \
+                                                             data.microseconds
+                a, b = microseconds & 0xffffffff, microseconds >> 32
+            elif kind == events.STATES_DROPPED:
+                a = data[0]
+                b = intern(output, pycompat.text_type(data[1]))
+            elif kind == events.REPR_SUPPRESSED:
+                a, b = intern(output, data[0]), intern(output, data[1])
+            elif data is not None:
+                a = intern(output, data)
+            offset = self._base + len(output)
+            output += RECORD.pack(EVENT_KIND_NUMBERS[kind], 0, event.depth,
+                                  thread_id, code_id, frame_id, a, b,
+                                  event.timestamp)
+        indexer = self.indexer
+        if indexer is not None:
+            if frame_id and is_new_frame:
+                indexer.add_frame(self.recorder_id, frame_id, offset,
+                                  self.code_offsets.get(code_id, 0))
+            indexer.add_event(self.recorder_id, frame_id, offset,
+                              self._base + len(output), event.timestamp,
+                              event.thread)
+
+
+class RecordingWriter(object):
+    '''What a `Tracer` with `format='binary'` writes its events to.'''
+    def __init__(self, recorder, overwrite):
+        self.recorder = recorder
+        self.overwrite = overwrite
+        # Frame serials are only unique within a tracer:
+        self.writer_id = recorder.get_writer_id()
+
+    def write_events(self, events_):
+        if self.overwrite:
+            self.recorder.truncate()
+            self.overwrite = False
+        self.recorder.write_events(events_, self.writer_id)
+
+    def flush(self):
+        self.recorder.flush()
+
+
+def get_recording_writer(output, overwrite, buffer_size=DEFAULT_BUFFER_SIZE,
+                         flush_interval=DEFAULT_FLUSH_INTERVAL, fsync=False):
+    is_path = isinstance(output, (pycompat.PathLike, str))
+    if overwrite and not is_path:
+        raise Exception('`overwrite=True` can only be used when writing '
+                        'content to file.')
+    if is_path:
+        recorder = Recorder.get(pycompat.text_type(output), buffer_size,
+                                flush_interval, fsync)
+    elif callable(output):
+        recorder = Recorder(output)
+    elif isinstance(output, utils.WritableStream):
+        recorder = Recorder(output.write)
+    else:
+        raise TypeError('`format=\'binary\'` needs a path or a binary '
+                        'stream to write to.')
+    return RecordingWriter(recorder, overwrite)
+
+
+def read_events(data, normalize=False):
+    '''
+    Yield the events recorded in `data`, which is the content of a recording
+    (`bytes`, or anything else that supports the buffer protocol).
+
+    The events have a `RecordedCode` as their `code`, and the source line of
+    frame events as their `data`. With `normalize`, source paths and reprs
+    are normalized like `Tracer(normalize=True)` does, except that reprs that
+    were cut short are normalized after the cut rather than before.
+    '''
+    for _, event in iter_records(data, normalize):
+        yield event
+
+
+class Tables(object):
+    '''The strings, codes and threads defined so far in a segment.'''
+    def __init__(self, recorder_id=0):
+        self.recorder_id = recorder_id
+        self.strings = {0: None}
+        self.codes = {0: None}
+        # `(thread_info, ident)` by thread number:
+        self.threads = {}
+
+    def define(self, view, offset):
+        '''
+        Read the definition record at `offset` into the tables, and return
+        the offset after it.
+        '''
+        (kind_number, _, _, thread_id, code_id, _, a, b,
+                                     timestamp) = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        strings = self.strings
+        if kind_number == STRING:
+            strings[a] = pycompat.text_type(bytes(view[offset:offset + b]),
+                                            'utf-8', 'replace')
+            offset += b
+        elif kind_number == CODE:
+            self.codes[code_id] = RecordedCode(strings[a], strings[b],
+                                               timestamp)
+        elif kind_number == THREAD:
+            self.threads[thread_id] = (strings[a], timestamp)
+        else:
+            raise RecordingError('No definition at offset {}.'.format(offset))
+        return offset
+
+
+def read_header(view, offset):
+    '''Read the segment header at `offset`, and return its recorder's id.'''
+    magic, version, recorder_id = HEADER.unpack_from(view, offset)
+    if magic != MAGIC:
+        raise RecordingError('Not a dbgsnooper recording.')
+    if version != VERSION:
+        raise RecordingError('Recording version {} is not supported by this '
+                             'version of dbgsnooper.'.format(version))
+    return recorder_id
+
+
+def iter_records(data, normalize=False, offset=0, end=None, tables=None):
+    '''
+    Yield `(offset, event)` for the events in `data[offset:end]`, see
+    `read_events`. `offset` has to be where a segment starts, unless
+    `tables` has the definitions of the segment up to `offset`. The events
+    have their frame's number within the segment's recorder as `serial`.
+    '''
+    view = memoryview(data)
+    end = len(view) if end is None else end
+    magic_size = len(MAGIC)
+    record_size = RECORD.size
+    unpack_record = RECORD.unpack_from
+    pending = pending_offset = None
+    while offset < end:
+        if view[offset:offset + magic_size] == MAGIC:
+            tables = Tables(read_header(view, offset))
+            offset += HEADER.size
+            continue
+        if tables is None:
+            raise RecordingError('Not a dbgsnooper recording.')
+        kind_number, flags = view[offset], view[offset + 1]
+        if kind_number < FIRST_EVENT_KIND:
+            offset = tables.define(view, offset)
+            continue
+        (_, _, depth, thread_id, code_id, frame_id, a, b,
+                                    timestamp) = unpack_record(view, offset)
+        try:
+            kind = EVENT_KINDS[kind_number - FIRST_EVENT_KIND]
+        except IndexError:
+            raise RecordingError('Unknown record kind {} at offset {}.'.format(
+                kind_number, offset
+            ))
+        strings = tables.strings
+        if flags & CONTINUED:
+            pending.data.append(_get_var_repr(strings, a, b, normalize))
+            offset += record_size
+            continue
+        if pending is not None:
+            yield pending_offset, pending
+        pending_offset = offset
+        offset += record_size
+        thread_info, ident = tables.threads[thread_id]
+        pending = _decode(kind, strings, thread_info, tables.codes[code_id],
+                          depth, timestamp, a, b, normalize)
+        pending.thread = ident
+        pending.serial = frame_id
+    if pending is not None:
+        yield pending_offset, pending
+
+
+def _get_var_repr(strings, a, b, normalize):
+    value_repr = strings[b]
+    if normalize:
+        value_repr = utils.normalize_repr(value_repr)
+    return (strings[a], value_repr)
+
+
+def _decode(kind, strings, thread_info, code, depth, timestamp, a, b,
+            normalize):
+    line_no = None
+    if kind in events.FRAME_EVENTS:
+        data, line_no = strings[a], b
+    elif kind in VAR_KINDS:
+        data = [_get_var_repr(strings, a, b, normalize)]
+    elif kind == events.ELAPSED_TIME:
+        data = datetime_module.timedelta(microseconds=a | (b << 32))
+    elif kind == events.STATES_DROPPED:
+        data = (a, strings[b])
+    elif kind == events.REPR_SUPPRESSED:
+        data = (strings[a], strings[b])
+    else:
+        data = strings[a]
+        if normalize and kind == events.SOURCE_PATH:
+            data = os.path.basename(data)
+        elif normalize and kind == events.RETURN_VALUE:
+            data = utils.normalize_repr(data)
+    event = Event(kind, depth, line_no, code, thread_info, data)
+    event.timestamp = timestamp
+    return event
+
+
+def render(data, write, prefix='', color=False, normalize=False):
+    '''Render the recording in `data` as text, passing each line to `write`.'''
+    renderer = events.TextRenderer(prefix, color)
+    for event in read_events(data, normalize):
+        write(u'{}{}\n'.format(prefix, renderer.render(event)))
@@ -3,7 +3,10 @@ import json
 def render_call_tree(call_data_path):
     with open(call_data_path, 'r') as f:
         entries = json.load(f)
+    return format_call_tree(entries)
 
+
+def format_call_tree(entries):
     lines = []
     
     for i, entry in enumerate(entries):
@@ -0,0 +1,941 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Running a test once, and answering `trace_method`, `call_graph` and
+`trace_var` queries about it afterwards without running it again.
+
+`record` runs a test file under a `ReplayRecorder`, which writes a binary
+recording (see `dbgsnooper.recording`) of what the code of the observed files
+does. `Replay` reads the parts of the recording that a query is about through
+its index (see `dbgsnooper.trace_reader`), and goes over them the way
+`Tracer` and `VarTracer` would have gone over the live run: which frames are
+in the observed lines, which of their calls are shown, and which loop
+iterations are skipped.
+'''
+
+import collections
+import dis
+import inspect
+import os
+import runpy
+import sys
+import traceback
+import types
+
+from . import events, pycompat, recording, utils
+from .code_info import get_code_info
+from .events import Event, TextRenderer, format_var_reprs
+from .fingerprints import ReprCache
+from .frame_states import FrameState, FrameStates
+from .loops import FrameLoops
+from .render_call_tree import format_call_tree
+from .scope_index import ScopeIndex, IN_SCOPE, OUT_OF_SCOPE
+from .trace_reader import TraceReader
+from .trace_var import (get_history_item, construct_history_str,
+                        resolve_variable)
+from .tracer import (get_local_reprs, update_local_reprs,
+                     get_path_and_source_from_frame)
+from .variables import CommonVariable
+
+# Calls this many levels below a frame of an observed file get recorded:
+DEFAULT_CALLEE_DEPTH = 2
+# What the `trace_method`, `call_graph` and `trace_var` commands use:
+MAX_VARIABLE_LENGTH = 100
+METHOD_LOOP = 3
+CALL_GRAPH_DEPTH = 3
+VAR_LOOP = 4
+
+TEST_FILE_PREFIX = u'Test file:...... '
+OBSERVED_FILE_PREFIX = u'Observed file:.. '
+
+
+def get_global_names(code):
+    '''
+    Get the names of the globals that `code` assigns to, which are recorded
+    with its variables. A module's globals are its variables already.
+    '''
+    if code.co_name == '<module>':
+        return frozenset()
+    return frozenset(
+        instruction.argval for instruction in dis.get_instructions(code)
+        if instruction.opname in ('STORE_GLOBAL', 'DELETE_GLOBAL')
+    )
+
+
+class ReplayFrameState(FrameState):
+    __slots__ = ('global_watch', 'values')
+
+    def __init__(self, serial, code):
+        FrameState.__init__(self, serial, code)
+        self.global_watch = ()
+        self.values = None
+
+    def forget_locals(self):
+        FrameState.forget_locals(self)
+        self.values = None
+
+
+class ReplayRecorder(object):
+    '''
+    A trace function that records what the code of `observed_files` does, to
+    the recording at `output`.
+
+    Frames of the observed files get all their events recorded, with their
+    variables like `Tracer` reports them, and the globals they assign to.
+    Their variables also get recorded the way `VarTracer` compares them, with
+    `resolve_variable`, whole.
+    Frames that they call, down to `depth` levels, only get their calls,
+    returns and exceptions recorded, with their arguments and return values.
+    Event depths count the recorded frames that are running.
+    '''
+    def __init__(self, output, test_path, observed_files,
+                 depth=DEFAULT_CALLEE_DEPTH,
+                 max_variable_length=MAX_VARIABLE_LENGTH):
+        self.observed_files = frozenset(os.path.abspath(path)
+                                        for path in observed_files)
+        self.depth = depth
+        self.max_variable_length = max_variable_length
+        self.custom_repr = utils.ReprResolver()
+        self._writer = recording.get_recording_writer(output, overwrite=True)
+        self.frame_states = FrameStates(state_type=ReplayFrameState)
+        self.events = []
+        self.event_count = 0
+        self.call_depth = 0
+        self._is_observed = {}
+        self._global_watches = {}
+        self.emit(Event(events.TEXT, 0,
+                        data=TEST_FILE_PREFIX + os.path.abspath(test_path)))
+        for path in sorted(self.observed_files):
+            self.emit(Event(events.TEXT, 0, data=OBSERVED_FILE_PREFIX + path))
+
+    def emit(self, event):
+        self.events.append(event)
+        if len(self.events) >= events.MAX_BUFFERED_EVENTS:
+            self._writer.write_events(self.events)
+            self.events = []
+
+    def flush(self):
+        if self.events:
+            self._writer.write_events(self.events)
+            self.events = []
+        self._writer.flush()
+
+    def is_observed(self, code):
+        file_name = code.co_filename
+        try:
+            return self._is_observed[file_name]
+        except KeyError:
+            result = self._is_observed[file_name] = \
+                               os.path.abspath(file_name) in self.observed_files
+            return result
+
+    def get_global_watch(self, code):
+        '''Get variables for the globals that `code` assigns to.'''
+        try:
+            return self._global_watches[code]
+        except KeyError:
+            watch = self._global_watches[code] = tuple(
+                CommonVariable(name) for name in sorted(get_global_names(code))
+            )
+            return watch
+
+    def __call__(self, frame, event, arg):
+        if event != 'call':
+            return None
+        if self.is_observed(frame.f_code):
+            return self.trace_observed(frame, event, arg)
+        candidate = frame
+        for _ in range(self.depth):
+            candidate = candidate.f_back
+            if candidate is None:
+                return None
+            if self.is_observed(candidate.f_code):
+                break
+        else:
+            return None
+        frame.f_trace_lines = False
+        return self.trace_callee(frame, event, arg)
+
+    def _get_code_info(self, frame):
+        code_info = get_code_info(frame.f_code)
+        if code_info.path_and_source is None:
+            code_info.path_and_source = get_path_and_source_from_frame(frame)
+        return code_info
+
+    def _emit_var_reprs(self, frame, event, frame_state):
+        '''Record the variables of `frame` that changed, like `Tracer`.'''
+        code = frame.f_code
+        repr_cache = frame_state.repr_cache
+        if repr_cache is None:
+            repr_cache = frame_state.repr_cache = ReprCache(
+                self.custom_repr, self.max_variable_length
+            )
+            frame_state.global_watch = self.get_global_watch(code)
+        dirty_names = None
+        if event == 'line' and not frame_state.global_watch and \
+                          repr_cache.event_index == self.event_count - 1 and \
+                          frame_state.local_reprs is not None:
+            dirty_names = get_code_info(code).get_line_stores().get(
+                repr_cache.line_no
+            )
+        if dirty_names is not None:
+            old_local_reprs, local_reprs = update_local_reprs(
+                frame, dirty_names, frame_state.local_reprs, repr_cache
+            )
+        else:
+            old_local_reprs = frame_state.local_reprs or {}
+            frame_state.local_reprs = local_reprs = get_local_reprs(
+                frame, watch=frame_state.global_watch,
+                max_length=self.max_variable_length, repr_cache=repr_cache
+            )
+        repr_cache.line_no = frame.f_lineno
+        repr_cache.event_index = self.event_count
+        self.frame_states.account(frame, frame_state)
+        new_var_reprs = []
+        modified_var_reprs = []
+        for name, value_repr in local_reprs.items():
+            if name not in old_local_reprs:
+                new_var_reprs.append((name, value_repr))
+            elif old_local_reprs[name] != value_repr:
+                modified_var_reprs.append((name, value_repr))
+        if new_var_reprs:
+            self.emit(Event(events.STARTING_VARS if event == 'call' else
+                            events.NEW_VARS, self.call_depth, code=code,
+                            data=new_var_reprs, serial=frame_state.serial))
+        if modified_var_reprs:
+            self.emit(Event(events.MODIFIED_VARS, self.call_depth, code=code,
+                            data=modified_var_reprs,
+                            serial=frame_state.serial))
+        self._emit_values(frame, local_reprs, frame_state)
+
+    def _emit_values(self, frame, names, frame_state):
+        '''
+        Record the values of the variables in `names` that changed, like
+        `VarTracer` sees them. These are resolved on every event, since
+        mutating an object changes them without assigning to any variable.
+        '''
+        old_values = frame_state.values or {}
+        frame_state.values = values = {}
+        f_locals = frame.f_locals
+        f_globals = frame.f_globals
+        changed_values = []
+        for name in names:
+            if name in f_locals:
+                value = f_locals[name]
+            elif name in f_globals:
+                value = f_globals[name]
+            else:
+                continue
+            try:
+                value = resolve_variable(value)
+            except Exception:
+                value = utils.get_shortish_repr(value, self.custom_repr)
+            values[name] = value
+            if old_values.get(name) != value:
+                changed_values.append((name, value))
+        if changed_values:
+            self.emit(Event(events.VALUES, self.call_depth, code=frame.f_code,
+                            data=changed_values, serial=frame_state.serial))
+
+    def _emit_frame_event(self, frame, event, arg, frame_state, code_info):
+        code = frame.f_code
+        depth = self.call_depth
+        serial = frame_state.serial
+        line_no = frame.f_lineno
+        if event == 'call':
+            line_no = code_info.get_call_line(code_info.path_and_source[1],
+                                              line_no)
+        if event == 'return' and arg is None and \
+                                         code_info.is_ended_by_exception(frame):
+            self.emit(Event(events.CALL_ENDED_BY_EXCEPTION, depth, code=code,
+                            serial=serial))
+        else:
+            self.emit(Event(event, depth, line_no, code, serial=serial))
+            if event == 'return':
+                if code.co_flags & inspect.CO_ASYNC_GENERATOR:
+                    arg = pycompat.unwrap_async_generator_value(arg)
+                self.emit(Event(events.RETURN_VALUE, depth, code=code,
+                                data=utils.get_shortish_repr(
+                                    arg, self.custom_repr,
+                                    self.max_variable_length
+                                ), serial=serial))
+        if event == 'exception':
+            exception = '\n'.join(
+                traceback.format_exception_only(*arg[:2])
+            ).strip()
+            if self.max_variable_length:
+                exception = utils.truncate(exception, self.max_variable_length)
+            self.emit(Event(events.EXCEPTION_VALUE, depth, code=code,
+                            data=exception, serial=serial))
+        elif event == 'return':
+            self.call_depth -= 1
+            if code_info.is_yielding(frame):
+                frame_state.forget_locals()
+                self.frame_states.account(frame, frame_state)
+            else:
+                self.frame_states.release(frame)
+
+    def trace_observed(self, frame, event, arg):
+        self.event_count += 1
+        if event == 'call':
+            self.call_depth += 1
+        frame_state = self.frame_states.get_or_add(frame)
+        code_info = self._get_code_info(frame)
+        self._emit_var_reprs(frame, event, frame_state)
+        self._emit_frame_event(frame, event, arg, frame_state, code_info)
+        return self.trace_observed
+
+    def trace_callee(self, frame, event, arg):
+        self.event_count += 1
+        frame_state = self.frame_states.get_or_add(frame)
+        code_info = self._get_code_info(frame)
+        if event == 'call':
+            self.call_depth += 1
+            local_reprs = get_local_reprs(frame, custom_repr=self.custom_repr,
+                                          max_length=self.max_variable_length)
+            if local_reprs:
+                self.emit(Event(events.STARTING_VARS, self.call_depth,
+                                code=frame.f_code,
+                                data=list(local_reprs.items()),
+                                serial=frame_state.serial))
+        self._emit_frame_event(frame, event, arg, frame_state, code_info)
+        return self.trace_callee
+
+
+def record(test_path, observed_files, recording_path,
+           depth=DEFAULT_CALLEE_DEPTH):
+    '''
+    Run the test file at `test_path`, recording what the code of
+    `observed_files` does to `recording_path`.
+    '''
+    test_path = os.path.abspath(test_path)
+    observed_files = [os.path.abspath(path) for path in observed_files]
+    recording_path = os.path.abspath(recording_path)
+    dir_path = os.path.dirname(test_path)
+    os.chdir(dir_path)
+    if dir_path not in sys.path:
+        sys.path.insert(0, dir_path)
+
+    recorder = ReplayRecorder(recording_path, test_path, observed_files,
+                              depth)
+    original_trace = sys.gettrace()
+    sys.settrace(recorder)
+    try:
+        runpy.run_path(test_path, run_name='__main__')
+    except SystemExit:
+        pass
+    except Exception as e:
+        print('Error occurred during script execution:{}'.format(e))
+        traceback.print_exc()
+    finally:
+        sys.settrace(original_trace)
+        recorder.flush()
+
+
+def ensure_recording(recording_path, test_path, observed_files):
+    '''
+    Record the test at `test_path` to `recording_path`, unless there's a
+    recording of it there already that observed all of `observed_files`.
+    '''
+    test_path = os.path.abspath(test_path)
+    observed_files = set(os.path.abspath(path) for path in observed_files)
+    if os.path.exists(recording_path):
+        with Replay(recording_path) as replay:
+            if replay.test_path == test_path:
+                if observed_files <= replay.observed_files:
+                    return
+                observed_files |= replay.observed_files
+    record(test_path, observed_files, recording_path)
+
+
+class ReplayedFrame(object):
+    '''What a query knows about a recorded frame, as it goes over it.'''
+    __slots__ = ('serial', 'code', 'parent', 'line_no', 'reprs', 'values',
+                 'shown_reprs', 'loops', 'is_target', 'is_hidden', 'depth',
+                 'call_info', 'location', 'line_counts')
+
+    def __init__(self, serial, code, parent):
+        self.serial = serial
+        self.code = code
+        self.parent = parent
+        self.line_no = None
+        # The reprs of its variables as of its last event, and as of its last
+        # event that was shown:
+        self.reprs = collections.OrderedDict()
+        self.shown_reprs = None
+        # The values of its variables for `trace_var`, as of its last event:
+        self.values = {}
+        self.loops = None
+        self.is_target = False
+        self.is_hidden = False
+        self.depth = 0
+        self.call_info = None
+        self.location = None
+        self.line_counts = {}
+
+
+class Step(object):
+    '''A frame event, with the return value or exception that came with it.'''
+    __slots__ = ('frame', 'event', 'line_no', 'source_line',
+                 'ended_by_exception', 'value')
+
+    def __init__(self, frame, event, line_no, source_line,
+                 ended_by_exception=False):
+        self.frame = frame
+        self.event = event
+        self.line_no = line_no
+        self.source_line = source_line
+        self.ended_by_exception = ended_by_exception
+        self.value = None
+
+
+def iter_steps(events_):
+    '''
+    Group recorded events into `Step`s, keeping track of the frames they're
+    in. The `reprs` and `values` of a step's frame are the ones it had at
+    that step.
+    '''
+    frames = {}
+    stack = []
+    step = None
+    for event in events_:
+        kind = event.kind
+        if kind == events.RETURN_VALUE or kind == events.EXCEPTION_VALUE:
+            if step is not None:
+                step.value = event.data
+            continue
+        if not event.serial:
+            continue
+        if step is not None:
+            yield step
+            if step.event == 'return':
+                _pop_frame(stack, step.frame)
+            step = None
+        frame = frames.get(event.serial)
+        if frame is None:
+            frame = frames[event.serial] = ReplayedFrame(
+                event.serial, event.code, stack[-1] if stack else None
+            )
+        if kind in events.FRAME_EVENTS:
+            if kind == 'call':
+                stack.append(frame)
+            frame.line_no = event.line_no
+            step = Step(frame, kind, event.line_no, event.data)
+        elif kind == events.CALL_ENDED_BY_EXCEPTION:
+            step = Step(frame, 'return', frame.line_no, None, True)
+        elif kind == events.VALUES:
+            frame.values.update(event.data)
+        elif kind in recording.VAR_KINDS:
+            frame.reprs.update(event.data)
+    if step is not None:
+        yield step
+
+
+def _pop_frame(stack, frame):
+    if stack and stack[-1] is frame:
+        stack.pop()
+    elif frame in stack:
+        stack.remove(frame)
+
+
+_compiled_codes = {}
+
+
+def find_code(path, name, first_line_no):
+    '''
+    Find the code object in the file at `path` with this (qualified) name and
+    first line, by compiling the file. Return `None` if there's none.
+    '''
+    try:
+        codes = _compiled_codes[path]
+    except KeyError:
+        codes = _compiled_codes[path] = {}
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                source = f.read()
+            pending = [compile(source, path, 'exec', dont_inherit=True)]
+        except (SyntaxError, ValueError) + utils.file_reading_errors:
+            return None
+        source_lines = source.splitlines()
+        while pending:
+            code = pending.pop()
+            get_code_info(code).path_and_source = (path, source_lines)
+            codes[(getattr(code, 'co_qualname', code.co_name),
+                   code.co_firstlineno)] = code
+            pending.extend(const for const in code.co_consts
+                           if isinstance(const, types.CodeType))
+    return codes.get((name, first_line_no))
+
+
+def _find_recorded_code(recorded_code):
+    return find_code(os.path.abspath(recorded_code.path), recorded_code.name,
+                     recorded_code.first_line_no)
+
+
+_recorded_global_names = {}
+
+
+def _get_recorded_global_names(recorded_code):
+    try:
+        return _recorded_global_names[recorded_code]
+    except KeyError:
+        code = _find_recorded_code(recorded_code)
+        global_names = _recorded_global_names[recorded_code] = \
+                          frozenset() if code is None else get_global_names(code)
+        return global_names
+
+
+class ReplayScope(object):
+    '''
+    Whether recorded code is between `start_line` and `end_line` of
+    `observed_file`, answered like `ScopeIndex` answers it for live code.
+    '''
+    def __init__(self, observed_file, start_line, end_line):
+        self.observed_file = os.path.abspath(observed_file)
+        self.start_line = start_line
+        self.end_line = end_line
+        self.scope_index = ScopeIndex(self.observed_file, start_line,
+                                      end_line)
+        self.verdicts = {}
+
+    def get_verdict(self, recorded_code):
+        try:
+            return self.verdicts[recorded_code]
+        except KeyError:
+            pass
+        code = None
+        if os.path.abspath(recorded_code.path) == self.observed_file:
+            code = _find_recorded_code(recorded_code)
+        verdict = self.verdicts[recorded_code] = OUT_OF_SCOPE \
+                        if code is None else self.scope_index.get_verdict(code)
+        return verdict
+
+    def contains(self, recorded_code, line_no):
+        verdict = self.get_verdict(recorded_code)
+        if verdict is IN_SCOPE:
+            return True
+        elif verdict is OUT_OF_SCOPE or line_no is None:
+            return False
+        return self.start_line <= line_no <= self.end_line
+
+
+# What `Replay._update_target` can say about a step:
+TARGET = 'target'
+NOT_TARGET = 'not target'
+LEFT_SCOPE = 'left scope'
+
+
+class Replay(object):
+    '''
+    Queries about a recording made by `record`.
+
+        with Replay('test.dbgsnoop') as replay:
+            replay.write_trace_method('foo.py', 10, 25, sys.stderr.write)
+    '''
+    def __init__(self, recording_path):
+        self.reader = TraceReader(recording_path)
+        self.test_path = None
+        self.observed_files = set()
+        for event in self.reader.read():
+            if event.kind != events.TEXT:
+                break
+            if event.data.startswith(TEST_FILE_PREFIX):
+                self.test_path = event.data[len(TEST_FILE_PREFIX):]
+            elif event.data.startswith(OBSERVED_FILE_PREFIX):
+                self.observed_files.add(
+                    event.data[len(OBSERVED_FILE_PREFIX):]
+                )
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def read_frames(self, is_wanted):
+        '''
+        Yield the events of the frames whose `RecordedCode` `is_wanted`, and
+        of the calls they made.
+        '''
+        reader = self.reader
+        end = 0
+        for frame in reader.frames:
+            if frame.offset < end or not is_wanted(reader.get_code(frame)):
+                continue
+            end = frame.end
+            for event in reader.read_frame(frame):
+                yield event
+
+    def _iter_scope_steps(self, scope):
+        return iter_steps(self.read_frames(
+            lambda code: scope.get_verdict(code) is not OUT_OF_SCOPE
+        ))
+
+    def _update_target(self, step, scope):
+        '''Keep track of the frames in the observed lines, like `Tracer`.'''
+        frame = step.frame
+        in_scope = scope.contains(frame.code, step.line_no)
+        if frame.is_target:
+            if in_scope:
+                return TARGET
+            if step.event in ('return', 'exception'):
+                _exit_target(frame)
+            return LEFT_SCOPE
+        if not in_scope:
+            return NOT_TARGET
+        frame.is_target = True
+        frame.depth = _get_shown_depth(frame.parent) + (step.event == 'call')
+        return TARGET
+
+    def _is_step_shown(self, step):
+        '''Count loop iterations like `Tracer.trace` does, see `FrameLoops`.'''
+        frame = step.frame
+        if step.event == 'return':
+            return True
+        if frame.loops is None:
+            code = _find_recorded_code(frame.code)
+            frame.loops = FrameLoops(
+                {} if code is None else get_code_info(code).get_loops(),
+                METHOD_LOOP
+            )
+        loops = frame.loops
+        if step.event == 'line':
+            return loops.update(step.line_no)
+        elif step.event == 'call':
+            return loops.update_call(step.line_no)
+        # An exception is shown if the line it's raised on is.
+        return loops.shown
+
+    def get_trace_method_events(self, observed_file, start_line, end_line):
+        '''
+        Get the events that the `trace_method` command shows for the lines
+        from `start_line` to `end_line` of `observed_file`: the lines of the
+        frames in them, and the calls these lines make.
+        '''
+        scope = ReplayScope(observed_file, start_line, end_line)
+        result = []
+        emit = result.append
+        last_source_path = None
+        is_last_skip = False
+        for step in self._iter_scope_steps(scope):
+            frame = step.frame
+            event = step.event
+            if frame.is_hidden or _is_line_suppressed(step):
+                continue
+            is_expanded = False
+            status = self._update_target(step, scope)
+            if status is LEFT_SCOPE:
+                continue
+            elif status is NOT_TARGET:
+                parent = frame.parent
+                if event == 'line' or parent is None or \
+                                    not parent.is_target or \
+                                    not scope.contains(parent.code,
+                                                       parent.line_no):
+                    continue
+                if parent.loops is not None and not parent.loops.shown:
+                    frame.is_hidden = True
+                    continue
+                is_expanded = True
+                if event == 'call':
+                    frame.depth = parent.depth + 1
+            if not self._is_step_shown(step):
+                if not is_last_skip:
+                    emit(Event(events.SKIPPED,
+                               frame.depth - (event == 'call')))
+                    is_last_skip = True
+                continue
+            # Like in `Tracer.trace`, a return (always shown, even when a
+            # resumed generator's call wasn't) doesn't end a skip:
+            if event != 'return':
+                is_last_skip = False
+            depth = frame.depth
+            source_path = frame.code.path
+            if last_source_path != source_path:
+                emit(Event(events.SOURCE_PATH, depth, data=source_path))
+                last_source_path = source_path
+            if not is_expanded or event == 'call':
+                _emit_var_changes(emit, frame, event, depth)
+            if step.ended_by_exception:
+                emit(Event(events.CALL_ENDED_BY_EXCEPTION, depth))
+            else:
+                emit(Event(event, depth, step.line_no, frame.code,
+                           data=step.source_line))
+            if is_expanded and event == 'call':
+                emit(Event(events.BODY_OMITTED, depth))
+            if event == 'return':
+                if not step.ended_by_exception:
+                    emit(Event(events.RETURN_VALUE, depth, data=step.value))
+                _exit_target(frame)
+            elif event == 'exception':
+                emit(Event(events.EXCEPTION_VALUE, depth, data=step.value))
+                _exit_target(frame)
+        return result
+
+    def write_trace_method(self, observed_file, start_line, end_line, write,
+                           color=False):
+        renderer = TextRenderer(color=color)
+        for line in renderer.render_lines(self.get_trace_method_events(
+                                        observed_file, start_line, end_line)):
+            write(line)
+
+    def get_call_graph(self, observed_file, start_line, end_line):
+        '''
+        Get the entries that `Tracer(call_graph_mode=True)` writes for the
+        calls of the lines from `start_line` to `end_line` of
+        `observed_file`, for `format_call_tree`.
+        '''
+        scope = ReplayScope(observed_file, start_line, end_line)
+        entries = []
+        is_last_call_skip = False
+        for step in self._iter_scope_steps(scope):
+            frame = step.frame
+            event = step.event
+            if frame.is_hidden or _is_line_suppressed(step):
+                continue
+            status = self._update_target(step, scope)
+            if status is LEFT_SCOPE:
+                continue
+            elif status is NOT_TARGET:
+                candidate = frame
+                for _ in range(1, CALL_GRAPH_DEPTH):
+                    candidate = candidate.parent
+                    if candidate is None:
+                        break
+                    if candidate.is_target and \
+                             scope.contains(candidate.code, candidate.line_no):
+                        break
+                else:
+                    candidate = None
+                if candidate is None:
+                    continue
+                if candidate.loops is not None and not candidate.loops.shown:
+                    frame.is_hidden = True
+                    if event == 'call' and not is_last_call_skip:
+                        entries.append({
+                            'depth': _get_shown_depth(frame.parent) + 1,
+                            'content': ['......Skipping repeated (loop) '
+                                        'calling details......'],
+                        })
+                        is_last_call_skip = True
+                    continue
+                if event == 'call':
+                    frame.depth = _get_shown_depth(frame.parent) + 1
+            if not self._is_step_shown(step):
+                continue
+            local_reprs = _get_local_reprs(frame)
+            if event == 'call':
+                shown_reprs = frame.shown_reprs or {}
+                frame.shown_reprs = collections.OrderedDict(local_reprs)
+                # A resumed generator adds to what its earlier calls have,
+                # like `Tracer` does:
+                if frame.call_info is None:
+                    frame.call_info = []
+                content = frame.call_info
+                content.append(u'Call ... {}'.format(step.source_line))
+                content.append(u'Source path:... {}'.format(frame.code.path))
+                input_para_string = format_var_reprs(
+                    ((name, value_repr)
+                     for name, value_repr in local_reprs.items()
+                     if name not in shown_reprs),
+                    ', ', prefix='Starting var:.. ', max_length=100
+                )
+                if input_para_string != 'Starting var:..':
+                    content.append(input_para_string)
+                entries.append({'depth': frame.depth, 'content': content})
+                is_last_call_skip = False
+            elif event == 'return':
+                if frame.call_info is not None:
+                    if step.ended_by_exception:
+                        frame.call_info.append('Call ended by exception')
+                    else:
+                        frame.call_info.append(
+                            u'Return ... {}'.format(step.source_line)
+                        )
+                        frame.call_info.append(
+                            u'Return value:.. {}'.format(step.value)
+                        )
+                _exit_target(frame)
+            elif event == 'exception':
+                _exit_target(frame)
+            else:
+                frame.shown_reprs = collections.OrderedDict(local_reprs)
+        return entries
+
+    def _iter_var_steps(self, var_path, start_line, end_line, is_global):
+        '''
+        Yield the steps that `VarTracer` looks at: the ones in the lines from
+        `start_line` to `end_line` of `var_path`, starting from a call, or
+        all the ones in `var_path` with `is_global`. Counts the lines each
+        frame runs.
+        '''
+        is_started = is_global
+        for step in iter_steps(self.read_frames(
+                         lambda code: os.path.abspath(code.path) == var_path)):
+            line_no = step.line_no
+            if os.path.abspath(step.frame.code.path) != var_path:
+                continue
+            if not is_global:
+                if not start_line <= line_no <= end_line:
+                    continue
+                if not is_started and step.event != 'call':
+                    continue
+                is_started = True
+            line_counts = step.frame.line_counts
+            line_counts[line_no] = line_counts.get(line_no, 0) + 1
+            yield step
+
+    def is_local(self, var_path, var_name, start_line, end_line):
+        '''
+        Whether `var_name` is a local variable of the frames that run the
+        lines from `start_line` to `end_line` of `var_path`, like
+        `judge_global` checks it.
+        '''
+        var_path = os.path.abspath(var_path)
+        for step in self._iter_var_steps(var_path, start_line, end_line,
+                                         False):
+            if var_name in _get_local_reprs(step.frame):
+                return True
+        return False
+
+    def get_var_history(self, var_path, var_name, start_line=None,
+                        end_line=None, is_global=False):
+        '''
+        Get the history of `var_name` like `VarTracer` makes it, for
+        `construct_history_str`, with the same values.
+
+        Without `is_global`, that's the history in the frames that run the
+        lines from `start_line` to `end_line` of `var_path`. With it, it's in
+        all the frames of `var_path` that have the variable: the frames of the
+        module, and the ones that assign to it as a global.
+        '''
+        var_path = os.path.abspath(var_path)
+        history = []
+        last_value = None
+        for step in self._iter_var_steps(var_path, start_line, end_line,
+                                         is_global):
+            frame = step.frame
+            location = frame.location or (var_path, step.line_no)
+            frame.location = (var_path, step.line_no)
+            values = frame.values if is_global else \
+                                             _get_locals(frame, frame.values)
+            if var_name not in values:
+                if not is_global:
+                    last_value = None
+                continue
+            value = values[var_name]
+            if value != last_value:
+                source_file, source_line_no = location
+                history.append(get_history_item(
+                    source_file, source_line_no, value,
+                    frame.line_counts.get(source_line_no, 0) >= VAR_LOOP
+                ))
+            last_value = value
+        return history
+
+
+def _is_line_suppressed(step):
+    loops = step.frame.loops
+    return step.event == 'line' and loops is not None and \
+           loops.suppressed_lines is not None and \
+           step.line_no in loops.suppressed_lines
+
+
+def _exit_target(frame):
+    '''Drop a frame from the targets after it returned or raised, like
+    `Tracer.manual_exit` does. Its variables count as new after that.'''
+    frame.is_target = False
+    frame.shown_reprs = None
+
+
+def _get_shown_depth(frame):
+    while frame is not None:
+        if frame.is_target or frame.depth:
+            return frame.depth
+        frame = frame.parent
+    return 0
+
+
+def _get_local_reprs(frame):
+    '''Get the reprs of the variables of `frame` that `Tracer` shows, which
+    are all of them but the globals it assigns to.'''
+    return _get_locals(frame, frame.reprs)
+
+
+def _get_locals(frame, items):
+    '''Leave the globals that `frame` assigns to out of `items`.'''
+    global_names = _get_recorded_global_names(frame.code)
+    if not global_names:
+        return items
+    return collections.OrderedDict(
+        (name, value) for name, value in items.items()
+        if name not in global_names
+    )
+
+
+def _emit_var_changes(emit, frame, event, depth):
+    shown_reprs = frame.shown_reprs or {}
+    local_reprs = _get_local_reprs(frame)
+    new_var_reprs = []
+    modified_var_reprs = []
+    for name, value_repr in local_reprs.items():
+        if name not in shown_reprs:
+            new_var_reprs.append((name, value_repr))
+        elif shown_reprs[name] != value_repr:
+            modified_var_reprs.append((name, value_repr))
+    frame.shown_reprs = collections.OrderedDict(local_reprs)
+    if new_var_reprs:
+        emit(Event(events.STARTING_VARS if event == 'call' else
+                   events.NEW_VARS, depth, data=new_var_reprs))
+    if modified_var_reprs:
+        emit(Event(events.MODIFIED_VARS, depth, data=modified_var_reprs))
+
+
+def trace_method(recording_path, observed_file, start_line, end_line,
+                 write=None, color=True):
+    '''Write what the `trace_method` command shows, from a recording.'''
+    write = sys.stderr.write if write is None else write
+    color = color and sys.platform in ('linux', 'linux2', 'cygwin', 'darwin')
+    with Replay(recording_path) as replay:
+        replay.write_trace_method(observed_file, start_line, end_line, write,
+                                  color)
+
+
+def call_graph(recording_path, observed_file, start_line, end_line):
+    '''Print what the `call_graph` command shows, from a recording.'''
+    with Replay(recording_path) as replay:
+        entries = replay.get_call_graph(observed_file, start_line, end_line)
+    print(format_call_tree(entries))
+
+
+def trace_var(recording_path, var_path, name, lineno):
+    '''
+    Print what the `trace_var` command shows, from a recording: the history
+    of the local variable `name` in the method that has line `lineno` of
+    `var_path`, or of the global variable `name` if it's not a local there.
+    '''
+    from . import trace_var as trace_var_module
+    var_path = os.path.abspath(var_path)
+    try:
+        with open(var_path, 'r') as f:
+            lines = f.read().splitlines()
+    except utils.file_reading_errors:
+        lines = []
+    if not lineno <= len(lines) or name not in lines[lineno - 1]:
+        print('Error occurred during script execution:\n'
+              "Variable '{}' not found in line {} of {}".format(
+                  name, lineno, var_path))
+        return
+    start_line, end_line = trace_var_module.run_get_belonging_method(var_path,
+                                                                     lineno)
+    with Replay(recording_path) as replay:
+        is_global = not (start_line and end_line) or \
+                    not replay.is_local(var_path, name, start_line, end_line)
+        history = replay.get_var_history(var_path, name, start_line, end_line,
+                                         is_global)
+    print('\n\n' + '=' * 50 + '\n\n')
+    print("Variable '{}' history:".format(name))
+    print(construct_history_str(history))
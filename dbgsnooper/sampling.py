@@ -0,0 +1,56 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import itertools
+import random
+import threading
+import time
+
+
+class Sampler(object):
+    '''
+    Picks the calls of snooped functions that get snooped on, so functions
+    that are called a lot can stay snooped.
+
+    A call is picked if it's an `every`th call, if it wins a draw with a
+    chance of `probability`, and if fewer than `max_calls` calls were picked
+    in the last `window` seconds. Each of these can be `None`, and a call has
+    to pass the ones that aren't.
+    '''
+    def __init__(self, every=None, probability=None, max_calls=None,
+                 window=1.0):
+        if every is not None and every < 1:
+            raise ValueError('`sample_every` must be at least 1.')
+        if probability is not None and not 0 <= probability <= 1:
+            raise ValueError('`sample_probability` must be between 0 and 1.')
+        if max_calls is not None and max_calls < 0:
+            raise ValueError('`sample_max_calls` must be at least 0.')
+        if window <= 0:
+            raise ValueError('`sample_window` must be positive.')
+        self.every = every
+        self.probability = probability
+        self.max_calls = max_calls
+        self.window = window
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._window_start = None
+        self._n_window_calls = 0
+
+    def sample(self):
+        '''Whether to snoop on the call that's starting.'''
+        if self.every is not None and next(self._counter) % self.every:
+            return False
+        if self.probability is not None and \
+                                          random.random() >= self.probability:
+            return False
+        if self.max_calls is not None:
+            now = time.monotonic()
+            with self._lock:
+                if self._window_start is None or \
+                                     now - self._window_start >= self.window:
+                    self._window_start = now
+                    self._n_window_calls = 0
+                if self._n_window_calls >= self.max_calls:
+                    return False
+                self._n_window_calls += 1
+        return True
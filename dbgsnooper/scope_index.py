@@ -0,0 +1,98 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''Per-code-object cache of whether it's inside the observed line range.'''
+
+import dis
+
+from . import utils, pycompat
+from .code_info import CodeCache, find_def_line
+if pycompat.PY2:
+    from io import open
+
+IN_SCOPE = 'in scope'
+PARTIALLY_IN_SCOPE = 'partially in scope'
+OUT_OF_SCOPE = 'out of scope'
+
+
+class ScopeIndex(object):
+    '''
+    Resolves each code object once into a verdict about `observed_file`.
+
+    A code object whose lines are all between `start_line` and `end_line` is
+    `IN_SCOPE`, one that has none of them is `OUT_OF_SCOPE`, and for the ones
+    that are `PARTIALLY_IN_SCOPE` only the current line has to be compared.
+    Either way, checking a trace event doesn't touch the file system.
+    '''
+    def __init__(self, observed_file, start_line, end_line):
+        self.observed_file = observed_file
+        self.start_line = start_line
+        self.end_line = end_line
+        self.verdicts = CodeCache()
+        self.call_lines = CodeCache()
+        self._sources = {}
+
+    def get_verdict(self, code):
+        try:
+            return self.verdicts[code]
+        except KeyError:
+            verdict = self.verdicts[code] = self._resolve(code)
+            return verdict
+
+    def is_in_scope(self, frame, event):
+        code = frame.f_code
+        verdict = self.get_verdict(code)
+        if verdict is IN_SCOPE:
+            return True
+        elif verdict is OUT_OF_SCOPE:
+            return False
+        line_no = frame.f_lineno
+        if event == 'call':
+            line_no = self.get_call_line(code, line_no)
+        return self.start_line <= line_no <= self.end_line
+
+    def get_call_line(self, code, line_no):
+        '''
+        Get the line to report for a call event at `line_no`.
+
+        For decorated functions that's the `def` line rather than the line of
+        the first decorator.
+        '''
+        call_lines = self.call_lines.setdefault(code, {})
+        try:
+            return call_lines[line_no]
+        except KeyError:
+            pass
+        source = self._get_source(code.co_filename)
+        result = line_no if source is None else find_def_line(source, line_no)
+        call_lines[line_no] = result
+        return result
+
+    def _resolve(self, code):
+        if code.co_filename != self.observed_file or \
+                                 self._get_source(code.co_filename) is None:
+            return OUT_OF_SCOPE
+        line_numbers = set(line_no for _, line_no in dis.findlinestarts(code)
+                           if line_no is not None)
+        line_numbers.add(code.co_firstlineno)
+        line_numbers.add(self.get_call_line(code, code.co_firstlineno))
+        in_scope = [self.start_line <= line_no <= self.end_line
+                    for line_no in line_numbers]
+        if all(in_scope):
+            return IN_SCOPE
+        elif any(in_scope):
+            return PARTIALLY_IN_SCOPE
+        else:
+            return OUT_OF_SCOPE
+
+    def _get_source(self, file_name):
+        try:
+            return self._sources[file_name]
+        except KeyError:
+            pass
+        try:
+            with open(file_name, 'r') as f:
+                source = f.read().splitlines()
+        except utils.file_reading_errors:
+            source = None
+        self._sources[file_name] = source
+        return source
@@ -0,0 +1,63 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Holding back the output of each invocation of snooped code until it's done,
+and only writing it out for the invocations that turn out to matter.
+
+An invocation is a call of a snooped function (or a `with` block), or a run
+of the lines between `start_line` and `end_line` with `observed_file`.
+'''
+
+import time
+
+
+class KeepPolicy(object):
+    '''
+    Which invocations get their output written: the ones that took at least
+    `min_duration` seconds, the ones that raised if `on_exception` is set,
+    and the ones whose return value `predicate` returns true for.
+    '''
+    def __init__(self, min_duration=None, on_exception=False, predicate=None):
+        self.min_duration = min_duration
+        self.on_exception = on_exception
+        self.predicate = predicate
+
+    def keeps(self, invocation):
+        if self.min_duration is not None and \
+                              invocation.get_duration() >= self.min_duration:
+            return True
+        if invocation.raised:
+            return self.on_exception
+        if self.predicate is not None and invocation.has_return_value:
+            try:
+                return bool(self.predicate(invocation.return_value))
+            except Exception:
+                # Better to show a call that wasn't asked for than to hide
+                # one that was:
+                return True
+        return False
+
+
+class Invocation(object):
+    '''An invocation that's running, and the events it emitted so far.'''
+    __slots__ = ('events', 'start_time', 'n_scopes', 'raised',
+                 'has_return_value', 'return_value')
+
+    def __init__(self):
+        self.events = []
+        self.start_time = time.monotonic()
+        # Snooped scopes of the invocation that didn't exit yet:
+        self.n_scopes = 0
+        self.raised = False
+        self.has_return_value = False
+        self.return_value = None
+
+    def get_duration(self):
+        return time.monotonic() - self.start_time
+
+    def set_outcome(self, ended_by_exception, return_value):
+        '''Record how a snooped frame of the invocation returned.'''
+        # The outermost frame returns last:
+        self.raised = ended_by_exception
+        self.has_return_value = not ended_by_exception
+        self.return_value = None if ended_by_exception else return_value
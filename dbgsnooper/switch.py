@@ -0,0 +1,45 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Turning snooping off and back on in a running process.
+
+It's all `tracer.DISABLED`, which snooped functions and `with` blocks check
+each time they start, so `@snoop` can be left in the code, turned off, and
+turned on when it's needed without a restart. While it's off, they do
+nothing else.
+'''
+
+import signal
+
+from . import tracer, utils
+
+
+def enable():
+    '''Turn snooping on, for all tracers.'''
+    tracer.DISABLED = False
+
+
+def disable():
+    '''Turn snooping off, for all tracers.'''
+    tracer.DISABLED = True
+
+
+def is_enabled():
+    '''Whether snooping is on.'''
+    return not tracer.DISABLED
+
+
+def toggle_on_signal(signum=getattr(signal, 'SIGUSR2', None)):
+    '''
+    Turn snooping on or off each time the process gets signal `signum`.
+
+    Call from the main thread, like `signal.signal`.
+    '''
+    if signum is None:
+        raise NotImplementedError('There is no `SIGUSR2` on this platform, '
+                                  'pass another signal.')
+    utils.chain_signal_handler(signum, _handle_signal)
+
+
+def _handle_signal(signum, frame):
+    tracer.DISABLED = not tracer.DISABLED
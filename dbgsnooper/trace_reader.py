@@ -0,0 +1,311 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''
+Reading the events of one call, or of a time window, out of a big recording
+without reading all of it.
+
+`TraceReader` memory-maps a recording and uses its sidecar index (see
+`recording.Indexer`) to seek straight to what it's asked for. A recording
+whose index is missing or behind, like one written by a process that was
+killed, or by several processes at once, gets its index built again by
+scanning it once.
+'''
+
+import bisect
+import collections
+import mmap
+import os
+
+from . import recording
+from .recording import (INDEX_ENTRY, INDEX_HEADER, INDEX_MAGIC,
+                        INDEX_VERSION, INDEX_SUFFIX, RECORD, HEADER, MAGIC,
+                        STRING, CODE, THREAD, FIRST_EVENT_KIND,
+                        RecordingError, Indexer, Tables)
+
+
+class Frame(object):
+    '''
+    A frame that was traced: its events, and the events of the calls it
+    made, are between `offset` and `end` in the recording.
+    '''
+    __slots__ = ('recorder_id', 'frame_id', 'offset', 'end', 'code_offset',
+                 'code')
+
+    def __init__(self, recorder_id, frame_id, offset, code_offset):
+        self.recorder_id = recorder_id
+        self.frame_id = frame_id
+        self.offset = offset
+        self.end = offset
+        self.code_offset = code_offset
+        self.code = None
+
+    def __repr__(self):
+        return '<Frame {} at {}>'.format(self.code or self.frame_id,
+                                          self.offset)
+
+
+class TraceIndex(object):
+    '''
+    What a recording's index says: where its segments and definitions are,
+    its frames by `(recorder_id, frame_id)`, and its runs (see
+    `recording.Indexer`) as `[start, end, [(bucket, offset), ...]]`.
+    '''
+    def __init__(self, bucket_ns=recording.TIME_BUCKET_NS):
+        self.bucket_ns = bucket_ns
+        self.segments = []
+        self.definitions = []
+        self.frames = collections.OrderedDict()
+        self.runs = []
+        self.covered = 0
+
+    def add_entries(self, data):
+        frames = self.frames
+        runs = self.runs
+        for kind, frame_id, recorder_id, x, y in INDEX_ENTRY.iter_unpack(data):
+            if kind == recording.DEFINITION_ENTRY:
+                self.definitions.append(x)
+            elif kind == recording.FRAME_END_ENTRY:
+                frame = frames.get((recorder_id, frame_id))
+                if frame is not None and x > frame.end:
+                    frame.end = x
+            elif kind == recording.TIME_ENTRY:
+                runs[-1][2].append((x, y))
+            elif kind == recording.RUN_ENTRY:
+                if runs:
+                    runs[-1][1] = y
+                runs.append([y, None, [(x, y)]])
+            elif kind == recording.FRAME_ENTRY:
+                frames[(recorder_id, frame_id)] = Frame(recorder_id, frame_id,
+                                                        x, y)
+            elif kind == recording.SEGMENT_ENTRY:
+                self.segments.append(x)
+            elif kind == recording.COVERED_ENTRY:
+                self.covered = max(self.covered, x)
+        if runs:
+            runs[-1][1] = self.covered
+
+
+def get_index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def load_index(path):
+    '''
+    Load the index of the recording at `path`, or return `None` if it has no
+    index that can be read.
+    '''
+    try:
+        with open(get_index_path(path), 'rb') as index_file:
+            data = index_file.read()
+    except (IOError, OSError):
+        return None
+    if len(data) < INDEX_HEADER.size:
+        return None
+    magic, version, bucket_ns = INDEX_HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        return None
+    index = TraceIndex(bucket_ns)
+    # An index that's being written can end in the middle of an entry:
+    end = len(data) - (len(data) - INDEX_HEADER.size) % INDEX_ENTRY.size
+    index.add_entries(memoryview(data)[INDEX_HEADER.size:end])
+    return index
+
+
+def build_index(path, data=None):
+    '''
+    Scan the recording at `path` (or `data`, its content), write its index
+    next to it, and return the index.
+    '''
+    if data is None:
+        with open(path, 'rb') as recording_file:
+            data = recording_file.read()
+    view = memoryview(data)
+    end = len(view)
+    indexer = Indexer()
+    magic_size = len(MAGIC)
+    record_size = RECORD.size
+    unpack_record = RECORD.unpack_from
+    seen_frames = set()
+    recorder_id = None
+    offset = 0
+    while offset < end:
+        if view[offset:offset + magic_size] == MAGIC:
+            recorder_id = recording.read_header(view, offset)
+            indexer.add_segment(offset, recorder_id)
+            code_offsets, thread_idents = {}, {}
+            offset += HEADER.size
+            continue
+        if recorder_id is None:
+            raise RecordingError('Not a dbgsnooper recording.')
+        (kind_number, _, _, thread_id, code_id, frame_id, a, b,
+                                    timestamp) = unpack_record(view, offset)
+        record_offset = offset
+        offset += record_size
+        if kind_number < FIRST_EVENT_KIND:
+            indexer.add_definition(record_offset)
+            if kind_number == STRING:
+                offset += b
+            elif kind_number == CODE:
+                code_offsets[code_id] = record_offset
+            elif kind_number == THREAD:
+                thread_idents[thread_id] = timestamp
+            continue
+        if frame_id and (recorder_id, frame_id) not in seen_frames:
+            seen_frames.add((recorder_id, frame_id))
+            indexer.add_frame(recorder_id, frame_id, record_offset,
+                              code_offsets.get(code_id, 0))
+        # The records after the first of a variables event come out the same
+        # as the first, except for moving the end of the frame:
+        indexer.add_event(recorder_id, frame_id, record_offset, offset,
+                          timestamp, thread_idents[thread_id])
+    index_data = indexer.get_header() + indexer.finish(end)
+    with open(get_index_path(path), 'wb') as index_file:
+        index_file.write(index_data)
+    index = TraceIndex(indexer.bucket_ns)
+    index.add_entries(memoryview(index_data)[INDEX_HEADER.size:])
+    return index
+
+
+class TraceReader(object):
+    '''
+    Read parts of the recording at `path`, through its index. With
+    `normalize`, events are normalized like `recording.read_events` does.
+
+        with TraceReader('trace.dbgsnoop') as reader:
+            for frame in reader.find_frames('parse'):
+                for event in reader.read_frame(frame):
+                    ...
+    '''
+    def __init__(self, path, normalize=False):
+        self.path = path
+        self.normalize = normalize
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        # Empty files can't be memory-mapped:
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+                                                                if size else b''
+        self.size = size
+        index = load_index(path)
+        if index is None or index.covered != size:
+            index = build_index(path, self.data)
+        self.index = index
+        # Tables by segment offset, and how many definitions they have:
+        self._tables = {}
+        # Codes by the offset of their definition:
+        self._codes = {}
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _get_tables(self, offset):
+        '''Get the tables of the segment at `offset`, as they are there.'''
+        index = self.index
+        segment = index.segments[bisect.bisect_right(index.segments,
+                                                     offset) - 1]
+        tables, n_loaded = self._tables.get(segment, (None, None))
+        if tables is None:
+            tables = Tables(recording.read_header(self.data, segment))
+            n_loaded = bisect.bisect_right(index.definitions, segment)
+        definitions = index.definitions
+        n_needed = bisect.bisect_left(definitions, offset)
+        # Definitions are only ever added to, so tables that have more of
+        # them than needed are as good:
+        for definition in definitions[n_loaded:n_needed]:
+            tables.define(self.data, definition)
+        self._tables[segment] = (tables, max(n_loaded, n_needed))
+        return tables
+
+    def read(self, offset=0, end=None):
+        '''
+        Yield the events between `offset` and `end`. `offset` has to be where
+        an event or a segment starts.
+        '''
+        if offset >= self.size:
+            return iter(())
+        tables = None
+        if self.data[offset:offset + len(MAGIC)] != MAGIC:
+            tables = self._get_tables(offset)
+        return (event for _, event in recording.iter_records(
+            self.data, self.normalize, offset, end, tables
+        ))
+
+    @property
+    def frames(self):
+        '''The frames in the recording, in the order they started.'''
+        return list(self.index.frames.values())
+
+    def get_code(self, frame):
+        '''Get the `RecordedCode` of `frame`.'''
+        if frame.code is None:
+            code = self._codes.get(frame.code_offset)
+            if code is None:
+                tables = self._get_tables(frame.code_offset)
+                _, _, _, _, code_id, _, _, _, _ = RECORD.unpack_from(
+                    self.data, frame.code_offset
+                )
+                tables.define(self.data, frame.code_offset)
+                code = self._codes[frame.code_offset] = tables.codes[code_id]
+            frame.code = code
+        return frame.code
+
+    def find_frames(self, name=None, path=None, line_no=None):
+        '''
+        Get the frames of the code called `name` (its name or qualified
+        name), defined in `path` (or a file with that name) at `line_no`.
+        '''
+        if path is not None:
+            path = os.path.realpath(path) if os.sep in path else path
+        found = []
+        for frame in self.index.frames.values():
+            code = self.get_code(frame)
+            if name is not None and code.name != name and \
+                                     not code.name.endswith('.' + name):
+                continue
+            if path is not None and path != code.path and \
+                         path not in (os.path.realpath(code.path),
+                                      os.path.basename(code.path)):
+                continue
+            if line_no is not None and line_no != code.first_line_no:
+                continue
+            found.append(frame)
+        return found
+
+    def read_frame(self, frame):
+        '''Yield the events of `frame` and of the calls it made.'''
+        thread = None
+        for event in self.read(frame.offset, frame.end):
+            if thread is None:
+                thread = event.thread
+            # Other threads can write to the same recording in between:
+            if event.thread == thread:
+                yield event
+
+    def read_time_window(self, start_ns, end_ns):
+        '''
+        Yield the events with timestamps from `start_ns` to `end_ns` (from
+        `events.monotonic_ns`), run by run. Runs are in the order they were
+        written, so events of different threads can come out of order.
+        '''
+        bucket_ns = self.index.bucket_ns
+        start_bucket = start_ns - start_ns % bucket_ns
+        for run_start, run_end, buckets in self.index.runs:
+            if buckets[0][0] > end_ns or buckets[-1][0] < start_bucket:
+                continue
+            offset = run_start
+            for bucket, bucket_offset in buckets:
+                if bucket > start_bucket:
+                    break
+                offset = bucket_offset
+            for event in self.read(offset, run_end):
+                if event.timestamp > end_ns:
+                    break
+                if event.timestamp >= start_ns:
+                    yield event
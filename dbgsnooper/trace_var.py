@@ -5,6 +5,12 @@ import argparse
 import traceback
 from typing import List, Tuple
 from .ast_env_boot import run_get_statement_range, run_get_belonging_method
+from .code_info import get_code_info
+from .frame_states import (FrameStates, FRAME_STATE_SIZE,
+                           DEFAULT_MAX_STATE_SIZE)
+
+# Rough size in bytes of one entry of `VarFrameState.line_counts`:
+LINE_COUNT_SIZE = 100
 
 def debugging_test_execution_wrapper(test_path, name, is_global = False, var_path=None, lineno = None):
     test_path = os.path.abspath(test_path)
@@ -31,6 +37,20 @@ def debugging_test_execution_wrapper(test_path, name, is_global = False, var_pat
         
         
 
+class VarFrameState:
+    __slots__ = ('serial', 'code', 'size', 'location', 'line_counts')
+
+    def __init__(self, serial, code):
+        self.serial = serial
+        self.code = code
+        self.size = FRAME_STATE_SIZE
+        self.location = None
+        self.line_counts = {}
+
+    def get_size(self):
+        return FRAME_STATE_SIZE + LINE_COUNT_SIZE * len(self.line_counts)
+
+
 class VarTracer:
     def __init__(self, varname: str, test_path: str, is_global = False, var_path: str = None, lineno: int = None):
         self.trace_start = False
@@ -38,7 +58,8 @@ class VarTracer:
         self.varname = varname
         self.history: List[Tuple[str, int, object, str]] = []
         self.last_value = None
-        self.frame_locs = dict()
+        self.frame_states = FrameStates(max_size=DEFAULT_MAX_STATE_SIZE,
+                                        state_type=VarFrameState)
         self.is_global = is_global
         
         self.var_path = os.path.abspath(var_path) if var_path else None
@@ -48,7 +69,6 @@ class VarTracer:
         self.observed_code = None
 
         self.loop = 4
-        self.frame_line_executed = {}
         
         if self.var_path and self.lineno and not self.is_global:
             assert os.path.exists(self.var_path), f"Variable path {self.var_path} does not exist"
@@ -62,6 +82,14 @@ class VarTracer:
 
         
     def __call__(self, frame, event, arg):
+        try:
+            return self._trace(frame, event, arg)
+        finally:
+            if event == 'return' and \
+                           not get_code_info(frame.f_code).is_yielding(frame):
+                self.frame_states.release(frame)
+
+    def _trace(self, frame, event, arg):
         file = frame.f_code.co_filename
                 
         if not self.trace_start:
@@ -85,7 +113,9 @@ class VarTracer:
             else:
                 self.observed_code = frame.f_code
         
-        self.record_frame_line_executed(frame)
+        frame_state = self.frame_states.get_or_add(frame)
+        self.record_frame_line_executed(frame_state, lineno)
+        self.frame_states.account(frame, frame_state)
         if self.is_global:
             g = frame.f_globals
             observed_vars = g
@@ -96,63 +126,38 @@ class VarTracer:
         
         if self.varname not in observed_vars:
             self.last_value = None
-            self.frame_locs[frame] = (file, lineno)
+            frame_state.location = (file, lineno)
             return self
         
             
             
         current_value = resolve_variable(observed_vars[self.varname])
         if current_value != self.last_value:
-            source_file, source_lineno = self.frame_locs.get(frame)
-
-            code, end_line = self._get_full_statement(source_file, source_lineno)
-            if end_line != source_lineno:
-                scope = f'{source_lineno}-{end_line}'
-            else:
-                scope = str(source_lineno)
-
-            if self.is_skip_loop(frame, source_lineno):
-                self.history.append((source_file, scope, current_value, code, 'loop'))
-            else:
-                self.history.append((source_file, scope, current_value, code))
+            # A state that was evicted starts over without a location:
+            source_file, source_lineno = frame_state.location or (file, lineno)
+            self.history.append(get_history_item(
+                source_file, source_lineno, current_value,
+                self.is_skip_loop(frame_state, source_lineno)
+            ))
 
         self.last_value = current_value
-        self.frame_locs[frame] = (file, lineno)
+        frame_state.location = (file, lineno)
         return self
         
 
     def _get_full_statement(self, filename: str, lineno: int):
-        try:
-            start, end = run_get_statement_range(filename, lineno)
-            with open(filename, 'r', encoding='utf-8') as f:
-                lines = f.read().splitlines()
-            return '\n'.join(lines[start - 1:end]), end
-        except Exception as e:
-            return f"<error extracting statement: {e}>", None
+        return get_full_statement(filename, lineno)
 
     def construct_history_str(self):
-        str_list = []
-        for i in range(len(self.history)):
-            curr_item = self.history[i]
-            if len(curr_item) == 4:
-                filename, scope, value, code = curr_item
-                str_list.append(f"Location: {filename}: {scope}\nCode:\n```\n{code}\n```\nValue: {value}\n")
-            elif len(curr_item) == 5:
-                filename, scope, value, code, _ = curr_item
-                next_item = self.history[i + 1] if i + 1 < len(self.history) else None
-                if len(next_item) == 4:
-                    str_list.append(f"Location: {filename}: {scope}\nCode:\n```\n{code}\n```\nValue: {value}\n")
-                elif i-1 >= 0 and len(self.history[i-1]) == 4:
-                        str_list.append(f"...Skipping repeated variable modification details in loop......\n")
-        return '\n'.join(str_list)
+        return construct_history_str(self.history)
 
 
-    def is_skip_loop(self, frame, lineno, max_loop_times = None):
+    def is_skip_loop(self, frame_state, lineno, max_loop_times = None):
         looped_times = 0
         max_loop_times = max_loop_times if max_loop_times is not None else self.loop
 
-        if frame in self.frame_line_executed and lineno in self.frame_line_executed[frame]:
-            looped_times = self.frame_line_executed[frame][lineno]
+        if lineno in frame_state.line_counts:
+            looped_times = frame_state.line_counts[lineno]
         else:
             return False
         if looped_times >= max_loop_times:
@@ -160,16 +165,52 @@ class VarTracer:
         return False
 
         
-    def record_frame_line_executed(self, frame, lineno = None):
-        lineno = lineno if lineno is not None else frame.f_lineno
-        if frame not in self.frame_line_executed:
-            self.frame_line_executed[frame] = {}
-        if lineno not in self.frame_line_executed[frame]:
-            self.frame_line_executed[frame][lineno] = 0
-        self.frame_line_executed[frame][lineno] += 1
+    def record_frame_line_executed(self, frame_state, lineno):
+        if lineno not in frame_state.line_counts:
+            frame_state.line_counts[lineno] = 0
+        frame_state.line_counts[lineno] += 1
 
 
 
+def get_full_statement(filename: str, lineno: int):
+    try:
+        start, end = run_get_statement_range(filename, lineno)
+        with open(filename, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        return '\n'.join(lines[start - 1:end]), end
+    except Exception as e:
+        return f"<error extracting statement: {e}>", None
+
+
+def get_history_item(source_file, source_lineno, value, is_loop):
+    '''Make an item of a variable's history, for `construct_history_str`.'''
+    code, end_line = get_full_statement(source_file, source_lineno)
+    if end_line != source_lineno:
+        scope = f'{source_lineno}-{end_line}'
+    else:
+        scope = str(source_lineno)
+    if is_loop:
+        return (source_file, scope, value, code, 'loop')
+    return (source_file, scope, value, code)
+
+
+def construct_history_str(history):
+    str_list = []
+    for i in range(len(history)):
+        curr_item = history[i]
+        if len(curr_item) == 4:
+            filename, scope, value, code = curr_item
+            str_list.append(f"Location: {filename}: {scope}\nCode:\n```\n{code}\n```\nValue: {value}\n")
+        elif len(curr_item) == 5:
+            filename, scope, value, code, _ = curr_item
+            next_item = history[i + 1] if i + 1 < len(history) else None
+            if next_item is None or len(next_item) == 4:
+                str_list.append(f"Location: {filename}: {scope}\nCode:\n```\n{code}\n```\nValue: {value}\n")
+            elif i-1 >= 0 and len(history[i-1]) == 4:
+                    str_list.append(f"...Skipping repeated variable modification details in loop......\n")
+    return '\n'.join(str_list)
+
+
 import inspect
 import types
 
@@ -3,50 +3,87 @@
 
 import functools
 import inspect
-import opcode
+import itertools
 import os
 import sys
 import re
 import collections
 import datetime as datetime_module
-import itertools
 import threading
 import traceback
+import weakref
 
 from .variables import CommonVariable, Exploding, BaseVariable
-from . import utils, pycompat
+from . import (utils, pycompat, monitoring, sampling, speculation,
+               dumping)
+from .scope_index import ScopeIndex, IN_SCOPE, OUT_OF_SCOPE
+from .code_info import get_code_info, get_loaded_names, UnavailableSource
+from .fingerprints import ReprCache
+from .loops import FrameLoops
+from .frame_states import ThreadState, TaskState, DEFAULT_MAX_STATE_SIZE
+from . import events, recording
+from .events import (Event, EventBuffer, ThreadBuffers, RingBuffers,
+                     TextRenderer, format_var_reprs)
+from .writers import (get_write_function, AsyncWriter, DEFAULT_BUFFER_SIZE,
+                      DEFAULT_FLUSH_INTERVAL, DEFAULT_QUEUE_SIZE,
+                      add_exit_callback)
 if pycompat.PY2:
     from io import open
 
 ipython_filename_pattern = re.compile('^<ipython-input-([0-9]+)-.*>$')
 ansible_filename_pattern = re.compile(r'^(.+\.zip)[/|\\](ansible[/|\\]modules[/|\\].+\.py)$')
 ipykernel_filename_pattern = re.compile(r'^/var/folders/.*/ipykernel_[0-9]+/[0-9]+.py$')
-RETURN_OPCODES = {
-    'RETURN_GENERATOR', 'RETURN_VALUE', 'RETURN_CONST',
-    'INSTRUMENTED_RETURN_GENERATOR', 'INSTRUMENTED_RETURN_VALUE',
-    'INSTRUMENTED_RETURN_CONST', 'YIELD_VALUE', 'INSTRUMENTED_YIELD_VALUE'
-}
-
 
-def get_local_reprs(frame, watch=(), custom_repr=(), max_length=None, normalize=False):
-    code = frame.f_code
-    vars_order = (code.co_varnames + code.co_cellvars + code.co_freevars +
-                  tuple(frame.f_locals.keys()))
 
-    result_items = [(key, utils.get_shortish_repr(value, custom_repr,
-                                                  max_length, normalize))
-                    for key, value in frame.f_locals.items()]
-    result_items.sort(key=lambda key_value: vars_order.index(key_value[0]))
-    result = collections.OrderedDict(result_items)
+def get_local_reprs(frame, watch=(), custom_repr=(), max_length=None, normalize=False,
+                    repr_cache=None, repr_guard=None):
+    code_info = get_code_info(frame.f_code)
+    items = code_info.sort_local_items(frame.f_locals.items())
+    if repr_cache is None:
+        result = collections.OrderedDict(
+            (key, utils.get_shortish_repr(value, custom_repr, max_length,
+                                          normalize, repr_guard))
+            for key, value in items
+        )
+    else:
+        result = collections.OrderedDict(
+            (key, repr_cache.get_repr(key, value)) for key, value in items
+        )
+        repr_cache.prune(result)
 
     for variable in watch:
         result.update(sorted(variable.items(frame, normalize)))
     return result
 
 
-class UnavailableSource(object):
-    def __getitem__(self, i):
-        return u'SOURCE IS UNAVAILABLE'
+def update_local_reprs(frame, names, local_reprs, repr_cache):
+    '''
+    Repr only the variables in `names` again, and update `local_reprs` with
+    them.
+
+    Returns the old reprs of these variables and their new ones, ordered like
+    `get_local_reprs` orders them.
+    '''
+    code_info = get_code_info(frame.f_code)
+    f_locals = frame.f_locals
+    old_reprs = {}
+    items = []
+    for name in names:
+        if name in local_reprs:
+            old_reprs[name] = local_reprs[name]
+        try:
+            value = f_locals[name]
+        except KeyError:
+            local_reprs.pop(name, None)
+            repr_cache.discard(name)
+            continue
+        items.append((name, value))
+    new_reprs = collections.OrderedDict(
+        (name, repr_cache.get_repr(name, value))
+        for name, value in code_info.sort_local_items(items)
+    )
+    local_reprs.update(new_reprs)
+    return old_reprs, new_reprs
 
 
 source_and_path_cache = {}
@@ -130,46 +167,59 @@ def get_path_and_source_from_frame(frame):
     return result
 
 
-def get_write_function(output, overwrite):
-    is_path = isinstance(output, (pycompat.PathLike, str))
-    if overwrite and not is_path:
-        raise Exception('`overwrite=True` can only be used when writing '
-                        'content to file.')
-    if output is None:
-        def write(s):
-            stderr = sys.stderr
-            try:
-                stderr.write(s)
-            except UnicodeEncodeError:
-                # God damn Python 2
-                stderr.write(utils.shitcode(s))
-    elif is_path:
-        return FileWriter(output, overwrite).write
-    elif callable(output):
-        write = output
-    else:
-        assert isinstance(output, utils.WritableStream)
-
-        def write(s):
-            output.write(s)
-    return write
+thread_global = threading.local()
 
 
-class FileWriter(object):
-    def __init__(self, path, overwrite):
-        self.path = pycompat.text_type(path)
-        self.overwrite = overwrite
+class _NotSnooping(object):
+    '''Where the steps of generators whose calls weren't sampled run.'''
+    def __enter__(self):
+        pass
 
-    def write(self, s):
-        with open(self.path, 'w' if self.overwrite else 'a',
-                  encoding='utf-8') as output_file:
-            output_file.write(s)
-        self.overwrite = False
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
 
 
-thread_global = threading.local()
+not_snooping = _NotSnooping()
+# The wrappers of snooped functions, which aren't snooped themselves:
+internal_file_names = frozenset((
+    __file__, os.path.join(os.path.dirname(__file__), 'coroutines.py')
+))
+# Whether snooping is off, see `switch`. Read where snooping starts, so it can
+# be turned back on in a running process:
 DISABLED = bool(os.getenv('PYSNOOPER_DISABLED', ''))
 
+
+# All tracers, so what they still hold can be written when the process exits:
+_tracers = weakref.WeakSet()
+
+
+def get_event_buffer():
+    '''Get the buffer of the events that this thread's tracers emitted.'''
+    try:
+        return thread_global.event_buffer
+    except AttributeError:
+        event_buffer = thread_global.event_buffer = EventBuffer()
+        return event_buffer
+
+
+def write_pending_events():
+    '''
+    Render and write the events that tracers hold back until a scope exits,
+    before `writers.flush_all` writes the buffers of the files.
+
+    This runs when the process exits or gets `SIGTERM`, so it may interrupt
+    the main thread in the middle of emitting or rendering. Events that are
+    being rendered already are left to that. The event buffers of other
+    threads are left to them too, since their events are recorded as the
+    thread's that writes them.
+    '''
+    event_buffer = thread_global.__dict__.get('event_buffer')
+    if event_buffer is not None:
+        event_buffer.flush()
+    for tracer in list(_tracers):
+        tracer.write_pending_events()
+
+
 class Tracer:
     '''
     Snoop on the function, writing everything it's doing to stderr.
@@ -208,6 +258,18 @@ class Tracer:
 
         @pysnooper.snoop(thread_info=True)
 
+    Snoop on the threads that get started while snooping too (with
+    `threading.settrace`, so only with `backend='settrace'`). Each thread's
+    events go to a buffer of its own, and get merged in the order they
+    happened when they're rendered, so threads don't wait on each other to
+    write and their lines don't get mixed up:
+
+        @pysnooper.snoop(thread_info=True, trace_threads=True)
+
+    Threads that were started while snooping keep being snooped on until they
+    finish; call `flush()` to write out what they did after the snooped scope
+    exited.
+
     Customize how values are represented as strings::
 
         @pysnooper.snoop(custom_repr=((type1, custom_repr_func1),
@@ -220,6 +282,12 @@ class Tracer:
 
     You can also use `max_variable_length=None` to never truncate them.
 
+    Replace the reprs of types whose `__repr__` is slow with a placeholder,
+    once one of their reprs takes more than 10 ms, or all of them took more
+    than a second together (each limit is optional):
+
+        @pysnooper.snoop(max_repr_time=0.01, max_total_repr_time=1)
+
     Show timestamps relative to start time rather than wall time::
 
         @pysnooper.snoop(relative_time=True)
@@ -229,28 +297,126 @@ class Tracer:
 
         @pysnooper.snoop(color=False)
 
+    On Python 3.12+, use `sys.monitoring` instead of `sys.settrace`, so code
+    outside the snooped scope runs at (nearly) full speed:
+
+        @pysnooper.snoop(backend='monitoring')
+
+    `backend='auto'` picks `monitoring` when it's available.
+
+    Cap the memory that per-frame state (like the reprs of the variables of
+    each frame that's being snooped) may take, in bytes. Past it, the state of
+    the least recently used frames is dropped, and their variables are
+    reported as new again (the cap is for each thread):
+
+        @pysnooper.snoop(max_state_size=16 * 1024 * 1024)
+
+    Text output is written as it happens. Binary recordings are buffered as
+    events for up to a tenth of a second, or until the snooped scope exits.
+    Call `flush()` to write them out earlier.
+
+    A log file is kept open, and written once `buffer_size` characters piled
+    up or `flush_interval` seconds passed, when the outermost snooped scope
+    exits, and when the process exits or gets `SIGTERM`. Pass `fsync=True` to
+    also wait for each write to reach the disk:
+
+        @pysnooper.snoop('/my/log/file.log', flush_interval=0.1, fsync=True)
+
+    Write the output on a background thread, through a queue of up to
+    `queue_size` lines. When the queue is full, `overflow='block'` (the
+    default) waits for room, and `'drop-oldest'` or `'drop-newest'` drop
+    lines, and say how many in the output:
+
+        @pysnooper.snoop(async_output=True, overflow='drop-oldest')
+
+    Record a compact binary log instead of text, to render later with
+    `dbgsnooper render /my/log/file.dbgsnoop` (add `--color` or
+    `--normalize` to taste):
+
+        @pysnooper.snoop('/my/log/file.dbgsnoop', format='binary')
+
+    Snoop on only some of the calls of a function that's called a lot: every
+    Nth call, each call with some probability, or at most K calls in each
+    `sample_window` seconds (a call has to pass all of the ones that are
+    set). The other calls run as if the function wasn't snooped:
+
+        @pysnooper.snoop(sample_every=1000)
+        @pysnooper.snoop(sample_probability=0.001)
+        @pysnooper.snoop(sample_max_calls=10, sample_window=60)
+
+    Hold back the output of each call (or `with` block, or run of the lines
+    of `observed_file`) until it's done, and only write it if it took at
+    least `keep_slower_than` seconds, if it raised and `keep_exceptions` is
+    set, or if `keep_if` returns true for its return value. The output of
+    the other calls is dropped:
+
+        @pysnooper.snoop(keep_slower_than=0.5, keep_exceptions=True)
+        @pysnooper.snoop(keep_if=lambda response: response.status >= 500)
+
+    Keep only the last `flight_recorder` events of each thread, and write
+    nothing until something goes wrong: an exception that isn't caught, one
+    of the `dump_on` exception types being raised, the `dump_signal` signal
+    (`SIGUSR1` by default, which needs the tracer to be made in the main
+    thread), or a call to `dump()`. Then the events are written like any
+    other output:
+
+        @pysnooper.snoop('/my/log/file.log', flight_recorder=10000,
+                         dump_on=(DatabaseError,))
+
+    Coroutine functions and asynchronous generator functions can be snooped
+    too. Each task keeps its own depth and variable reprs, and its output is
+    written in one piece when its outermost snooped coroutine is done, rather
+    than interleaved with other tasks'. So the event loop doesn't wait for
+    the output, text is then written on a background thread, like with
+    `async_output=True`, dropping the oldest lines when the queue is full
+    unless `overflow` says otherwise.
+
+    Snooping can be turned off and back on in a running process, with
+    `pysnooper.disable()` and `pysnooper.enable()`, or with a signal that
+    `pysnooper.toggle_on_signal()` sets up. While it's off, snooped functions
+    are called right away, without tracing. It starts off if the
+    `PYSNOOPER_DISABLED` environment variable is set:
+
+        pysnooper.toggle_on_signal(signal.SIGUSR2)
+
+    Only show the exceptions that pass through the snooped frames, each with
+    a snapshot of the frame's local variables when the exception got to it.
+    No line events are traced, so the snooped code runs at (nearly) full
+    speed until an exception is raised, especially with
+    `backend='monitoring'`, which then doesn't hook calls at all:
+
+        @pysnooper.snoop(exceptions_only=True, backend='monitoring')
+
     '''
     def __init__(self, output=None, watch=(), watch_explode=(), depth=1,
                  prefix='', overwrite=False, thread_info=False, custom_repr=(),
                  max_variable_length=100, normalize=False, relative_time=False,
-                 color=True, observed_file = None, start_line = None, end_line = None, spec_loop_time = None, depth_expanded = True, call_graph_mode = False):
+                 color=True, observed_file = None, start_line = None, end_line = None, spec_loop_time = None, depth_expanded = True, call_graph_mode = False,
+                 backend='settrace', max_repr_time=None,
+                 max_total_repr_time=None,
+                 max_state_size=DEFAULT_MAX_STATE_SIZE,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, fsync=False,
+                 async_output=False, queue_size=DEFAULT_QUEUE_SIZE,
+                 overflow=None, format='text', trace_threads=False,
+                 sample_every=None, sample_probability=None,
+                 sample_max_calls=None, sample_window=1.0,
+                 keep_slower_than=None, keep_exceptions=False, keep_if=None,
+                 flight_recorder=None, dump_on=(),
+                 dump_signal=dumping.DEFAULT_DUMP_SIGNAL,
+                 exceptions_only=False):
         
-        self.is_last_skip = False
-        self.is_last_call_skip = False
         self.loop = 3
         self.spec_loop_time = spec_loop_time
         
         self.depth_expanded = depth_expanded if not call_graph_mode else False
         self.depth = depth if not call_graph_mode else 3
-        self.is_in_expanded_status = False
         
         self.call_graph_output_path = 'call_graph_data.json' if call_graph_mode else None
         if call_graph_mode:
 
-            self.call_frames = {}
             self.call_infos = []
         
-        self.frame_line_executed = {}
         self.observed_file = os.path.abspath(observed_file) if observed_file else None
         
 
@@ -259,8 +425,46 @@ class Tracer:
         if self.observed_file:
             assert os.path.exists(self.observed_file)
             assert self.start_line is not None and self.end_line is not None and self.start_line <= self.end_line
+            self.scope_index = ScopeIndex(self.observed_file, start_line, end_line)
+        else:
+            self.scope_index = None
         
-        self._write = get_write_function(output, overwrite)
+        if format == 'text':
+            self._write = get_write_function(output, overwrite, buffer_size,
+                                             flush_interval, fsync,
+                                             async_output, queue_size,
+                                             overflow or 'block')
+        elif format == 'binary':
+            if async_output:
+                raise NotImplementedError('`async_output` is only supported '
+                                          'with `format=\'text\'`.')
+            self._write = recording.get_recording_writer(
+                output, overwrite, buffer_size, flush_interval, fsync
+            )
+        else:
+            raise ValueError('Unknown format {!r}.'.format(format))
+        self.format = format
+        # Whether events are rendered and written as they're emitted, rather
+        # than buffered. The call graph is written all at once, and binary
+        # recordings are encoded a batch of events at a time:
+        self.writes_through = format == 'text' and not call_graph_mode
+
+        if backend == 'auto':
+            backend = ('monitoring' if monitoring.MONITORING_AVAILABLE and
+                       not trace_threads else 'settrace')
+        if backend == 'monitoring':
+            if not monitoring.MONITORING_AVAILABLE:
+                raise NotImplementedError('`backend=\'monitoring\'` needs '
+                                          'Python 3.12 or newer.')
+            if trace_threads:
+                raise NotImplementedError('`trace_threads` is only supported '
+                                          'with `backend=\'settrace\'`.')
+            self._monitor = monitoring.get_monitor()
+        elif backend == 'settrace':
+            self._monitor = None
+        else:
+            raise ValueError('Unknown backend {!r}.'.format(backend))
+        self.backend = backend
 
         self.watch = [
             v if isinstance(v, BaseVariable) else CommonVariable(v)
@@ -269,55 +473,75 @@ class Tracer:
              v if isinstance(v, BaseVariable) else Exploding(v)
              for v in utils.ensure_tuple(watch_explode)
         ]
-        self.frame_to_local_reprs = {}
-        self.start_times = {}
+        self.watch_names = frozenset().union(
+            *(get_loaded_names(variable.code) for variable in self.watch)
+        )
+        self.max_state_size = max_state_size
+        # Shared by the states of all threads and tasks, so the serials of
+        # their frames don't collide in a recording:
+        self.frame_serials = itertools.count(1)
         self.prefix = prefix
         self.thread_info = thread_info
         self.thread_info_padding = 0
+        self.exceptions_only = exceptions_only
         assert self.depth >= 1
         self.target_codes = set()
-        self.target_frames = set()
         self.thread_local = threading.local()
+        self.trace_threads = trace_threads
+        self.thread_buffers = ThreadBuffers() if trace_threads else None
+        self._render_lock = threading.Lock()
+        self._thread_trace_lock = threading.Lock()
+        self._n_thread_scopes = 0
+        self._original_thread_trace = None
+        # A `ContextVar` with the `TaskState` of the current task, once a
+        # coroutine function is snooped, and the states of all tasks:
+        self._task_state = None
+        self._task_states = weakref.WeakSet()
+        self.queue_size = queue_size
+        self.overflow = overflow
         if len(custom_repr) == 2 and not all(isinstance(x,
                       pycompat.collections_abc.Iterable) for x in custom_repr):
             custom_repr = (custom_repr,)
-        self.custom_repr = custom_repr
-        self.last_source_path = None
+        self.custom_repr = utils.ReprResolver(custom_repr)
+        if max_repr_time is None and max_total_repr_time is None:
+            self.repr_guard = None
+        else:
+            self.repr_guard = utils.ReprGuard(max_repr_time,
+                                              max_total_repr_time)
+        if sample_every is None and sample_probability is None and \
+                                                     sample_max_calls is None:
+            self.sampler = None
+        else:
+            self.sampler = sampling.Sampler(sample_every, sample_probability,
+                                            sample_max_calls, sample_window)
+        if keep_slower_than is None and not keep_exceptions and \
+                                                              keep_if is None:
+            self.keep_policy = None
+        else:
+            self.keep_policy = speculation.KeepPolicy(keep_slower_than,
+                                                      keep_exceptions, keep_if)
+        self.dump_on = utils.ensure_tuple(dump_on)
+        self.dump_signal = dump_signal
+        self._dumped_exception_id = None
+        if flight_recorder is None:
+            if self.dump_on:
+                raise ValueError('`dump_on` needs `flight_recorder`.')
+            self.ring_buffers = None
+        else:
+            self.ring_buffers = RingBuffers(flight_recorder)
+            dumping.register(self)
         self.max_variable_length = max_variable_length
         self.normalize = normalize
         self.relative_time = relative_time
         self.color = color and sys.platform in ('linux', 'linux2', 'cygwin',
                                                 'darwin')
 
-        if self.color:
-            self._FOREGROUND_BLUE = '\x1b[34m'
-            self._FOREGROUND_CYAN = '\x1b[36m'
-            self._FOREGROUND_GREEN = '\x1b[32m'
-            self._FOREGROUND_MAGENTA = '\x1b[35m'
-            self._FOREGROUND_RED = '\x1b[31m'
-            self._FOREGROUND_RESET = '\x1b[39m'
-            self._FOREGROUND_YELLOW = '\x1b[33m'
-            self._STYLE_BRIGHT = '\x1b[1m'
-            self._STYLE_DIM = '\x1b[2m'
-            self._STYLE_NORMAL = '\x1b[22m'
-            self._STYLE_RESET_ALL = '\x1b[0m'
-        else:
-            self._FOREGROUND_BLUE = ''
-            self._FOREGROUND_CYAN = ''
-            self._FOREGROUND_GREEN = ''
-            self._FOREGROUND_MAGENTA = ''
-            self._FOREGROUND_RED = ''
-            self._FOREGROUND_RESET = ''
-            self._FOREGROUND_YELLOW = ''
-            self._STYLE_BRIGHT = ''
-            self._STYLE_DIM = ''
-            self._STYLE_NORMAL = ''
-            self._STYLE_RESET_ALL = ''
+        self.renderer = TextRenderer(prefix, self.color)
+        _tracers.add(self)
+        if self.thread_buffers is not None or not self.writes_through:
+            add_exit_callback(write_pending_events)
 
     def __call__(self, function_or_class):
-        if DISABLED:
-            return function_or_class
-
         if inspect.isclass(function_or_class):
             return self._wrap_class(function_or_class)
         else:
@@ -325,11 +549,6 @@ class Tracer:
 
     def _wrap_class(self, cls):
         for attr_name, attr in cls.__dict__.items():
-            # Coroutines are functions, but snooping them is not supported
-            # at the moment
-            if pycompat.iscoroutinefunction(attr):
-                continue
-
             if inspect.isfunction(attr):
                 setattr(cls, attr_name, self._wrap_function(attr))
         return cls
@@ -338,17 +557,25 @@ class Tracer:
         if not self.observed_file:
             self.target_codes.add(function.__code__)
 
+        sampler = self.sampler
+
         @functools.wraps(function)
         def simple_wrapper(*args, **kwargs):
+            if DISABLED or (sampler is not None and not sampler.sample()):
+                return function(*args, **kwargs)
             with self:
                 return function(*args, **kwargs)
 
         @functools.wraps(function)
         def generator_wrapper(*args, **kwargs):
             gen = function(*args, **kwargs)
+            if sampler is None or sampler.sample():
+                context = self
+            else:
+                context = not_snooping
             method, incoming = gen.send, None
             while True:
-                with self:
+                with (not_snooping if DISABLED else context):
                     try:
                         outgoing = method(incoming)
                     except StopIteration:
@@ -359,74 +586,519 @@ class Tracer:
                     method, incoming = gen.throw, e
 
         if pycompat.iscoroutinefunction(function):
-            raise NotImplementedError
-        if pycompat.isasyncgenfunction(function):
-            raise NotImplementedError
+            from . import coroutines
+            self._prepare_for_tasks()
+            return coroutines.wrap_coroutine_function(self, function)
+        elif pycompat.isasyncgenfunction(function):
+            from . import coroutines
+            self._prepare_for_tasks()
+            return coroutines.wrap_async_generator_function(self, function)
         elif inspect.isgeneratorfunction(function):
             return generator_wrapper
         else:
             return simple_wrapper
 
+    def _prepare_for_tasks(self):
+        if self._task_state is None:
+            import contextvars
+            self._task_state = contextvars.ContextVar('task_state')
+            add_exit_callback(write_pending_events)
+        # The event loop shouldn't wait for the output to be written:
+        if self.format == 'text' and not isinstance(self._write, AsyncWriter):
+            self._write = AsyncWriter(self._write, self.queue_size,
+                                      self.overflow or 'drop-oldest')
+
+    def get_task_state(self):
+        '''
+        Get what this tracer keeps about the current task, if a snooped
+        coroutine is running in it, or `None`.
+        '''
+        if self._task_state is None:
+            return None
+        task_state = self._task_state.get(None)
+        # Tasks inherit the context of the task that created them, so the
+        # state in it may be another task's, which isn't running:
+        if task_state is None or not task_state.n_steps:
+            return None
+        return task_state
+
+    def enter_task(self):
+        '''
+        Get the state of the current task, for a snooped coroutine that's
+        starting in it.
+        '''
+        task_state = self.get_task_state()
+        if task_state is None:
+            task_state = TaskState(self.max_state_size,
+                                   thread_global.__dict__.get('depth', -1),
+                                   self.frame_serials)
+            self._task_state.set(task_state)
+            self._task_states.add(task_state)
+        task_state.n_coroutines += 1
+        if self.keep_policy is not None:
+            self.start_invocation(task_state)
+        return task_state
+
+    def exit_task(self, task_state, exc_type=None):
+        if self.keep_policy is not None:
+            self.end_invocation(task_state, exc_type)
+        task_state.n_coroutines -= 1
+        if not task_state.n_coroutines:
+            self.write_task_events(task_state)
+
+    def run_task_step(self, task_state, method, incoming):
+        '''
+        Snoop on `method(incoming)`, a step of a coroutine, with the state of
+        the task it runs in.
+        '''
+        if not task_state.n_steps:
+            thread_depth = thread_global.__dict__.get('depth', -1)
+            thread_global.depth = task_state.depth
+        task_state.n_steps += 1
+        try:
+            with self:
+                return method(incoming)
+        finally:
+            task_state.n_steps -= 1
+            if not task_state.n_steps:
+                task_state.depth = thread_global.depth
+                thread_global.depth = thread_depth
+
+    def write_task_events(self, task_state, blocking=True):
+        '''
+        Write the events that a task emitted, all together. Without
+        `blocking`, give up if another thread is rendering.
+        '''
+        if not task_state.events:
+            return
+        if not self._render_lock.acquire(blocking):
+            return
+        try:
+            task_events, task_state.events = task_state.events, []
+            self.write_events(task_events)
+        finally:
+            self._render_lock.release()
+        self.flush_output()
+
+    def start_invocation(self, state):
+        '''Start holding back the output of `state`, if it isn't yet.'''
+        invocation = state.invocation
+        if invocation is None:
+            invocation = state.invocation = speculation.Invocation()
+        invocation.n_scopes += 1
+
+    def end_invocation(self, state, exc_type=None):
+        '''
+        Leave a scope of the invocation of `state`. When it was the last one,
+        emit the output that was held back, or drop it, as `keep_policy` says.
+        '''
+        invocation = state.invocation
+        invocation.n_scopes -= 1
+        if invocation.n_scopes:
+            return
+        if exc_type is not None:
+            invocation.raised = True
+        state.invocation = None
+        if not self.keep_policy.keeps(invocation):
+            return
+        if type(state) is TaskState:
+            # The task's events are written when it's done with this:
+            state.events.extend(invocation.events)
+        else:
+            for event in invocation.events:
+                self.emit(event)
+
+    def get_thread_state(self):
+        '''
+        Get what this tracer keeps about the current thread, or about the
+        current task when a snooped coroutine is running in it.
+        '''
+        task_state = self.get_task_state()
+        if task_state is not None:
+            return task_state
+        try:
+            return self.thread_local.state
+        except AttributeError:
+            # Threads that `trace_threads` got to didn't enter a scope:
+            thread_global.__dict__.setdefault('depth', -1)
+            state = self.thread_local.state = ThreadState(
+                self.max_state_size, self.frame_serials
+            )
+            return state
+
+    @property
+    def frame_states(self):
+        return self.get_thread_state().frame_states
+
+    @property
+    def target_frames(self):
+        return self.get_thread_state().target_frames
+
     def write(self, s):
-        if not self.call_graph_output_path:
-            s = u'{self.prefix}{s}\n'.format(**locals())
-            self._write(s)
+        self.emit(Event(events.TEXT, 0, data=s))
+
+    def emit(self, event):
+        if self.ring_buffers is not None:
+            self.ring_buffers.get().append(event)
+            return
+        if self.keep_policy is not None:
+            invocation = self.get_thread_state().invocation
+            if invocation is not None:
+                invocation.events.append(event)
+                return
+        task_state = self.get_task_state()
+        if task_state is not None:
+            task_state.events.append(event)
+            if len(task_state.events) >= events.MAX_BUFFERED_EVENTS:
+                self.write_task_events(task_state)
+            return
+        if self.thread_buffers is not None:
+            thread_events = self.thread_buffers.get()
+            thread_events.append(event)
+            if len(thread_events) >= events.MAX_BUFFERED_EVENTS:
+                self.render_threads()
+            return
+        event_buffer = get_event_buffer()
+        if self.writes_through:
+            # Written right away, so it keeps its place among what the program
+            # writes itself, and isn't lost if the process dies abruptly:
+            self.write_events((event,))
+            event_buffer.add_written_sink(self)
+        elif event_buffer.add(self, event):
+            event_buffer.flush()
+
+    def render_threads(self, blocking=True):
+        '''
+        Render and write the events of all the threads, merged by when they
+        happened, with `trace_threads`. Without `blocking`, give up if
+        another thread is at it.
+        '''
+        if not self._render_lock.acquire(blocking):
+            return
+        try:
+            merged_events = self.thread_buffers.drain()
+            if merged_events:
+                self.write_events(merged_events)
+        finally:
+            self._render_lock.release()
+
+    def write_pending_events(self):
+        '''
+        Render and write what's held back for `trace_threads` and for tasks,
+        see `write_pending_events`. Gives up on what's being rendered.
+        '''
+        if self.thread_buffers is not None:
+            self.render_threads(blocking=False)
+        for task_state in list(self._task_states):
+            self.write_task_events(task_state, blocking=False)
+
+    def dump(self, reason='dump()', blocking=True):
+        '''
+        Render and write the events that `flight_recorder` kept, and forget
+        them. Without `blocking`, give up if another thread is at it.
+        '''
+        if self.ring_buffers is None:
+            return
+        if not self._render_lock.acquire(blocking):
+            return
+        try:
+            recorded_events = self.ring_buffers.drain()
+            if recorded_events:
+                header = Event(events.TEXT, 0, data=(
+                    u'......Flight recorder: the last events before '
+                    u'{}......'.format(reason)
+                ))
+                self.write_events([header] + recorded_events)
+        finally:
+            self._render_lock.release()
+        self.flush_output()
+
+    def dump_exception(self, exception):
+        # It's seen again in each frame it passes through:
+        if id(exception) != self._dumped_exception_id:
+            self._dumped_exception_id = id(exception)
+            self.dump('a {}'.format(type(exception).__name__))
+
+    def flush(self):
+        '''
+        Render and write the events that this thread's tracers emitted, or
+        that all threads emitted with `trace_threads`.
+        '''
+        if self.thread_buffers is not None:
+            self.render_threads()
+            self.flush_output()
+        else:
+            event_buffer = get_event_buffer()
+            event_buffer.flush()
+            event_buffer.flush_sinks()
+        join = getattr(self._write, 'join', None)
+        if join is not None:
+            join()
+
+    def flush_output(self):
+        flush = getattr(self._write, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def write_events(self, events):
+        if self.call_graph_output_path:
+            self.write_call_graph()
+        elif self.format == 'binary':
+            self._write.write_events(events)
         else:
-            import json
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            call_graph_output_path = os.path.join(current_dir, self.call_graph_output_path)
-            with open(call_graph_output_path, 'w') as f:
-                json.dump(self.call_infos, f, indent=4)
+            for line in self.renderer.render_lines(events):
+                self._write(line)
+
+    def write_call_graph(self):
+        import json
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        call_graph_output_path = os.path.join(current_dir, self.call_graph_output_path)
+        with open(call_graph_output_path, 'w') as f:
+            json.dump(self.call_infos, f, indent=4)
 
     def __enter__(self):
+        # Snooping may be turned on or off before the scope exits:
+        self.thread_local.__dict__.setdefault('entered', []).append(
+            not DISABLED
+        )
         if DISABLED:
             return
         thread_global.__dict__.setdefault('depth', -1)
+        thread_global.n_scopes = thread_global.__dict__.get('n_scopes', 0) + 1
         calling_frame = inspect.currentframe().f_back
         if not self._is_internal_frame(calling_frame):
-            calling_frame.f_trace = self.trace
+            if self._monitor is None:
+                calling_frame.f_trace = self.get_trace_function()
+                if self.exceptions_only:
+                    calling_frame.f_trace_lines = False
+            elif not self.exceptions_only:
+                self._monitor.trace_frame(self, calling_frame)
             if not self.observed_file:
                 self.target_frames.add(calling_frame)
 
-        stack = self.thread_local.__dict__.setdefault(
-            'original_trace_functions', []
-        )
-        stack.append(sys.gettrace())
         if not self.observed_file:
-            self.start_times[calling_frame] = datetime_module.datetime.now()
-        sys.settrace(self.trace)
+            start_time = datetime_module.datetime.now()
+            self.frame_states.get_or_add(calling_frame).start_time = start_time
+            # Kept apart from the frame's state, which may be evicted:
+            self.thread_local.__dict__.setdefault('start_times', []).append(
+                start_time
+            )
+            if self.keep_policy is not None:
+                self.start_invocation(self.get_thread_state())
+        if self._monitor is None:
+            stack = self.thread_local.__dict__.setdefault(
+                'original_trace_functions', []
+            )
+            stack.append(sys.gettrace())
+            sys.settrace(self.get_trace_function())
+            if self.trace_threads:
+                self._start_tracing_threads()
+        else:
+            self._monitor.push(self)
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        if DISABLED:
+        if not self.thread_local.entered.pop():
             return
-        stack = self.thread_local.original_trace_functions
-        sys.settrace(stack.pop())
+        calling_frame = inspect.currentframe().f_back
+        if self._monitor is None:
+            stack = self.thread_local.original_trace_functions
+            sys.settrace(stack.pop())
+            if self.exceptions_only:
+                calling_frame.f_trace_lines = True
+            if self.trace_threads:
+                self._stop_tracing_threads()
+        else:
+            self._monitor.pop(self, calling_frame)
         if not self.observed_file:
-            calling_frame = inspect.currentframe().f_back
             self.target_frames.discard(calling_frame)
-            self.frame_to_local_reprs.pop(calling_frame, None)
+            self.frame_states.release(calling_frame)
 
             ### Writing elapsed time: #############################################
             #                                                                     #
-            _FOREGROUND_YELLOW = self._FOREGROUND_YELLOW
-            _STYLE_DIM = self._STYLE_DIM
-            _STYLE_NORMAL = self._STYLE_NORMAL
-            _STYLE_RESET_ALL = self._STYLE_RESET_ALL
-
-            start_time = self.start_times.pop(calling_frame)
+            start_time = self.thread_local.start_times.pop()
             duration = datetime_module.datetime.now() - start_time
-            elapsed_time_string = pycompat.timedelta_format(duration)
-            indent = ' ' * 4 * (thread_global.depth + 1)
-            self.write(
-                '{indent}{_FOREGROUND_YELLOW}{_STYLE_DIM}'
-                'Elapsed time: {_STYLE_NORMAL}{elapsed_time_string}'
-                '{_STYLE_RESET_ALL}'.format(**locals())
-            )
+            depth = thread_global.depth + 1
+            self.emit(Event(events.ELAPSED_TIME, depth, data=duration))
                                                                                 #
             ## Finished writing elapsed time. ####################################
+            self.write_notes(depth)
+            if self.keep_policy is not None:
+                self.end_invocation(self.get_thread_state(), exc_type)
+        thread_global.n_scopes -= 1
+        if self.thread_buffers is not None:
+            if not thread_global.n_scopes:
+                self.render_threads()
+                self.flush_output()
+            return
+        event_buffer = get_event_buffer()
+        event_buffer.flush()
+        if not thread_global.n_scopes:
+            # Buffered output is only written when the snooped code is done:
+            event_buffer.flush_sinks()
+
+    def _start_tracing_threads(self):
+        with self._thread_trace_lock:
+            if not self._n_thread_scopes:
+                self._original_thread_trace = pycompat.get_thread_trace()
+                threading.settrace(self.get_trace_function())
+            self._n_thread_scopes += 1
+
+    def _stop_tracing_threads(self):
+        with self._thread_trace_lock:
+            self._n_thread_scopes -= 1
+            if not self._n_thread_scopes:
+                threading.settrace(self._original_thread_trace)
+                self._original_thread_trace = None
+
+    def get_trace_function(self):
+        '''The function to trace with under `sys.settrace`.'''
+        return self.trace_exceptions if self.exceptions_only else self.trace
 
     def _is_internal_frame(self, frame):
-        return frame.f_code.co_filename == Tracer.__enter__.__code__.co_filename
+        return frame.f_code.co_filename in internal_file_names
+
+    def wants_call_events(self, code):
+        '''Whether `trace` may ever act on a frame running `code`.'''
+        if self.observed_file or self.depth > 1 or self.depth_expanded:
+            # Any code could be called from a snooped frame.
+            return True
+        return code in self.target_codes
+
+    def wants_line_events(self, frame):
+        '''Whether `trace` may print line events for frames like `frame`.'''
+        code = frame.f_code
+        if code in self.target_codes or frame in self.target_frames:
+            return True
+        if self.scope_index is not None and \
+                         self.scope_index.get_verdict(code) is not OUT_OF_SCOPE:
+            return True
+        # Callees get their lines traced down to `depth - 1` levels below a
+        # snooped frame, the level below that only gets call/return events:
+        candidate = frame
+        for _ in range(1, self.depth):
+            candidate = candidate.f_back
+            if candidate is None:
+                return False
+            if candidate.f_code in self.target_codes or \
+                                              candidate in self.target_frames:
+                return True
+        return False
+
+    def wants_line(self, code, line_no):
+        '''Whether `trace` may print a line event for `code` at `line_no`.'''
+        if self.scope_index is not None and self.depth == 1 and \
+                                                code not in self.target_codes:
+            verdict = self.scope_index.get_verdict(code)
+            if verdict is OUT_OF_SCOPE:
+                return code.co_filename != self.observed_file
+            return self.start_line <= line_no <= self.end_line
+        return True
+
+    def sees_all_lines(self, code):
+        '''Whether all the line events of `code` get to `trace`.'''
+        return self._monitor is None or self.scope_index is None or \
+               self.depth != 1 or code in self.target_codes or \
+               self.scope_index.get_verdict(code) is IN_SCOPE
+
+    def sees_all_calls(self):
+        '''Whether the call events of any code get to `trace`, like the ones
+        of a property that a line reads.'''
+        return self._monitor is None or self.observed_file is not None or \
+               self.depth > 1 or self.depth_expanded
+
+    def get_dirty_names(self, frame, event, repr_cache):
+        '''
+        Get the names of the variables that may have changed since the ones of
+        `frame` were last repr'd, or `None` if all of them have to be checked.
+
+        That's only known when the last repr was taken on the previous event
+        that this tracer got, at the start of a line that can only change the
+        variables it stores. Otherwise lines may have run in between unseen.
+        '''
+        if event != 'line' or \
+              repr_cache.event_index != self.get_thread_state().event_count - 1:
+            return None
+        code = frame.f_code
+        if not self.sees_all_lines(code):
+            return None
+        names = get_code_info(code).get_line_stores(
+            self.sees_all_calls()
+        ).get(repr_cache.line_no)
+        if names is None or not names.isdisjoint(self.watch_names):
+            return None
+        return names
+
+    def get_frame_loops(self, frame, frame_state):
+        if frame_state.loops is None:
+            code_info = get_code_info(frame.f_code)
+            if code_info.path_and_source is None:
+                code_info.path_and_source = \
+                                          get_path_and_source_from_frame(frame)
+            frame_state.loops = FrameLoops(code_info.get_loops(), self.loop,
+                                           self.spec_loop_time)
+        return frame_state.loops
+
+    def is_frame_shown(self, frame):
+        '''Whether the last event of `frame` was shown, see `FrameLoops`.'''
+        frame_state = self.frame_states.get(frame)
+        return frame_state is None or frame_state.loops is None or \
+                                                      frame_state.loops.shown
+
+    def is_line_suppressed(self, frame, line_no):
+        '''
+        Whether line events of `frame` at `line_no` are of no use until the
+        frame leaves the loop it's in, see `FrameLoops`.
+        '''
+        frame_state = self.frame_states.get(frame)
+        if frame_state is None or frame_state.loops is None:
+            return False
+        suppressed_lines = frame_state.loops.suppressed_lines
+        return suppressed_lines is not None and line_no in suppressed_lines
+
+    def resume_lines(self, frame_state):
+        '''Get line events again after a frame left a suppressed loop.'''
+        if frame_state.repr_cache is not None:
+            # The lines that ran unseen may have changed any variable:
+            frame_state.repr_cache.event_index = None
+        if self._monitor is not None:
+            self._monitor.restart_events()
+
+    def forget_stale_state(self, state, frame):
+        '''
+        Forget the state that a new frame found under its id, which is left
+        from an earlier frame of the same code that never got a return event,
+        like a generator that wasn't run to the end while snooping.
+        '''
+        if state.frame_states.get(frame) is not None and \
+                               get_code_info(frame.f_code).is_starting(frame):
+            state.frame_states.release(frame)
+
+    def release_frame(self, frame):
+        '''Forget the state of `frame`, unless it's only suspended.'''
+        if get_code_info(frame.f_code).is_yielding(frame):
+            frame_state = self.frame_states.get(frame)
+            if frame_state is not None:
+                frame_state.forget_locals()
+                self.frame_states.account(frame, frame_state)
+        else:
+            self.frame_states.release(frame)
+
+    def get_thread_info(self):
+        thread_info = ""
+        if self.thread_info:
+            if self.normalize:
+                raise NotImplementedError("normalize is not supported with "
+                                          "thread_info")
+            current_thread = threading.current_thread()
+            thread_info = "{ident}-{name} ".format(
+                ident=current_thread.ident, name=current_thread.name)
+        return self.set_thread_info_padding(thread_info)
+
+    def format_exception(self, exc_info):
+        exception = '\n'.join(traceback.format_exception_only(*exc_info[:2])).strip()
+        if self.max_variable_length:
+            exception = utils.truncate(exception, self.max_variable_length)
+        return exception
 
     def set_thread_info_padding(self, thread_info):
         current_thread_len = len(thread_info)
@@ -435,45 +1107,40 @@ class Tracer:
         return thread_info.ljust(self.thread_info_padding)
 
     def trace(self, frame, event, arg): 
+        state = self.get_thread_state()
+        state.event_count += 1
+        if event == 'line' and self.is_line_suppressed(frame, frame.f_lineno):
+            return self.trace
+        if event == 'call':
+            self.forget_stale_state(state, frame)
         if self.observed_file:
-            if len(self.target_frames) == 0:
-                frame_file_name = frame.f_code.co_filename
-                if frame_file_name == self.observed_file:
-                    with open(frame_file_name, 'r') as f:
-                        source = f.read().splitlines()
-                    line_no = frame.f_lineno
-                    source_line = source[line_no - 1]
-                    if event == 'call' and source_line.lstrip().startswith('@'):
-                        for candidate_line_no in itertools.count(line_no):
-                            try:
-                                candidate_source_line = source[candidate_line_no - 1]
-                            except IndexError:
-                                break
-                            if candidate_source_line.lstrip().startswith('def'):
-                                # Found the def line!
-                                line_no = candidate_line_no
-                                break                    
-                    if self.start_line <= line_no <= self.end_line:
-                        self.target_frames.add(frame)
-                        self.start_times[frame] = datetime_module.datetime.now()
-                        thread_global.depth = 0
-                    else:
-                        return self.trace
+            if len(state.target_frames) == 0:
+                if self.is_in_code_scope(frame, event):
+                    state.target_frames.add(frame)
+                    state.frame_states.get_or_add(frame).start_time = \
+                                                 datetime_module.datetime.now()
+                    thread_global.depth = 0
+                    if self.keep_policy is not None and \
+                                                  state.invocation is None:
+                        self.start_invocation(state)
                 else:
                     return self.trace
-            elif frame not in self.target_frames and self.is_in_code_scope(frame, event):
-                if frame not in self.start_times:
-                    self.start_times[frame] = datetime_module.datetime.now() 
-                self.target_frames.add(frame)
+            elif frame not in state.target_frames and self.is_in_code_scope(frame, event):
+                frame_state = state.frame_states.get_or_add(frame)
+                if frame_state.start_time is None:
+                    frame_state.start_time = datetime_module.datetime.now()
+                state.target_frames.add(frame)
 
-            elif frame in self.target_frames and not self.is_in_code_scope(frame, event):
+            elif frame in state.target_frames and not self.is_in_code_scope(frame, event):
                 if event == 'return' or event == 'exception':
                     thread_global.depth -= 1
-                    self.target_frames.discard(frame)
+                    state.target_frames.discard(frame)
+                if event == 'return':
+                    self.release_frame(frame)
                 return self.trace
 
-        self.is_in_expanded_status = False
-        if not (frame.f_code in self.target_codes or frame in self.target_frames):
+        state.is_in_expanded_status = False
+        if not (frame.f_code in self.target_codes or frame in state.target_frames):
             if self._is_internal_frame(frame):
                 return None
 
@@ -483,56 +1150,64 @@ class Tracer:
                 _frame_candidate = _frame_candidate.f_back
                 if _frame_candidate is None:
                     return self.trace
-                elif _frame_candidate.f_code in self.target_codes or (_frame_candidate in self.target_frames and self.is_in_code_scope(_frame_candidate, event)):
+                elif _frame_candidate.f_code in self.target_codes or (_frame_candidate in state.target_frames and self.is_in_code_scope(_frame_candidate, event)):
                     if self.loop:
-                        if self.is_skip_loop(_frame_candidate, max_loop_times = self.loop + 1):
-                            if self.call_graph_output_path and event == 'call' and not self.is_last_call_skip:
+                        if not self.is_frame_shown(_frame_candidate):
+                            if self.call_graph_output_path and event == 'call' and not state.is_last_call_skip:
                                 self.call_infos.append({'depth': thread_global.depth + 1,
                                                         'content': ['......Skipping repeated (loop) calling details......'],
                                                         })
-                                self.is_last_call_skip = True
+                                state.is_last_call_skip = True
                             return None
                     if self.depth_expanded:
                         if i == back_depth - 1:
                             if event != 'call' and event != 'return' and event != 'exception':
                                 return self.trace
-                            self.is_in_expanded_status = True
+                            state.is_in_expanded_status = True
                         else:
-                            self.is_in_expanded_status = False
+                            state.is_in_expanded_status = False
                     break
             else:
                 return self.trace
 
-        indent = ' ' * 4 * thread_global.depth
-        _FOREGROUND_BLUE = self._FOREGROUND_BLUE
-        _FOREGROUND_CYAN = self._FOREGROUND_CYAN
-        _FOREGROUND_GREEN = self._FOREGROUND_GREEN
-        _FOREGROUND_MAGENTA = self._FOREGROUND_MAGENTA
-        _FOREGROUND_RED = self._FOREGROUND_RED
-        _FOREGROUND_RESET = self._FOREGROUND_RESET
-        _FOREGROUND_YELLOW = self._FOREGROUND_YELLOW
-        _STYLE_BRIGHT = self._STYLE_BRIGHT
-        _STYLE_DIM = self._STYLE_DIM
-        _STYLE_NORMAL = self._STYLE_NORMAL
-        _STYLE_RESET_ALL = self._STYLE_RESET_ALL
-
+        frame_state = state.frame_states.get_or_add(frame)
         if self.loop:
-            if event != 'return' and event != 'exception':
-                if self.is_skip_loop(frame):
-                    self.record_frame_line_executed(frame)
-                    if not self.is_last_skip:
-                        self.write(u'{indent}{_FOREGROUND_BLUE}{_STYLE_DIM}......Skipping repeated execution details......{_STYLE_RESET_ALL}'.format(**locals()))
-                        self.is_last_skip = True
+            if event != 'return':
+                frame_loops = self.get_frame_loops(frame, frame_state)
+                if event == 'line':
+                    shown = frame_loops.update(frame.f_lineno)
+                    if frame_loops.left_suppressed_lines:
+                        self.resume_lines(frame_state)
+                elif event == 'call':
+                    shown = frame_loops.update_call(frame.f_lineno)
+                else:
+                    # An exception is shown if the line it's raised on is.
+                    shown = frame_loops.shown
+                if not shown:
+                    if event == 'exception':
+                        # It's still shown if it ends the frame:
+                        frame_state.exception = (frame.f_lineno,
+                                                 self.get_thread_info(), arg)
+                        if self.dump_on and issubclass(arg[0], self.dump_on):
+                            self.dump_exception(arg[1])
+                    if not state.is_last_skip:
+                        self.emit(Event(events.SKIPPED, thread_global.depth,
+                                        code=frame.f_code,
+                                        serial=frame_state.serial))
+                        state.is_last_skip = True
+                    if event == 'call':
+                        # The return event that matches it is still shown.
+                        thread_global.depth += 1
                     return self.trace
                 else:
-                    self.is_last_skip = False
-                    self.record_frame_line_executed(frame)        
+                    state.is_last_skip = False
+                    frame_state.exception = None
         #                                                                     #
         ### Finished checking whether we should trace this line. ##############
         if event == 'call':
             thread_global.depth += 1
 
-        indent = ' ' * 4 * thread_global.depth
+        depth = thread_global.depth
 
 
         ### Making timestamp: #################################################
@@ -540,10 +1215,9 @@ class Tracer:
         if self.normalize:
             timestamp = ' ' * 15
         elif self.relative_time:
-            try:
-                start_time = self.start_times[frame]
-            except KeyError:
-                start_time = self.start_times[frame] = \
+            start_time = frame_state.start_time
+            if start_time is None:
+                start_time = frame_state.start_time = \
                                                  datetime_module.datetime.now()
             duration = datetime_module.datetime.now() - start_time
             timestamp = pycompat.timedelta_format(duration)
@@ -556,142 +1230,145 @@ class Tracer:
         ### Finished making timestamp. ########################################
 
         line_no = frame.f_lineno
-        source_path, source = get_path_and_source_from_frame(frame)
+        code_info = get_code_info(frame.f_code)
+        if code_info.path_and_source is None:
+            code_info.path_and_source = get_path_and_source_from_frame(frame)
+        source_path, source = code_info.path_and_source
         source_path = source_path if not self.normalize else os.path.basename(source_path)
-        if self.last_source_path != source_path:
-            self.write(u'{_FOREGROUND_YELLOW}{_STYLE_DIM}{indent}Source path:... '
-                       u'{_STYLE_NORMAL}{source_path}'
-                       u'{_STYLE_RESET_ALL}'.format(**locals()))
-            self.last_source_path = source_path
+        if state.last_source_path != source_path:
+            self.emit(Event(events.SOURCE_PATH, depth, code=frame.f_code,
+                            data=source_path, serial=frame_state.serial))
+            state.last_source_path = source_path
         source_line = source[line_no - 1]
-        thread_info = ""
-        if self.thread_info:
-            if self.normalize:
-                raise NotImplementedError("normalize is not supported with "
-                                          "thread_info")
-            current_thread = threading.current_thread()
-            thread_info = "{ident}-{name} ".format(
-                ident=current_thread.ident, name=current_thread.name)
-        thread_info = self.set_thread_info_padding(thread_info)
+        thread_info = self.get_thread_info()
 
         ### Reporting newish and modified variables: ##########################
         #                                                                     #
-        old_local_reprs = self.frame_to_local_reprs.get(frame, {})
-        self.frame_to_local_reprs[frame] = local_reprs = \
+        repr_cache = frame_state.repr_cache
+        if repr_cache is None:
+            repr_cache = frame_state.repr_cache = ReprCache(
+                self.custom_repr, self.max_variable_length, self.normalize,
+                self.repr_guard
+            )
+        dirty_names = self.get_dirty_names(frame, event, repr_cache)
+        if dirty_names is not None and frame_state.local_reprs is not None:
+            old_local_reprs, local_reprs = update_local_reprs(
+                frame, dirty_names, frame_state.local_reprs, repr_cache
+            )
+        else:
+            old_local_reprs = frame_state.local_reprs or {}
+            frame_state.local_reprs = local_reprs = \
                                        get_local_reprs(frame,
                                                        watch=self.watch, custom_repr=self.custom_repr,
                                                        max_length=self.max_variable_length,
                                                        normalize=self.normalize,
+                                                       repr_cache=repr_cache,
+                                                       repr_guard=self.repr_guard,
                                                        )
+        repr_cache.line_no = frame.f_lineno
+        repr_cache.event_index = state.event_count
+        state.frame_states.account(frame, frame_state)
 
-        newish_string = ('Starting var:.. ' if event == 'call' else
-                                                            'New var:....... ')
         
-        if not self.is_in_expanded_status or event == 'call': 
-            input_para_string = ''
-            modify_var_string = ''
+        if not state.is_in_expanded_status or event == 'call': 
+            new_var_reprs = []
+            modified_var_reprs = []
             for name, value_repr in local_reprs.items():
                 if name not in old_local_reprs:
-                    input_para_string += f'{name} = {value_repr},    '
-                    
-
+                    new_var_reprs.append((name, value_repr))
                 elif old_local_reprs[name] != value_repr:
-                    modify_var_string += f'{name} = {value_repr}, '
+                    modified_var_reprs.append((name, value_repr))
             
-            if input_para_string:
-                input_para_string = input_para_string.rstrip().strip(',')
-                if len(input_para_string) > 200:
-                    input_para_string = input_para_string[:94] + ' ......'
-                self.write('{indent}{_FOREGROUND_GREEN}{_STYLE_DIM}'
-                        '{newish_string}{_STYLE_NORMAL}{input_para_string}{_STYLE_RESET_ALL}'.format(**locals()))
+            if new_var_reprs:
+                self.emit(Event(events.STARTING_VARS if event == 'call' else
+                                events.NEW_VARS, depth, code=frame.f_code,
+                                data=new_var_reprs, serial=frame_state.serial))
                 
-            if modify_var_string:
-                modify_var_string = modify_var_string.rstrip().strip(',')
-                if len(modify_var_string) > 200:
-                    modify_var_string = modify_var_string[:94] + ' ......'
-                self.write('{indent}{_FOREGROUND_GREEN}{_STYLE_DIM}'
-                        'Modified var:.. {_STYLE_NORMAL}{modify_var_string}{_STYLE_RESET_ALL}'.format(**locals()))
+            if modified_var_reprs:
+                self.emit(Event(events.MODIFIED_VARS, depth, code=frame.f_code,
+                                data=modified_var_reprs,
+                                serial=frame_state.serial))
 
 
 
-        if event == 'call' and source_line.lstrip().startswith('@'):
-            for candidate_line_no in itertools.count(line_no):
-                try:
-                    candidate_source_line = source[candidate_line_no - 1]
-                except IndexError:
-                    break
+        if event == 'call':
+            line_no = code_info.get_call_line(source, line_no)
+            source_line = source[line_no - 1]
 
-                if candidate_source_line.lstrip().startswith('def'):
-                    # Found the def line!
-                    line_no = candidate_line_no
-                    source_line = candidate_source_line
-                    break
-                
-        code_byte = frame.f_code.co_code[frame.f_lasti]
-        if not isinstance(code_byte, int):
-            code_byte = ord(code_byte)
         ended_by_exception = (
                 event == 'return'
                 and arg is None
-                and opcode.opname[code_byte] not in RETURN_OPCODES
+                and code_info.is_ended_by_exception(frame)
         )
 
         if ended_by_exception:
-            self.write('{_FOREGROUND_RED}{indent}Call ended by exception{_STYLE_RESET_ALL}'.
-                       format(**locals()))
+            if frame_state.exception is not None:
+                # The exception that ended the frame wasn't shown when it was
+                # raised, past the shown iterations of a loop:
+                exception_line_no, exception_thread_info, exc_info = \
+                                                          frame_state.exception
+                self.emit(Event('exception', depth, exception_line_no,
+                                frame.f_code, exception_thread_info,
+                                serial=frame_state.serial))
+                self.emit(Event(events.EXCEPTION_VALUE, depth,
+                                code=frame.f_code,
+                                data=self.format_exception(exc_info),
+                                serial=frame_state.serial))
+                # Like an exception that was shown when it was raised:
+                thread_global.depth -= 1
+                depth = thread_global.depth
+            self.emit(Event(events.CALL_ENDED_BY_EXCEPTION, depth,
+                            code=frame.f_code, serial=frame_state.serial))
         else:
-            self.write(u'{indent}{_STYLE_DIM}{thread_info}{event:9} '
-                       u'{line_no:4}{_STYLE_RESET_ALL} {source_line}'.format(**locals()))
+            self.emit(Event(event, depth, line_no, frame.f_code, thread_info,
+                            serial=frame_state.serial))
 
-        if self.is_in_expanded_status and event == 'call':
-            self.write(u'{indent}{_STYLE_DIM}{thread_info}{_STYLE_RESET_ALL}{padding}... (function body omitted)'
-           .format(indent=indent, _STYLE_DIM=_STYLE_DIM, thread_info=thread_info, event=event,padding = ' '*4,  _STYLE_RESET_ALL=_STYLE_RESET_ALL))
+        if state.is_in_expanded_status and event == 'call':
+            self.emit(Event(events.BODY_OMITTED, depth, code=frame.f_code,
+                            thread_info=thread_info,
+                            serial=frame_state.serial))
 
 
         if not ended_by_exception:
+            if frame.f_code.co_flags & inspect.CO_ASYNC_GENERATOR:
+                arg = pycompat.unwrap_async_generator_value(arg)
             return_value_repr = utils.get_shortish_repr(arg,
                                                         custom_repr=self.custom_repr,
                                                         max_length=self.max_variable_length,
                                                         normalize=self.normalize,
+                                                        repr_guard=self.repr_guard,
                                                         )
         ## if enable call graph
         if self.call_graph_output_path:
             if event == 'call':
-                if frame not in self.call_frames:
-                    self.call_frames[frame] = []
-                result_str_lst = self.call_frames[frame]
+                if frame_state.call_info is None:
+                    frame_state.call_info = []
+                result_str_lst = frame_state.call_info
                 
                 self.call_infos.append({'depth': thread_global.depth,
                                             'content': result_str_lst,
                     })
                 
-                self.is_last_call_skip = False
+                state.is_last_call_skip = False
                 
 
                 result_str_lst.append(f'Call ... {source_line}')
                 result_str_lst.append(f'Source path:... {source_path}')
 
-                input_para_string = 'Starting var:.. '
-                
-                for name, value_repr in local_reprs.items():
-                    if name not in old_local_reprs:
-                        input_para_string += ('{name} = '
-                                '{value_repr}, '.format(**locals()))
-
-                input_para_string = input_para_string.rstrip().strip(',')
-                if len(input_para_string) > 100:
-                    input_para_string = input_para_string[:94] + ' ......'
+                input_para_string = format_var_reprs(
+                    ((name, value_repr)
+                     for name, value_repr in local_reprs.items()
+                     if name not in old_local_reprs),
+                    ', ', prefix='Starting var:.. ', max_length=100
+                )
                 
                 if input_para_string != 'Starting var:..':
                     result_str_lst.append(input_para_string)
                 
                 
-            if event == 'return':
-                if frame not in self.call_frames:
-                    # raise Exception(f'Frame in file {frame.f_code.co_filename}-{frame.f_lineno} not found in call_frames.')
-                    print(f'Frame in file {frame.f_code.co_filename}-{frame.f_lineno} not found in call_frames.')
-                    return self.trace
-                result_str_lst = self.call_frames[frame]
+            # The call isn't there when the frame's state had to be dropped:
+            if event == 'return' and frame_state.call_info is not None:
+                result_str_lst = frame_state.call_info
                 if ended_by_exception:
                     result_str_lst.append('Call ended by exception')
                 else:
@@ -702,79 +1379,114 @@ class Tracer:
 
 
         if event == 'return':
-            if not self.observed_file or frame not in self.target_frames:
-                self.frame_to_local_reprs.pop(frame, None)
-                self.start_times.pop(frame, None)
+            if not self.observed_file or frame not in state.target_frames:
+                frame_state.forget_locals()
             thread_global.depth -= 1
 
             if not ended_by_exception:
-                self.write('{indent}{_FOREGROUND_CYAN}{_STYLE_DIM}'
-                           'Return value:.. {_STYLE_NORMAL}{return_value_repr}'
-                           '{_STYLE_RESET_ALL}'.
-                           format(**locals()))
+                self.emit(Event(events.RETURN_VALUE, depth, code=frame.f_code,
+                                data=return_value_repr,
+                                serial=frame_state.serial))
+            if state.invocation is not None and \
+                                  (frame.f_code in self.target_codes or
+                                   frame in state.target_frames):
+                state.invocation.set_outcome(ended_by_exception, arg)
             
             if self.observed_file:
-                if frame in self.target_frames:
+                if frame in state.target_frames:
                     self.manual_exit(frame)
+                    if state.invocation is not None and \
+                                                     not state.target_frames:
+                        self.end_invocation(state)
+            self.release_frame(frame)
 
         if event == 'exception':
             thread_global.depth -= 1
-            exception = '\n'.join(traceback.format_exception_only(*arg[:2])).strip()
-            if self.max_variable_length:
-                exception = utils.truncate(exception, self.max_variable_length)
-            self.write('{indent}{_FOREGROUND_RED}Exception:..... '
-                       '{_STYLE_BRIGHT}{exception}'
-                       '{_STYLE_RESET_ALL}'.format(**locals()))
+            self.emit(Event(events.EXCEPTION_VALUE, depth, code=frame.f_code,
+                            data=self.format_exception(arg),
+                            serial=frame_state.serial))
+            if self.dump_on and issubclass(arg[0], self.dump_on):
+                self.dump_exception(arg[1])
             if self.observed_file:
-                if frame in self.target_frames:
+                if frame in state.target_frames:
                     self.manual_exit(frame)
 
         return self.trace
 
+    def trace_exceptions(self, frame, event, arg):
+        '''
+        The trace function with `exceptions_only`: frames in the snooped scope
+        are traced without line events, and only their exceptions are shown.
+        '''
+        if event == 'call':
+            if self._is_internal_frame(frame) or \
+                                            not self.wants_line_events(frame):
+                return None
+            frame.f_trace_lines = False
+        elif event == 'exception':
+            self.report_exception(frame, arg)
+        return self.trace_exceptions
+
+    def report_exception(self, frame, exc_info):
+        '''
+        Show the exception that got to `frame`, with the frame's locals as
+        they are now, when it has to be shown.
+        '''
+        line_no = frame.f_lineno
+        if not self.wants_line(frame.f_code, line_no):
+            return
+        state = self.get_thread_state()
+        code_info = get_code_info(frame.f_code)
+        if code_info.path_and_source is None:
+            code_info.path_and_source = get_path_and_source_from_frame(frame)
+        source_path = code_info.path_and_source[0]
+        if self.normalize:
+            source_path = os.path.basename(source_path)
+        if state.last_source_path != source_path:
+            self.emit(Event(events.SOURCE_PATH, 0, code=frame.f_code,
+                            data=source_path))
+            state.last_source_path = source_path
+        local_reprs = get_local_reprs(frame, watch=self.watch,
+                                      custom_repr=self.custom_repr,
+                                      max_length=self.max_variable_length,
+                                      normalize=self.normalize,
+                                      repr_guard=self.repr_guard)
+        if local_reprs:
+            self.emit(Event(events.LOCALS, 0, code=frame.f_code,
+                            data=list(local_reprs.items())))
+        self.emit(Event('exception', 0, line_no, frame.f_code,
+                        self.get_thread_info()))
+        self.emit(Event(events.EXCEPTION_VALUE, 0, code=frame.f_code,
+                        data=self.format_exception(exc_info)))
+        if self.dump_on and issubclass(exc_info[0], self.dump_on):
+            self.dump_exception(exc_info[1])
+
     def manual_exit(self, frame):
         self.target_frames.discard(frame)
         
-        self.frame_to_local_reprs.pop(frame, None)
-        ### Writing elapsed time: #############################################
-        #                                                                     #
-        _FOREGROUND_YELLOW = self._FOREGROUND_YELLOW
-        _STYLE_DIM = self._STYLE_DIM
-        _STYLE_NORMAL = self._STYLE_NORMAL
-        _STYLE_RESET_ALL = self._STYLE_RESET_ALL
-
-        start_time = self.start_times.pop(frame, None)
-        duration = datetime_module.datetime.now() - start_time
-        elapsed_time_string = pycompat.timedelta_format(duration)
-        indent = ' ' * 4 * (thread_global.depth)
-        # self.write(
-        #     '{indent}{_FOREGROUND_YELLOW}{_STYLE_DIM}'
-        #     'Elapsed time: {_STYLE_NORMAL}{elapsed_time_string}'
-        #     '{_STYLE_RESET_ALL}'.format(**locals())
-        # )
+        frame_state = self.frame_states.get(frame)
+        if frame_state is not None:
+            frame_state.forget_locals()
+        self.write_notes(thread_global.depth)
+
+    def write_notes(self, depth):
+        '''Write about the reprs and frame states that had to be dropped.'''
+        n_evictions = self.frame_states.pop_new_evictions()
+        if n_evictions:
+            self.emit(Event(events.STATES_DROPPED, depth,
+                            data=(n_evictions, self.frame_states.max_size)))
+        if self.repr_guard is None:
+            return
+        for item_type, reason in self.repr_guard.pop_new_demotions():
+            type_name = '{}.{}'.format(item_type.__module__,
+                                       item_type.__qualname__)
+            self.emit(Event(events.REPR_SUPPRESSED, depth,
+                            data=(type_name, reason)))
     
     def is_in_code_scope(self, frame, event):
-        frame_file_name = frame.f_code.co_filename
-        if not os.path.exists(frame_file_name):
+        if self.scope_index is None:
             return False
-        with open(frame_file_name, 'r') as f:
-            source = f.read().splitlines()
-        line_no = frame.f_lineno
-        source_line = source[line_no - 1]
-        if event == 'call' and source_line.lstrip().startswith('@'):
-            for candidate_line_no in itertools.count(line_no):
-                try:
-                    candidate_source_line = source[candidate_line_no - 1]
-                except IndexError:
-                    break
-                if candidate_source_line.lstrip().startswith('def'):
-                    # Found the def line!
-                    line_no = candidate_line_no
-                    break                    
-        if self.observed_file:
-            if frame_file_name == self.observed_file:
-                if self.start_line <= line_no <= self.end_line:
-                    return True
-        return False
+        return self.scope_index.is_in_scope(frame, event)
 
 
             # if curr_fline_event_cnt[key] == total_fline_event_cnt[key] or curr_fline_event_cnt[key] <= self.loop:
@@ -784,25 +1496,3 @@ class Tracer:
             #     if not is_last_skip:
             #         self._write(f'\n\t...Skipping repeated(loop) execution details...\n\n')
             #         is_last_skip = True
-                
-    def is_skip_loop(self, frame, max_loop_times = None):
-        looped_times = 0
-        max_loop_times = max_loop_times if max_loop_times is not None else self.loop
-        
-        if frame in self.frame_line_executed and frame.f_lineno in self.frame_line_executed[frame]:
-            looped_times = self.frame_line_executed[frame][frame.f_lineno]
-        else:
-            return False
-        if looped_times >= max_loop_times:
-            if self.spec_loop_time:
-                if looped_times == self.spec_loop_time - 1:
-                    return False
-            return True
-        return False
-
-    def record_frame_line_executed(self, frame):
-        if frame not in self.frame_line_executed:
-            self.frame_line_executed[frame] = {}
-        if frame.f_lineno not in self.frame_line_executed[frame]:
-            self.frame_line_executed[frame][frame.f_lineno] = 0
-        self.frame_line_executed[frame][frame.f_lineno] += 1
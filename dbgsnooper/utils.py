@@ -2,9 +2,19 @@
 # This program is distributed under the MIT license.
 
 import abc
+import collections
 import re
-
+import signal
 import sys
+import threading
+try:
+    from time import perf_counter as timer
+except ImportError: # Python 2
+    from time import time as timer
+try:
+    import dataclasses
+except ImportError:
+    dataclasses = None
 from .pycompat import ABC, string_types, collections_abc
 
 def _check_methods(C, *methods):
@@ -47,7 +57,92 @@ def shitcode(s):
     )
 
 
+class ReprResolver(object):
+    '''
+    A `custom_repr` that's compiled for finding the repr functions of many
+    items.
+
+    Conditions that are types are resolved once per type of item, by the first
+    one that the type is a subclass of. That's only memoized by type, so it
+    can't depend on the item. Predicates, which may look at the item, are
+    still called for each item, but only the ones that come before that type
+    condition, so the first condition that matches wins like in
+    `get_repr_function`.
+
+    Registering a class with an ABC (`ABC.register`) drops the memo, so a
+    type condition that's an ABC picks up classes that were registered after
+    tracing started. An ABC whose `__subclasshook__` gives another answer
+    later for the same class, without a registration, isn't picked up, like
+    `issubclass` itself caches it.
+
+    Items whose `__class__` isn't their type, like mocks with a `spec` and
+    proxies, are resolved with `isinstance` every time, since that looks at
+    their `__class__` too.
+
+    Iterating on it gives the original `(condition, action)` pairs.
+    '''
+    def __init__(self, custom_repr=()):
+        self.custom_repr = tuple(custom_repr)
+        self.type_conditions = []
+        self.predicates = []
+        for index, (condition, action) in enumerate(self.custom_repr):
+            if isinstance(condition, type):
+                self.type_conditions.append((index, condition, action))
+            else:
+                self.predicates.append((index, condition, action))
+        self._type_resolutions = {}
+        self._has_abcs = any(isinstance(condition, abc.ABCMeta)
+                             for _, condition, _ in self.type_conditions)
+        self._abc_cache_token = abc.get_cache_token()
+
+    def __iter__(self):
+        return iter(self.custom_repr)
+
+    def __len__(self):
+        return len(self.custom_repr)
+
+    def _resolve_type(self, item_type):
+        for index, condition, action in self.type_conditions:
+            if issubclass(item_type, condition):
+                return index, action
+        return len(self.custom_repr), repr
+
+    def _resolve_instance(self, item):
+        for index, condition, action in self.type_conditions:
+            if isinstance(item, condition):
+                return index, action
+        return len(self.custom_repr), repr
+
+    def get_repr_function(self, item):
+        item_type = type(item)
+        if self._has_abcs and \
+                            self._abc_cache_token != abc.get_cache_token():
+            # A class was registered with an ABC since:
+            self._type_resolutions.clear()
+            self._abc_cache_token = abc.get_cache_token()
+        try:
+            is_proxy = item.__class__ is not item_type
+        except Exception:
+            is_proxy = False
+        if is_proxy:
+            type_index, type_action = self._resolve_instance(item)
+        else:
+            try:
+                type_index, type_action = self._type_resolutions[item_type]
+            except KeyError:
+                type_index, type_action = self._type_resolutions[item_type] = \
+                                                  self._resolve_type(item_type)
+        for index, predicate, action in self.predicates:
+            if index > type_index:
+                break
+            if predicate(item):
+                return action
+        return type_action
+
+
 def get_repr_function(item, custom_repr):
+    if isinstance(custom_repr, ReprResolver):
+        return custom_repr.get_repr_function(item)
     for condition, action in custom_repr:
         if isinstance(condition, type):
             condition = lambda x, y=condition: isinstance(x, y)
@@ -64,10 +159,86 @@ def normalize_repr(item_repr):
     return DEFAULT_REPR_RE.sub('', item_repr)
 
 
-def get_shortish_repr(item, custom_repr=(), max_length=None, normalize=False):
+class ReprGuard(object):
+    '''
+    Times reprs per type, and replaces the reprs of types that go over budget
+    with a cheap placeholder from then on.
+
+    A type is demoted when one repr of it takes more than `max_repr_time`
+    seconds, or when all of its reprs took more than `max_total_repr_time`
+    seconds together. Either limit can be `None`.
+
+    Only the time of a type's own repr is charged to it. The reprs of builtin
+    containers, namedtuples and dataclasses are made from the reprs of their
+    items (see `get_budgeted_repr`), which are charged to the types of the
+    items, so one slow item doesn't get every `list` demoted.
+    '''
+    def __init__(self, max_repr_time=None, max_total_repr_time=None):
+        self.max_repr_time = max_repr_time
+        self.max_total_repr_time = max_total_repr_time
+        self.total_times = collections.defaultdict(float)
+        # Type to the reason it was demoted, in the order they were demoted:
+        self.demotions = collections.OrderedDict()
+        self._n_reported_demotions = 0
+
+    def get_placeholder(self, item, normalize=False):
+        if normalize:
+            return u'<{} repr-suppressed>'.format(type(item).__name__)
+        return u'<{} id={:#x} repr-suppressed>'.format(type(item).__name__,
+                                                       id(item))
+
+    def get_repr(self, item, repr_function=repr, normalize=False):
+        '''
+        Get `repr_function(item)`, charging the time it took to the type of
+        `item`, or the placeholder if that type was demoted.
+        '''
+        item_type = type(item)
+        if item_type in self.demotions:
+            return self.get_placeholder(item, normalize)
+        start_time = timer()
+        try:
+            return repr_function(item)
+        finally:
+            self.record(item_type, timer() - start_time)
+
+    def record(self, item_type, duration):
+        total_time = self.total_times[item_type] = \
+                                      self.total_times[item_type] + duration
+        if self.max_repr_time is not None and duration > self.max_repr_time:
+            self.demotions.setdefault(
+                item_type,
+                u'one repr took {:.1f} ms'.format(duration * 1000)
+            )
+        elif self.max_total_repr_time is not None and \
+                                       total_time > self.max_total_repr_time:
+            self.demotions.setdefault(
+                item_type,
+                u'reprs took {:.1f} ms in total'.format(total_time * 1000)
+            )
+
+    def pop_new_demotions(self):
+        '''Get the `(type, reason)` pairs that weren't reported yet.'''
+        new_demotions = list(self.demotions.items())[
+                                                  self._n_reported_demotions:]
+        self._n_reported_demotions += len(new_demotions)
+        return new_demotions
+
+
+def get_shortish_repr(item, custom_repr=(), max_length=None, normalize=False,
+                      repr_guard=None):
     repr_function = get_repr_function(item, custom_repr)
     try:
-        r = repr_function(item)
+        if repr_function is repr and _get_budget_handler(type(item)):
+            if max_length or repr_guard is not None:
+                # With a `repr_guard`, the items are timed one by one:
+                r = get_budgeted_repr(item, max_length, normalize, repr_guard)
+                if r is not None:
+                    return r
+            r = repr(item)
+        elif repr_guard is not None:
+            r = repr_guard.get_repr(item, repr_function, normalize)
+        else:
+            r = repr_function(item)
     except Exception:
         r = 'REPR FAILED'
     r = r.replace('\r', '').replace('\n', '')
@@ -87,6 +258,331 @@ def truncate(string, max_length):
         return u'{}...{}'.format(string[:left], string[-right:])
 
 
+### Budgeted repr: ###########################################################
+#                                                                             #
+# `get_budgeted_repr(item, max_length)` is the same as truncating the repr of
+# `item` like `get_shortish_repr` does, but for builtin containers, strings,
+# dataclasses and namedtuples it only makes as much of the repr as the start
+# and the end of the truncated string need.
+
+class _Unbudgetable(Exception):
+    pass
+
+
+class _Partial(object):
+    '''
+    The start and the end of a repr that's too long to be made in full.
+
+    The repr is `head`, then zero or more characters, then `tail`, and both
+    `head` and `tail` are at least as long as the budget, so the repr is longer
+    than the budget.
+    '''
+    __slots__ = ('head', 'tail')
+
+    def __init__(self, head, tail):
+        self.head = head
+        self.tail = tail
+
+
+class _Budget(object):
+    __slots__ = ('length', 'normalize', 'repr_guard', 'active')
+
+    def __init__(self, length, normalize, repr_guard=None):
+        self.length = length
+        self.normalize = normalize
+        self.repr_guard = repr_guard
+        self.active = set()
+
+
+def get_budgeted_repr(item, max_length, normalize=False, repr_guard=None):
+    '''
+    Get the truncated repr of `item`, or `None` if it has to be made in full.
+
+    Without `max_length`, the repr isn't truncated. With `repr_guard`, the
+    reprs of the items that have no budgeted repr are made through it.
+    '''
+    if not max_length:
+        try:
+            return _budgeted_repr(item, _Budget(float('inf'), normalize,
+                                                repr_guard))
+        except (_Unbudgetable, RuntimeError):
+            return None
+    left = (max_length - 3) // 2
+    right = max_length - 3 - left
+    if left < 1 or right < 1:
+        return None
+    try:
+        result = _budgeted_repr(item, _Budget(max_length, normalize,
+                                              repr_guard))
+    except (_Unbudgetable, RuntimeError):
+        # A recursive container, or one that changed while we iterated on it.
+        return None
+    if isinstance(result, _Partial):
+        return u'{}...{}'.format(result.head[:left], result.tail[-right:])
+    return truncate(result, max_length)
+
+
+def _clean_repr(r, budget):
+    r = r.replace('\r', '').replace('\n', '')
+    if budget.normalize:
+        r = normalize_repr(r)
+    return r
+
+
+def _budgeted_repr(item, budget):
+    handler = _get_budget_handler(type(item))
+    if handler is None:
+        if budget.repr_guard is not None:
+            return _clean_repr(budget.repr_guard.get_repr(item, repr,
+                                                          budget.normalize),
+                               budget)
+        return _clean_repr(repr(item), budget)
+    return handler(item, budget)
+
+
+def _concatenate(pieces):
+    '''Concatenate strings and `_Partial`s into a string or a `_Partial`.'''
+    head = None
+    tail = u''
+    for piece in pieces:
+        if isinstance(piece, _Partial):
+            if head is None:
+                head = tail + piece.head
+            tail = piece.tail
+        else:
+            tail += piece
+    return tail if head is None else _Partial(head, tail)
+
+
+def _join(opening, closing, count, items, reversed_items, get_piece, budget):
+    '''
+    Make `opening + ', '.join(pieces) + closing` from both ends.
+
+    `items` and `reversed_items` iterate on the same `count` items from the
+    start and from the end, and `get_piece` turns an item into its piece.
+    '''
+    head_pieces = [opening]
+    head_length = len(opening)
+    n_head_items = 0
+    for item in items:
+        if n_head_items == count or head_length >= budget.length:
+            break
+        piece = get_piece(item, budget)
+        if n_head_items:
+            head_pieces.append(u', ')
+        head_pieces.append(piece)
+        n_head_items += 1
+        if isinstance(piece, _Partial):
+            break
+        head_length += len(piece) + 2
+    tail_pieces = [closing]
+    tail_length = len(closing)
+    n_tail_items = 0
+    for item in reversed_items:
+        if n_head_items + n_tail_items == count or \
+                                              tail_length >= budget.length:
+            break
+        piece = get_piece(item, budget)
+        if n_tail_items:
+            tail_pieces.append(u', ')
+        tail_pieces.append(piece)
+        n_tail_items += 1
+        if isinstance(piece, _Partial):
+            break
+        tail_length += len(piece) + 2
+    if n_head_items + n_tail_items < count:
+        # The items in the middle are left out:
+        tail_pieces.append(_Partial(u', ' if n_head_items else u'',
+                                    u', ' if n_tail_items else u''))
+    elif n_head_items and n_tail_items:
+        tail_pieces.append(u', ')
+    result = _concatenate(head_pieces + tail_pieces[::-1])
+    if isinstance(result, _Partial) and (len(result.head) < budget.length or
+                                         len(result.tail) < budget.length):
+        raise _Unbudgetable
+    return result
+
+
+def _budgeted_sequence_repr(opening, closing, sequence, budget,
+                            get_piece=_budgeted_repr):
+    if not sequence:
+        return opening + closing
+    if id(sequence) in budget.active:
+        raise _Unbudgetable
+    budget.active.add(id(sequence))
+    try:
+        if isinstance(sequence, (list, tuple)):
+            items, reversed_items = iter(sequence), reversed(sequence)
+        else:
+            sequence_list = list(sequence)
+            items, reversed_items = iter(sequence_list), \
+                                                      reversed(sequence_list)
+        return _join(opening, closing, len(sequence), items, reversed_items,
+                     get_piece, budget)
+    finally:
+        budget.active.discard(id(sequence))
+
+
+def _budgeted_list_repr(item, budget):
+    return _budgeted_sequence_repr(u'[', u']', item, budget)
+
+
+def _budgeted_tuple_repr(item, budget):
+    return _budgeted_sequence_repr(u'(', u',)' if len(item) == 1 else u')',
+                                   item, budget)
+
+
+def _budgeted_set_repr(item, budget):
+    if not item:
+        return u'set()'
+    return _budgeted_sequence_repr(u'{', u'}', item, budget)
+
+
+def _budgeted_frozenset_repr(item, budget):
+    if not item:
+        return u'frozenset()'
+    return _budgeted_sequence_repr(u'frozenset({', u'})', item, budget)
+
+
+def _budgeted_dict_item_repr(key_and_value, budget):
+    key, value = key_and_value
+    return _concatenate((_budgeted_repr(key, budget), u': ',
+                         _budgeted_repr(value, budget)))
+
+
+def _budgeted_dict_repr(item, budget):
+    if not item:
+        return u'{}'
+    if id(item) in budget.active:
+        raise _Unbudgetable
+    budget.active.add(id(item))
+    try:
+        try:
+            reversed_items = reversed(item.items())
+        except TypeError: # Python 3.7 and older
+            reversed_items = reversed(list(item.items()))
+        return _join(u'{', u'}', len(item), iter(item.items()),
+                     reversed_items, _budgeted_dict_item_repr, budget)
+    finally:
+        budget.active.discard(id(item))
+
+
+def _budgeted_field_repr(name_and_value, budget):
+    name, value = name_and_value
+    return _concatenate((name + u'=', _budgeted_repr(value, budget)))
+
+
+def _make_budgeted_fields_repr(name_attribute, field_names, positional):
+    '''
+    Make a budgeted repr for dataclasses and namedtuples, which have reprs like
+    `Point(x=1, y=2)`.
+    '''
+    def budgeted_fields_repr(item, budget):
+        if id(item) in budget.active:
+            raise _Unbudgetable
+        if positional:
+            if len(item) != len(field_names):
+                raise _Unbudgetable
+            fields = list(zip(field_names, item))
+        else:
+            fields = [(name, getattr(item, name)) for name in field_names]
+        opening = getattr(item.__class__, name_attribute) + u'('
+        if not fields:
+            return opening + u')'
+        budget.active.add(id(item))
+        try:
+            return _join(opening, u')', len(fields), iter(fields),
+                         reversed(fields), _budgeted_field_repr, budget)
+        finally:
+            budget.active.discard(id(item))
+    return budgeted_fields_repr
+
+
+_namedtuple_repr_code = collections.namedtuple('_', ()).__repr__.__code__
+
+
+def _get_budget_handler(item_type):
+    try:
+        return _budget_handlers[item_type]
+    except KeyError:
+        pass
+    handler = None
+    for owner in item_type.__mro__:
+        if '__repr__' in owner.__dict__:
+            break
+    repr_function = owner.__dict__['__repr__']
+    if issubclass(owner, tuple) and getattr(repr_function, '__code__',
+                                            None) is _namedtuple_repr_code:
+        handler = _make_budgeted_fields_repr('__name__', owner._fields,
+                                             positional=True)
+    elif dataclasses is not None and dataclasses.is_dataclass(owner) and \
+             getattr(getattr(repr_function, '__wrapped__', None),
+                     '__qualname__', '').startswith('__create_fn__.'):
+        # The `__repr__` that `dataclasses` made:
+        handler = _make_budgeted_fields_repr(
+            '__qualname__',
+            tuple(field.name for field in dataclasses.fields(owner)
+                  if field.repr),
+            positional=False
+        )
+    _budget_handlers[item_type] = handler
+    return handler
+
+
+def _budgeted_str_repr(item, budget):
+    length = budget.length
+    if len(item) <= 2 * length or \
+               (budget.normalize and ' at 0x' in item):
+        return _clean_repr(repr(item), budget)
+    # `repr` escapes each character on its own, so the repr of a slice is a
+    # slice of the repr, except that the quotes are picked by looking at the
+    # whole string:
+    quote = '"' if "'" in item and '"' not in item else "'"
+    head = _get_inner_str_repr(item[:length], quote)
+    tail = _get_inner_str_repr(item[-length:], quote)
+    return _Partial(quote + head, tail + quote)
+
+
+def _get_inner_str_repr(piece, quote):
+    piece_repr = repr(piece)
+    inner = piece_repr[1:-1]
+    if piece_repr[0] != quote and quote == "'":
+        inner = inner.replace("'", "\\'")
+    return inner
+
+
+def _budgeted_bytes_repr(item, budget):
+    length = budget.length
+    if len(item) <= 2 * length or \
+               (budget.normalize and b' at 0x' in item):
+        return _clean_repr(repr(item), budget)
+    quote = '"' if b"'" in item and b'"' not in item else "'"
+    head = _get_inner_bytes_repr(item[:length], quote)
+    tail = _get_inner_bytes_repr(item[-length:], quote)
+    return _Partial('b' + quote + head, tail + quote)
+
+
+def _get_inner_bytes_repr(piece, quote):
+    piece_repr = repr(piece)
+    inner = piece_repr[2:-1]
+    if piece_repr[1] != quote and quote == "'":
+        inner = inner.replace("'", "\\'")
+    return inner
+
+
+_budget_handlers = {
+    list: _budgeted_list_repr,
+    tuple: _budgeted_tuple_repr,
+    dict: _budgeted_dict_repr,
+    set: _budgeted_set_repr,
+    frozenset: _budgeted_frozenset_repr,
+    str: _budgeted_str_repr,
+    bytes: _budgeted_bytes_repr,
+}
+#                                                                             #
+### Finished budgeted repr. ###################################################
+
+
 def ensure_tuple(x):
     if isinstance(x, collections_abc.Iterable) and \
                                                not isinstance(x, string_types):
@@ -95,4 +591,28 @@ def ensure_tuple(x):
         return (x,)
 
 
+# The `(signum, handler)` pairs that `chain_signal_handler` installed:
+_chained_signal_handlers = set()
+
+
+def chain_signal_handler(signum, handler):
+    '''
+    Have `handler` called on signal `signum`, and then the handler that was
+    there before it. Does nothing if it was done already.
+
+    Call from the main thread, like `signal.signal`.
+    '''
+    if (signum, handler) in _chained_signal_handlers:
+        return
+    if threading.current_thread() is not threading.main_thread():
+        raise RuntimeError('Signal handlers can only be set from the main '
+                           'thread.')
+    previous_handler = signal.getsignal(signum)
+
+    def handle_signal(signum, frame):
+        handler(signum, frame)
+        if callable(previous_handler):
+            return previous_handler(signum, frame)
 
+    signal.signal(signum, handle_signal)
+    _chained_signal_handlers.add((signum, handler))
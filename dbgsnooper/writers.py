@@ -0,0 +1,565 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+'''Where `Tracer` writes its output to.'''
+
+import atexit
+import collections
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import weakref
+from io import open
+
+from . import utils, pycompat
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_QUEUE_SIZE = 10000
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+# How long exiting waits for writer threads to write what they have left:
+EXIT_TIMEOUT = 5.0
+
+
+def get_write_function(output, overwrite, buffer_size=DEFAULT_BUFFER_SIZE,
+                       flush_interval=DEFAULT_FLUSH_INTERVAL, fsync=False,
+                       async_output=False, queue_size=DEFAULT_QUEUE_SIZE,
+                       overflow='block'):
+    write = _get_write_function(output, overwrite, buffer_size,
+                                flush_interval, fsync)
+    if async_output:
+        return AsyncWriter(write, queue_size, overflow)
+    return write
+
+
+def _get_write_function(output, overwrite, buffer_size, flush_interval, fsync):
+    is_path = isinstance(output, (pycompat.PathLike, str))
+    if overwrite and not is_path:
+        raise Exception('`overwrite=True` can only be used when writing '
+                        'content to file.')
+    if output is None:
+        def write(s):
+            stderr = sys.stderr
+            try:
+                stderr.write(s)
+            except UnicodeEncodeError:
+                # God damn Python 2
+                stderr.write(utils.shitcode(s))
+    elif is_path:
+        return FileWriter(output, overwrite, buffer_size, flush_interval,
+                          fsync)
+    elif isinstance(output, socket.socket):
+        return SocketWriter(output)
+    elif callable(output):
+        write = output
+    else:
+        assert isinstance(output, utils.WritableStream)
+
+        def write(s):
+            output.write(s)
+    return write
+
+
+class FileWriter(object):
+    '''
+    Writes to the file at `path`, through a buffer that's shared with every
+    other `FileWriter` of the same file, so they don't overwrite each other.
+
+    The buffer is written once it has `buffer_size` characters or once
+    `flush_interval` seconds passed since it was last written, and on `flush`.
+    A background thread keeps to `flush_interval` when nothing else gets
+    written, so the output of a process that hangs or gets killed is there.
+    Buffers are also written when the process exits or gets `SIGTERM` or
+    `SIGHUP`. With `fsync`, every flush waits for the data to reach the disk.
+
+    With `overwrite`, the first write of this writer truncates the file, like
+    opening it with `'w'` would.
+    '''
+    def __init__(self, path, overwrite, buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, fsync=False):
+        self.path = pycompat.text_type(path)
+        self.overwrite = overwrite
+        self.file = _SharedFile.get(self.path, buffer_size, flush_interval,
+                                    fsync)
+
+    def __call__(self, s):
+        self.write(s)
+
+    def write(self, s):
+        if self.overwrite:
+            self.file.truncate()
+            self.overwrite = False
+        self.file.write(s)
+
+    def flush(self):
+        self.file.flush()
+
+
+class SocketWriter(object):
+    '''
+    Sends the output over a connected socket, like the connection of a client
+    of `control.ControlServer`. Once the other end is gone, the output is
+    dropped rather than failing the snooped code.
+    '''
+    def __init__(self, sock):
+        self.socket = sock
+        self.closed = False
+
+    def __call__(self, s):
+        self.write(s)
+
+    def write(self, s):
+        if self.closed:
+            return
+        try:
+            self.socket.sendall(s.encode('utf-8'))
+        except OSError:
+            self.closed = True
+
+
+class _SharedFile(object):
+    '''
+    The open file and write buffer of one path, see `FileWriter`. With
+    `binary`, it's written bytes rather than text.
+    '''
+    _instances = weakref.WeakValueDictionary()
+    # Reentrant, since `flush_all` may run in a signal handler that
+    # interrupted the main thread while it held it:
+    _instances_lock = threading.RLock()
+
+    def __init__(self, path, buffer_size, flush_interval, fsync, binary=False):
+        self.path = path
+        self.binary = binary
+        self.lock = threading.RLock()
+        self.file = None
+        self.buffer = []
+        self.buffered_size = 0
+        self.last_flush_time = time.monotonic()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._position = None
+
+    @classmethod
+    def get(cls, path, buffer_size, flush_interval, fsync, binary=False):
+        key = (os.path.realpath(path), binary)
+        with cls._instances_lock:
+            if buffer_size > 0 and flush_interval > 0:
+                _install_exit_flushing()
+            shared_file = cls._instances.get(key)
+            if shared_file is None:
+                shared_file = cls._instances[key] = cls(
+                    path, buffer_size, flush_interval, fsync, binary
+                )
+                weakref.finalize(shared_file, _close, shared_file.__dict__)
+            else:
+                # Several writers of the same file get the strictest policy:
+                shared_file.buffer_size = min(shared_file.buffer_size,
+                                              buffer_size)
+                shared_file.flush_interval = min(shared_file.flush_interval,
+                                                 flush_interval)
+                shared_file.fsync = shared_file.fsync or fsync
+            return shared_file
+
+    def get_position(self):
+        '''Get the size the file will have once what's buffered is written.'''
+        with self.lock:
+            if self._position is None:
+                try:
+                    self._position = os.path.getsize(self.path) + \
+                                                            self.buffered_size
+                except OSError:
+                    self._position = self.buffered_size
+            return self._position
+
+    def write(self, s):
+        with self.lock:
+            self.buffer.append(s)
+            self.buffered_size += len(s)
+            if self._position is not None:
+                self._position += len(s)
+            if self.buffered_size >= self.buffer_size or \
+                 time.monotonic() - self.last_flush_time >= self.flush_interval:
+                self.flush()
+            elif len(self.buffer) == 1:
+                _wake_flusher()
+
+    def truncate(self):
+        with self.lock:
+            del self.buffer[:]
+            self.buffered_size = 0
+            self._position = 0
+            if self.file is not None:
+                self.file.close()
+            self.file = _open(self.path, 'w', self.binary)
+
+    def flush(self):
+        with self.lock:
+            self.last_flush_time = time.monotonic()
+            if not self.buffer:
+                return
+            if self.file is None:
+                self.file = _open(self.path, 'a', self.binary)
+            self.file.write((b'' if self.binary else u'').join(self.buffer))
+            del self.buffer[:]
+            self.buffered_size = 0
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def forget_buffer(self):
+        with self.lock:
+            del self.buffer[:]
+            self.buffered_size = 0
+            self._position = None
+
+
+_flusher_condition = threading.Condition(threading.RLock())
+_flusher_pid = None
+
+
+def _wake_flusher():
+    '''Have the flusher thread look for buffers that wait to be written.'''
+    global _flusher_pid
+    with _flusher_condition:
+        # A forked child has the buffers of its parent, but not its thread:
+        if _flusher_pid != os.getpid():
+            _flusher_pid = os.getpid()
+            thread = threading.Thread(target=_run_flusher,
+                                      name='dbgsnooper-flusher')
+            thread.daemon = True
+            thread.start()
+        _flusher_condition.notify_all()
+
+
+def _get_due_files():
+    '''
+    Get the shared files whose buffers waited `flush_interval`, and how long
+    until the next one does, or `None` if no other file has a buffer.
+    '''
+    with _SharedFile._instances_lock:
+        shared_files = list(_SharedFile._instances.values())
+    now = time.monotonic()
+    due_files = []
+    timeout = None
+    for shared_file in shared_files:
+        if not shared_file.buffer:
+            continue
+        remaining = shared_file.last_flush_time + shared_file.flush_interval - \
+                                                                          now
+        if remaining <= 0:
+            due_files.append(shared_file)
+        elif timeout is None or remaining < timeout:
+            timeout = remaining
+    return due_files, timeout
+
+
+def _run_flusher():
+    while True:
+        with _flusher_condition:
+            due_files, timeout = _get_due_files()
+            if not due_files:
+                _flusher_condition.wait(timeout)
+                continue
+        for shared_file in due_files:
+            try:
+                shared_file.flush()
+            except Exception:
+                traceback.print_exc()
+        del due_files
+
+
+def _open(path, mode, binary):
+    if binary:
+        return open(path, mode + 'b')
+    return open(path, mode, encoding='utf-8')
+
+
+def _close(attributes):
+    # Called when a `_SharedFile` is garbage collected, with what's left of it:
+    file, buffer = attributes['file'], attributes['buffer']
+    binary = attributes['binary']
+    if buffer:
+        if file is None:
+            file = _open(attributes['path'], 'a', binary)
+        file.write((b'' if binary else u'').join(buffer))
+    if file is not None:
+        file.close()
+
+
+class _Dropped(object):
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+
+_FLUSH = object()
+
+
+class AsyncWriter(object):
+    '''
+    Calls `write` on a background thread, so the snooped threads don't wait
+    for a slow terminal, pipe or disk.
+
+    Lines wait in a queue of up to `queue_size` lines. When it's full,
+    `overflow` picks what to do:
+
+     - `'block'`: wait for the writer thread to make room.
+     - `'drop-oldest'`: drop the line that waited the longest.
+     - `'drop-newest'`: drop the new line.
+
+    Dropped lines are counted, and a line that says how many were dropped is
+    written where they would have been.
+    '''
+    def __init__(self, write, queue_size=DEFAULT_QUEUE_SIZE, overflow='block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('`overflow` must be one of {}, not {!r}.'.format(
+                ', '.join(map(repr, OVERFLOW_POLICIES)), overflow
+            ))
+        if queue_size < 1:
+            raise ValueError('`queue_size` must be at least 1.')
+        self._write = write
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.queue = collections.deque()
+        self.n_queued = 0
+        self.n_dropped = 0
+        self._busy = False
+        self._condition = threading.Condition(threading.RLock())
+        self._thread = None
+        self._thread_pid = None
+        with _SharedFile._instances_lock:
+            _install_exit_flushing()
+            _async_writers.add(self)
+
+    def __call__(self, s):
+        self.write(s)
+
+    def _ensure_thread(self):
+        # A forked child has the queue of its parent, but not its thread:
+        if self._thread_pid != os.getpid():
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=_run_async_writer,
+                                            args=(weakref.ref(self),),
+                                            name='dbgsnooper-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def write(self, s):
+        with self._condition:
+            self._ensure_thread()
+            queue = self.queue
+            if self.n_queued >= self.queue_size:
+                if self.overflow == 'block':
+                    while self.n_queued >= self.queue_size:
+                        self._condition.wait()
+                elif self.overflow == 'drop-oldest':
+                    # Markers don't count as queued lines, so there's a line
+                    # right after the leading ones:
+                    index = 0
+                    while type(queue[index]) is not str:
+                        index += 1
+                    del queue[index]
+                    self.n_queued -= 1
+                    if index and type(queue[index - 1]) is _Dropped:
+                        marker = queue[index - 1]
+                    else:
+                        marker = _Dropped()
+                        queue.insert(index, marker)
+                    marker.count += 1
+                    self.n_dropped += 1
+                else:
+                    if not queue or type(queue[-1]) is not _Dropped:
+                        queue.append(_Dropped())
+                    queue[-1].count += 1
+                    self.n_dropped += 1
+                    self._condition.notify_all()
+                    return
+            queue.append(s)
+            self.n_queued += 1
+            self._condition.notify_all()
+
+    def flush(self):
+        '''Have the writer thread flush `write`, once it wrote what's queued.'''
+        if getattr(self._write, 'flush', None) is None:
+            return
+        with self._condition:
+            self._ensure_thread()
+            if not self.queue or self.queue[-1] is not _FLUSH:
+                self.queue.append(_FLUSH)
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        '''Wait until everything that's queued was written.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.queue or self._busy:
+                if self._thread_pid != os.getpid():
+                    return False
+                remaining = None if deadline is None else \
+                                                   deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _take(self, timeout):
+        '''Take the next item to write, or `None` if there's none yet.'''
+        with self._condition:
+            if not self.queue:
+                self._condition.wait(timeout)
+                if not self.queue:
+                    return None
+            item = self.queue.popleft()
+            if type(item) is str:
+                self.n_queued -= 1
+            self._busy = True
+            self._condition.notify_all()
+            return item
+
+    def _forget_queue(self):
+        self._condition = threading.Condition(threading.RLock())
+        self.queue.clear()
+        self.n_queued = 0
+        self._busy = False
+
+    def _done(self):
+        with self._condition:
+            self._busy = False
+            self._condition.notify_all()
+
+    def _write_item(self, item):
+        try:
+            if item is _FLUSH:
+                self._write.flush()
+            elif type(item) is _Dropped:
+                self._write(u'......{} lines dropped, the output queue was '
+                            u'full......\n'.format(item.count))
+            else:
+                self._write(item)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._done()
+
+
+def _run_async_writer(writer_ref):
+    # Only holds the writer while there's something to write, so the writer
+    # can be garbage collected along with its tracer:
+    while True:
+        writer = writer_ref()
+        if writer is None:
+            return
+        item = writer._take(1)
+        if item is not None:
+            writer._write_item(item)
+        del writer, item
+
+
+_async_writers = weakref.WeakSet()
+_exit_callbacks = []
+
+
+def add_exit_callback(callback):
+    '''
+    Have `callback` called by `flush_all` before it writes the buffers, for
+    output that hasn't gotten to a writer yet when the process exits.
+
+    Exit signals are only handled once a buffered file or an `AsyncWriter`
+    is made, so a tracer that writes right away leaves them to the program.
+    '''
+    _install_atexit_flushing()
+    if callback not in _exit_callbacks:
+        _exit_callbacks.append(callback)
+
+
+def flush_all():
+    '''Write the buffers of all the files that tracers write to.'''
+    for callback in list(_exit_callbacks):
+        try:
+            callback()
+        except Exception:
+            pass
+    for async_writer in list(_async_writers):
+        async_writer.join(EXIT_TIMEOUT)
+    with _SharedFile._instances_lock:
+        shared_files = list(_SharedFile._instances.values())
+    for shared_file in shared_files:
+        try:
+            shared_file.flush()
+        except Exception:
+            pass
+
+
+def _forget_all_buffers():
+    # A forked child would write its parent's buffers again:
+    global _flusher_condition
+    _flusher_condition = threading.Condition(threading.RLock())
+    _SharedFile._instances_lock = threading.RLock()
+    for shared_file in list(_SharedFile._instances.values()):
+        shared_file.lock = threading.RLock()
+        shared_file.forget_buffer()
+    for async_writer in list(_async_writers):
+        async_writer._forget_queue()
+
+
+_atexit_flushing_installed = False
+_exit_flushing_installed = False
+EXIT_SIGNALS = tuple(getattr(signal, name) for name in ('SIGTERM', 'SIGHUP')
+                     if hasattr(signal, name))
+# The handlers that flush on these signals, and the ones they replaced:
+_signal_handlers = {}
+
+
+def _install_atexit_flushing():
+    global _atexit_flushing_installed
+    if _atexit_flushing_installed:
+        return
+    _atexit_flushing_installed = True
+    atexit.register(flush_all)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_forget_all_buffers)
+
+
+def _install_exit_flushing():
+    global _exit_flushing_installed
+    if _exit_flushing_installed:
+        return
+    _exit_flushing_installed = True
+    _install_atexit_flushing()
+    if threading.current_thread() is not threading.main_thread():
+        # Signal handlers can only be set from the main thread.
+        return
+    for signum in EXIT_SIGNALS:
+        previous_handler = signal.getsignal(signum)
+        if previous_handler == signal.SIG_IGN or previous_handler is None:
+            continue
+        handler = _make_signal_handler(previous_handler)
+        signal.signal(signum, handler)
+        _signal_handlers[signum] = (handler, previous_handler)
+
+
+def restore_signal_handlers():
+    '''
+    Put back the signal handlers that were replaced to flush on exit signals,
+    in a process that's better off dying on them right away.
+    '''
+    for signum, (handler, previous_handler) in _signal_handlers.items():
+        if signal.getsignal(signum) is handler:
+            signal.signal(signum, previous_handler)
+    _signal_handlers.clear()
+
+
+def _make_signal_handler(previous_handler):
+    def handle_signal(signum, frame):
+        flush_all()
+        if callable(previous_handler):
+            return previous_handler(signum, frame)
+        # The default handler, which kills the process:
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+    return handle_signal
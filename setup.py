@@ -27,6 +27,7 @@ setuptools.setup(
             'trace_method = dbgsnooper.cli:main',
             'trace_var = dbgsnooper.cli:main',
             'call_graph = dbgsnooper.cli:main',
+            'dbgsnooper = dbgsnooper.cli:main',
         ],
     },
     extras_require={
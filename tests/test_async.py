@@ -0,0 +1,174 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import asyncio
+import io
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import monitoring, pycompat
+from .utils import get_output_lines
+
+BACKENDS = ['settrace'] + (['monitoring'] if monitoring.MONITORING_AVAILABLE
+                           else [])
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_tasks(backend):
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False, backend=backend)
+    task_states = {}
+
+    @tracer
+    async def work(n):
+        total = n * 10
+        await asyncio.sleep(0)
+        total += 1
+        task_states.setdefault(n, []).append(tracer.get_thread_state())
+        await inner(n)
+        return total
+
+    @tracer
+    async def inner(n):
+        task_states[n].append(tracer.get_thread_state())
+        await asyncio.sleep(0)
+
+    async def main():
+        return await asyncio.gather(work(1), work(2), work(3))
+
+    assert asyncio.run(main()) == [11, 21, 31]
+    tracer.flush()
+    # The tasks ran interleaved, but each one's output is in one piece:
+    lines = [line for line in get_output_lines(string_io.getvalue())
+             if line.startswith(('New var:....... total',
+                                 'Modified var:.. total'))]
+    assert lines == [line.format(n) for n in (1, 2, 3) for line in
+                     ('New var:....... total = {}0',
+                      'Modified var:.. total = {}1')]
+    # Coroutines that are awaited share the state of their task:
+    assert [states[0] is states[1] for states in task_states.values()] == \
+                                                             [True, True, True]
+    assert len(set(states[0] for states in task_states.values())) == 3
+    # Outside of a task, it's the thread's state again:
+    assert tracer.get_thread_state() not in task_states[1]
+
+
+def test_cancellation():
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False)
+
+    @tracer
+    async def wait():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    async def main():
+        task = asyncio.ensure_future(wait())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    tracer.flush()
+    lines = get_output_lines(string_io.getvalue())
+    assert 'New var:....... cancelled = True' in lines
+    assert 'Call ended by exception' in lines
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_async_generators(backend):
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False, backend=backend)
+    closed = []
+
+    @tracer
+    async def count(n):
+        try:
+            for i in range(n):
+                received = yield i
+                await asyncio.sleep(0)
+        finally:
+            closed.append(True)
+
+    async def main():
+        agen = count(3)
+        first = await agen.__anext__()
+        second = await agen.asend('hello')
+        await agen.aclose()
+        return first, second
+
+    assert asyncio.run(main()) == (0, 1)
+    assert closed == [True]
+    tracer.flush()
+    lines = get_output_lines(string_io.getvalue())
+    assert "New var:....... received = 'hello'" in lines
+    assert 'Modified var:.. i = 1' in lines
+    # What it yields, rather than how CPython wraps it:
+    assert 'Return value:.. 0' in lines
+    assert 'Return value:.. 1' in lines
+    assert not [line for line in lines if 'wrapped_value' in line]
+
+
+
+def test_snooping_coroutine_functions():
+    async def foo(x):
+        return 'lol'
+
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False)
+    snooped_foo = tracer(foo)
+    assert pycompat.iscoroutinefunction(snooped_foo)
+    assert not pycompat.isasyncgenfunction(snooped_foo)
+    assert asyncio.run(snooped_foo(1)) == 'lol'
+    tracer.flush()
+    assert "Return value:.. 'lol'" in string_io.getvalue()
+
+
+def test_snooping_async_generator_functions():
+    async def foo(x):
+        yield 'lol'
+
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False)
+    snooped_foo = tracer(foo)
+    assert pycompat.isasyncgenfunction(snooped_foo)
+    assert not pycompat.iscoroutinefunction(snooped_foo)
+
+    async def consume():
+        return [item async for item in snooped_foo(1)]
+
+    assert asyncio.run(consume()) == ['lol']
+    tracer.flush()
+    assert "Starting var:.. x = 1" in string_io.getvalue()
+
+def test_wrapping_classes():
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False)
+
+    @tracer
+    class Worker(object):
+        async def work(self, n):
+            result = n + 1
+            return result
+
+    assert asyncio.run(Worker().work(1)) == 2
+    tracer.flush()
+    assert 'Return value:.. 2' in get_output_lines(string_io.getvalue())
+
+
+def test_output_queue_drops_lines_rather_than_block():
+    async def work():
+        pass
+
+    tracer = dbgsnooper.snoop(io.StringIO(), color=False)
+    tracer(work)
+    assert tracer._write.overflow == 'drop-oldest'
+    tracer = dbgsnooper.snoop(io.StringIO(), color=False, overflow='block')
+    tracer(work)
+    assert tracer._write.overflow == 'block'
+
@@ -0,0 +1,85 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import pytest
+
+from dbgsnooper import children, cli
+from .utils import temp_module
+
+
+@pytest.fixture
+def observed_module(tmp_path):
+    with temp_module(tmp_path, 'child_module') as module:
+        yield module
+        children.stop()
+
+
+def _get_return_values(shard_dir):
+    return [(pid, event.data) for pid, event in
+            children.iter_shard_events(str(shard_dir))
+            if event.kind == 'return_value']
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Needs `os.fork`.')
+def test_forked_children(observed_module, tmp_path):
+    shard_dir = tmp_path / 'shards'
+    tracer = children.start(str(shard_dir),
+                            observed_file=observed_module.__file__,
+                            start_line=1, end_line=3)
+    with tracer:
+        observed_module.work(1)
+        with multiprocessing.get_context('fork').Pool(2) as pool:
+            assert pool.map(observed_module.work, [2, 3]) == [20, 30]
+    children.stop()
+    return_values = _get_return_values(shard_dir)
+    assert sorted(value for _, value in return_values) == ['10', '20', '30']
+    # Each process has its shard, and the parent's is there too:
+    assert return_values[0] == (os.getpid(), '10')
+    assert set(pid for pid, _ in return_values[1:]) & set([os.getpid()]) == \
+                                                                         set()
+    output = io.StringIO()
+    children.merge_shards(str(shard_dir), output.write)
+    lines = output.getvalue().splitlines()
+    assert '[{}]     Return value:.. 10'.format(os.getpid()) in lines
+    assert all(line.startswith('[') for line in lines)
+
+
+def test_new_interpreters(observed_module, tmp_path):
+    shard_dir = tmp_path / 'shards'
+    environ = dict(os.environ)
+    children.start(str(shard_dir), observed_file=observed_module.__file__,
+                   start_line=1, end_line=3)
+    subprocess.check_call([sys.executable, '-c',
+                           'import child_module; child_module.work(4)'],
+                          cwd=str(tmp_path))
+    children.stop()
+    assert dict(os.environ) == environ
+    return_values = _get_return_values(shard_dir)
+    assert [value for _, value in return_values] == ['None', '40']
+    assert return_values[0][0] != os.getpid()
+    # Processes started after `stop` aren't recorded:
+    subprocess.check_call([sys.executable, '-c',
+                           'import child_module; child_module.work(5)'],
+                          cwd=str(tmp_path))
+    assert len(os.listdir(str(shard_dir))) == 2
+
+
+def test_merge_command(observed_module, tmp_path, monkeypatch, capsys):
+    shard_dir = tmp_path / 'shards'
+    with children.start(str(shard_dir), observed_file=observed_module.__file__,
+                        start_line=1, end_line=3):
+        observed_module.work(6)
+    children.stop()
+    monkeypatch.setattr(sys, 'argv', ['dbgsnooper', 'merge', str(shard_dir),
+                                      '--normalize'])
+    cli.main()
+    lines = capsys.readouterr().out.splitlines()
+    pid = os.getpid()
+    assert '[{}]     Source path:... child_module.py'.format(pid) in lines
+    assert '[{}]     Return value:.. 60'.format(pid) in lines
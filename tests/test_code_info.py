@@ -0,0 +1,154 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import collections
+import gc
+import sys
+import weakref
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import monitoring
+from dbgsnooper.code_info import get_code_info, find_def_line, code_infos
+from .utils import get_snoop_lines
+
+BACKENDS = ['settrace'] + (['monitoring'] if monitoring.MONITORING_AVAILABLE
+                           else [])
+
+
+def test_sort_local_items():
+    def f(a, b):
+        c = a + b
+        return c
+
+    code_info = get_code_info(f.__code__)
+    assert get_code_info(f.__code__) is code_info
+    items = [('c', 3), ('extra', 0), ('b', 2), ('other', 1), ('a', 1)]
+    assert [name for name, _ in code_info.sort_local_items(items)] == \
+                                              ['a', 'b', 'c', 'extra', 'other']
+
+
+def test_code_infos_dont_keep_code_alive():
+    namespace = {}
+    exec(compile('def f(a):\n    return a\n', '<dynamic>', 'exec'), namespace)
+    code = namespace['f'].__code__
+    code_info = get_code_info(code)
+    assert code_info.code is code
+    assert code in code_infos
+    code_id = id(code)
+    code_ref = weakref.ref(code)
+    del namespace, code
+    gc.collect()
+    assert code_ref() is None
+    assert code_id not in code_infos.values
+
+
+def test_is_ended_by_exception():
+    frames = []
+
+    def f(raise_):
+        frames.append(sys._getframe())
+        if raise_:
+            raise ValueError
+        return 7
+
+    f(False)
+    try:
+        f(True)
+    except ValueError:
+        pass
+    code_info = get_code_info(f.__code__)
+    assert not code_info.is_ended_by_exception(frames[0])
+    assert code_info.is_ended_by_exception(frames[1])
+
+
+def test_find_def_line():
+    source = ['@foo', '  @bar(1)', 'def baz():', '    pass']
+    assert find_def_line(source, 1) == 3
+    assert find_def_line(source, 3) == 3
+    assert find_def_line(['@foo'], 1) == 1
+
+
+def test_get_line_stores():
+    def g(items):
+        for x in items:
+            y = x.real
+        return y
+
+    def f(a):
+        b = a
+        c = [a]
+        c.append(b)
+        del b
+        return c
+
+    first_line = f.__code__.co_firstlineno
+    line_stores = get_code_info(f.__code__).get_line_stores()
+    assert line_stores[first_line + 1] == {'b'}
+    assert line_stores[first_line + 2] == {'c'}
+    assert line_stores[first_line + 3] is None
+    assert line_stores[first_line + 4] == {'b'}
+    # Getting an attribute may run a property that changes any variable,
+    # which only a tracer that sees its call notices:
+    blind_line_stores = get_code_info(g.__code__).get_line_stores(
+        sees_calls=False
+    )
+    line_stores = get_code_info(g.__code__).get_line_stores()
+    first_line = g.__code__.co_firstlineno
+    assert line_stores[first_line + 2] == {'y'}
+    assert blind_line_stores[first_line + 2] is None
+    # Iterating may run C code that changes them without any call event:
+    assert line_stores[first_line + 1] is None
+    assert blind_line_stores[first_line + 1] is None
+
+def test_only_stored_variables_are_checked(monkeypatch):
+    def f(n):
+        shared = [0]
+        alias = shared
+        total = 0
+        for i in range(n):
+            j = i * 2
+            k, m = j, i
+            total += j
+        shared.append(k)
+        alias = shared[:]
+        shared[0] = total
+        del j
+        y = [x for x in alias]
+        try:
+            raise ValueError
+        except ValueError as e:
+            z = e
+        return y
+
+    lines = get_snoop_lines(f, (2,), watch=('shared[0]',))
+    monkeypatch.setattr(dbgsnooper.tracer.Tracer, 'get_dirty_names',
+                        lambda *args: None)
+    assert lines == get_snoop_lines(f, (2,), watch=('shared[0]',))
+
+
+def _using_defaultdict():
+    dd = collections.defaultdict(list)
+    x = dd['a']
+    y = 1
+    z = 2
+    return z
+
+
+def _mapping_appends():
+    lst = []
+    a, b = map(lst.append, 'ab')
+    for _ in map(lst.append, 'cd'):
+        c = 1
+    return c
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_variables_changed_by_c_code(monkeypatch, backend):
+    lines = [get_snoop_lines(function, backend=backend)
+             for function in (_using_defaultdict, _mapping_appends)]
+    monkeypatch.setattr(dbgsnooper.tracer.Tracer, 'get_dirty_names',
+                        lambda *args: None)
+    assert lines == [get_snoop_lines(function, backend=backend)
+                     for function in (_using_defaultdict, _mapping_appends)]
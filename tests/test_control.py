@@ -0,0 +1,145 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from dbgsnooper import control, tracer
+from .utils import get_output_lines
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                                reason='Needs Unix domain sockets.')
+
+
+def _add(x, y):
+    total = x + y
+    return total
+
+
+class _Thing(object):
+    @staticmethod
+    def double(x):
+        return x * 2
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracer, 'DISABLED', False)
+    control_server = control.serve(str(tmp_path / 'control.sock'))
+    yield control_server
+    control_server.close()
+
+
+def _send(server, command):
+    chunks = []
+    control.send_command(server.path, command, chunks.append)
+    return ''.join(chunks)
+
+
+def _send_in_thread(server, command):
+    chunks = []
+    thread = threading.Thread(target=control.send_command,
+                              args=(server.path, command, chunks.append))
+    thread.start()
+    return thread, chunks
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_snoop(server):
+    thread, chunks = _send_in_thread(
+        server, 'snoop {}:_add calls=2 watch="(\'y - x\',)"'.format(__name__)
+    )
+    _wait_for(lambda: hasattr(_add, '__wrapped__'))
+    assert [_add(1, 2), _add(3, 4), _add(5, 6)] == [3, 7, 11]
+    thread.join()
+    lines = get_output_lines(''.join(chunks))
+    assert [line for line in lines if line.startswith('Return value')] == \
+                                   ['Return value:.. 3', 'Return value:.. 7']
+    assert 'Starting var:.. x = 1,    y = 2,    y - x = 1' in lines
+    # Put back once the calls are done:
+    assert not hasattr(_add, '__wrapped__')
+
+
+def test_snoop_method(server):
+    thread, chunks = _send_in_thread(
+        server, 'snoop {}:_Thing.double depth=1'.format(__name__)
+    )
+    _wait_for(lambda: hasattr(_Thing.double, '__wrapped__'))
+    assert _Thing.double(4) == 8
+    thread.join()
+    assert 'Return value:.. 8' in get_output_lines(''.join(chunks))
+    assert isinstance(vars(_Thing)['double'], staticmethod)
+    assert not hasattr(_Thing.double, '__wrapped__')
+
+
+def test_client_gone(server):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(server.path)
+    client.sendall('snoop {}:_add calls=5\n'.format(__name__).encode())
+    _wait_for(lambda: hasattr(_add, '__wrapped__'))
+    client.close()
+    _wait_for(lambda: not hasattr(_add, '__wrapped__'))
+    assert _add(1, 1) == 2
+
+
+def test_switch(server):
+    assert _send(server, 'status') == 'snooping is on\n'
+    assert _send(server, 'disable') == 'snooping is off\n'
+    assert _send(server, 'snoop {}:_add'.format(__name__)).startswith(
+                                                                     'error: ')
+    assert _send(server, 'enable') == 'snooping is on\n'
+
+
+@pytest.mark.parametrize('command', [
+    '', 'frobnicate', 'snoop', 'snoop _add', 'snoop no_such_module:f',
+    'snoop {}:_nothing'.format(__name__), 'snoop {}:_add output=1'.format(
+                                                                     __name__),
+    'snoop {}:_add calls=0'.format(__name__),
+    'snoop {}:_add depth=two'.format(__name__),
+    'snoop {}:_Thing'.format(__name__),
+])
+def test_errors(server, command):
+    answer = _send(server, command)
+    assert answer.startswith('error: ') and answer.endswith('\n')
+    assert not hasattr(_add, '__wrapped__')
+
+
+def test_stale_socket(tmp_path):
+    path = str(tmp_path / 'control.sock')
+    control.serve(path).close()
+    # Closing a server that crashed leaves its socket behind:
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    control_server = control.serve(path)
+    with pytest.raises(OSError):
+        control.serve(path)
+    control_server.close()
+
+
+def test_socket_permissions(server):
+    assert stat.S_IMODE(os.lstat(server.path).st_mode) == 0o600
+
+
+@pytest.mark.parametrize('make_path', [
+    lambda path: path.write_text(u'not a socket'),
+    lambda path: path.mkdir(),
+    lambda path: path.symlink_to(path.parent / 'nothing'),
+])
+def test_path_that_is_not_a_socket(tmp_path, make_path):
+    path = tmp_path / 'control.sock'
+    make_path(path)
+    with pytest.raises(OSError):
+        control.serve(str(path))
+    assert os.path.lexists(str(path))
@@ -0,0 +1,181 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import events, writers
+from dbgsnooper.events import Event, RingBuffers
+from dbgsnooper.trace_reader import TraceReader
+from .utils import get_output_lines
+
+
+def _double(x):
+    y = x * 2
+    if x < 0:
+        raise KeyError(x)
+    return y
+
+
+def test_ring_buffers():
+    ring_buffers = RingBuffers(3)
+    for i in range(5):
+        ring_buffers.get().append(Event(events.TEXT, 0, data=i))
+    thread = threading.Thread(target=lambda: ring_buffers.get().append(
+        Event(events.TEXT, 0, data='thread')
+    ))
+    thread.start()
+    thread.join()
+    assert [event.data for event in ring_buffers.drain()] == \
+                                                          [2, 3, 4, 'thread']
+    assert ring_buffers.drain() == []
+    # The ring of a thread that's done goes once another thread comes along:
+    other_thread = threading.Thread(target=ring_buffers.get)
+    other_thread.start()
+    other_thread.join()
+    assert [ring_thread for ring_thread, _ in ring_buffers.rings] == \
+                                 [threading.current_thread(), other_thread]
+    with pytest.raises(ValueError):
+        RingBuffers(0)
+
+
+def test_dump():
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False, flight_recorder=4,
+                              dump_signal=None)
+    snooped_double = tracer(_double)
+    for x in range(3):
+        snooped_double(x)
+    assert string_io.getvalue() == ''
+    tracer.dump()
+    lines = get_output_lines(string_io.getvalue())
+    assert lines[0] == \
+                   '......Flight recorder: the last events before dump()......'
+    assert [line.split()[0] for line in lines[1:]] == \
+                                        ['line', 'return', 'Return', 'Elapsed']
+    assert lines[3] == 'Return value:.. 4'
+    # What was dumped is forgotten:
+    tracer.dump()
+    assert len(get_output_lines(string_io.getvalue())) == 5
+
+
+
+def test_binary_dump_of_threads(tmp_path):
+    path = str(tmp_path / 'foo.dbgsnoop')
+    tracer = dbgsnooper.snoop(path, format='binary', flight_recorder=100,
+                              dump_signal=None)
+    snooped_double = tracer(_double)
+    results = {}
+    # Idents of threads that are done get reused:
+    barrier = threading.Barrier(4)
+
+    def run(x):
+        results[threading.get_ident()] = str(snooped_double(x))
+        barrier.wait()
+
+    threads = [threading.Thread(target=run, args=(x,)) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tracer.dump()
+    writers.flush_all()
+    with TraceReader(path) as reader:
+        recorded_events = list(reader.read())
+    # Each event has the thread it happened in, not the one that dumped it:
+    calls = [event for event in recorded_events if event.kind == 'call']
+    assert sorted(event.thread for event in calls) == sorted(results)
+    for event in recorded_events:
+        if event.kind == events.RETURN_VALUE:
+            assert event.data == results[event.thread]
+
+def test_dump_on():
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False, flight_recorder=100,
+                              dump_on=KeyError, dump_signal=None)
+    snooped_double = tracer(_double)
+    snooped_double(1)
+    with pytest.raises(KeyError):
+        snooped_double(-1)
+    lines = get_output_lines(string_io.getvalue())
+    # Dumped once, where the exception was raised:
+    assert lines[0] == \
+                '......Flight recorder: the last events before a KeyError......'
+    assert lines[-1] == 'Exception:..... KeyError: -1'
+    assert 'Return value:.. 2' in lines
+    with pytest.raises(ValueError):
+        dbgsnooper.snoop(dump_on=KeyError)
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='Needs SIGUSR1.')
+def test_dump_signal():
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False, flight_recorder=100)
+    tracer(_double)(21)
+    os.kill(os.getpid(), signal.SIGUSR1)
+    lines = get_output_lines(string_io.getvalue())
+    assert lines[0] == \
+                  '......Flight recorder: the last events before SIGUSR1......'
+    assert 'Return value:.. 42' in lines
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR2'), reason='Needs SIGUSR2.')
+def test_dump_signal_off_the_main_thread():
+    errors = []
+
+    def make_tracers():
+        try:
+            dbgsnooper.snoop(io.StringIO(), flight_recorder=100,
+                             dump_signal=signal.SIGUSR2)
+        except RuntimeError as error:
+            errors.append(error)
+        dbgsnooper.snoop(io.StringIO(), flight_recorder=100, dump_signal=None)
+
+    thread = threading.Thread(target=make_tracers)
+    thread.start()
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_uncaught_exceptions(tmp_path):
+    script_path = tmp_path / 'crashing_script.py'
+    script_path.write_text(textwrap.dedent('''\
+        import threading
+        import dbgsnooper
+
+        @dbgsnooper.snoop(color=False, flight_recorder=100)
+        def work(x):
+            y = x + 1
+            if x == 2:
+                raise ValueError(y)
+            return y
+
+        thread = threading.Thread(target=work, args=(2,), name='worker')
+        thread.start()
+        thread.join()
+        work(1)
+        work(2)
+    '''))
+    package_dir = os.path.dirname(os.path.dirname(dbgsnooper.__file__))
+    environ = dict(os.environ, PYTHONPATH=package_dir)
+    process = subprocess.run([sys.executable, str(script_path)],
+                             stderr=subprocess.PIPE, env=environ,
+                             universal_newlines=True)
+    assert process.returncode == 1
+    lines = [line.strip() for line in process.stderr.splitlines()]
+    assert '......Flight recorder: the last events before an uncaught ' \
+           'ValueError in thread worker......' in lines
+    assert '......Flight recorder: the last events before an uncaught ' \
+           'ValueError......' in lines
+    assert lines.count('New var:....... y = 3') == 2
+    assert lines.count('Return value:.. 2') == 1
+    # The exceptions are still reported after the dumps:
+    assert lines[-1] == 'ValueError: 3'
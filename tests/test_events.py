@@ -0,0 +1,155 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import datetime as datetime_module
+import io
+import os
+import subprocess
+import sys
+import textwrap
+
+import dbgsnooper
+from dbgsnooper import events
+from dbgsnooper.code_info import get_code_info
+from dbgsnooper.events import Event, EventBuffer, TextRenderer
+from dbgsnooper.tracer import get_path_and_source_from_frame
+
+
+def test_render():
+    frame = sys._getframe()
+    code_info = get_code_info(frame.f_code)
+    if code_info.path_and_source is None:
+        code_info.path_and_source = get_path_and_source_from_frame(frame)
+    line_no = frame.f_code.co_firstlineno
+    renderer = TextRenderer(prefix='ZZ ', color=True)
+    render = renderer.render
+
+    assert render(Event('call', 2, line_no, frame.f_code, '1-Main ')) == (
+        '        \x1b[2m1-Main call      {:4}\x1b[0m def test_render():'
+        .format(line_no)
+    )
+    assert render(Event(events.NEW_VARS, 1, data=[('x', '1'), ('y', "'a'")])) \
+                == "    \x1b[32m\x1b[2mNew var:....... \x1b[22mx = 1,    " \
+                   "y = 'a'\x1b[0m"
+    assert render(Event(events.MODIFIED_VARS, 0, data=[('x', '2')])) == \
+                      '\x1b[32m\x1b[2mModified var:.. \x1b[22mx = 2\x1b[0m'
+    assert render(Event(events.SOURCE_PATH, 1, data='/a.py')) == \
+                   '\x1b[33m\x1b[2m    Source path:... \x1b[22m/a.py\x1b[0m'
+    assert render(Event(events.CALL_ENDED_BY_EXCEPTION, 1)) == \
+                               '\x1b[31m    Call ended by exception\x1b[0m'
+    assert render(Event(events.BODY_OMITTED, 1, thread_info='1-Main ')) == \
+                  '    \x1b[2m1-Main \x1b[0m    ... (function body omitted)'
+    assert render(Event(events.ELAPSED_TIME, -1,
+                        data=datetime_module.timedelta(seconds=1.5))) == \
+                       '\x1b[33m\x1b[2mElapsed time: \x1b[22m00:00:01.500000\x1b[0m'
+    assert render(Event(events.STATES_DROPPED, 0, data=(3, 1000))) == \
+                 '\x1b[33m\x1b[2mStates dropped:... \x1b[22m3 ' \
+                 '(over max_state_size=1000)\x1b[0m'
+    assert renderer.render_lines([Event(events.TEXT, 3, data='hi')]) == \
+                                                                 ['ZZ hi\n']
+
+    plain = TextRenderer().render
+    assert plain(Event(events.EXCEPTION_VALUE, 1, data='ValueError')) == \
+                                             '    Exception:..... ValueError'
+    assert plain(Event(events.SKIPPED, 0)) == \
+                           '......Skipping repeated execution details......'
+
+
+class Sink(object):
+    def __init__(self, name, written):
+        self.name = name
+        self.written = written
+
+    def write_events(self, events):
+        self.written.extend((self.name, event.data) for event in events)
+
+
+def test_event_buffer():
+    written = []
+    first, second = Sink('first', written), Sink('second', written)
+    event_buffer = EventBuffer(max_events=4)
+    assert not event_buffer.add(first, Event(events.TEXT, 0, data=1))
+    assert not event_buffer.add(second, Event(events.TEXT, 0, data=2))
+    assert not event_buffer.add(second, Event(events.TEXT, 0, data=3))
+    assert len(event_buffer) == 3
+    assert event_buffer.add(first, Event(events.TEXT, 0, data=4))
+    event_buffer.flush()
+    assert written == [('first', 1), ('second', 2), ('second', 3),
+                       ('first', 4)]
+    assert len(event_buffer) == 0
+    event_buffer.flush()
+    assert len(written) == 4
+
+
+def test_event_buffer_delay():
+    written = []
+    sink = Sink('sink', written)
+    event_buffer = EventBuffer(max_delay=0.1)
+    first = Event(events.TEXT, 0, data=1)
+    assert not event_buffer.add(sink, first)
+    late = Event(events.TEXT, 0, data=2)
+    late.timestamp = first.timestamp + int(0.2 * 1e9)
+    assert event_buffer.add(sink, late)
+    event_buffer.flush()
+    assert written == [('sink', 1), ('sink', 2)]
+
+
+def test_output_is_written_as_it_happens():
+    string_io = io.StringIO()
+
+    @dbgsnooper.snoop(string_io, color=False)
+    def my_function():
+        string_io.write('from the program\n')
+        return 7
+
+    assert my_function() == 7
+    lines = [line.strip() for line in string_io.getvalue().splitlines()]
+    index = lines.index('from the program')
+    assert lines[index - 1].endswith("string_io.write('from the program\\n')")
+    assert lines[index + 1].endswith('return 7')
+    assert lines[-2] == 'Return value:.. 7'
+    assert lines[-1].startswith('Elapsed time: ')
+
+
+def test_output_survives_a_hard_exit(tmp_path):
+    script = tmp_path / 'hard_exit.py'
+    script.write_text(textwrap.dedent(u'''
+        import os
+        import dbgsnooper
+
+        @dbgsnooper.snoop(color=False)
+        def my_function():
+            x = 7
+            os._exit(0)
+
+        my_function()
+    '''))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    process = subprocess.run([sys.executable, str(script)], env=env,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    assert process.returncode == 0
+    lines = [line.strip() for line in process.stderr.splitlines()]
+    assert 'New var:....... x = 7' in lines
+    assert lines[-1].endswith('os._exit(0)')
+
+
+def test_tracers_keep_their_order():
+    string_io = io.StringIO()
+
+    @dbgsnooper.snoop(string_io, color=False, normalize=True, prefix='inner ')
+    def inner(x):
+        return x + 1
+
+    @dbgsnooper.snoop(string_io, color=False, normalize=True, prefix='outer ')
+    def outer():
+        y = inner(1)
+        return y
+
+    assert outer() == 2
+    prefixes = [line.split()[0] for line in string_io.getvalue().splitlines()]
+    first_inner = prefixes.index('inner')
+    last_inner = len(prefixes) - prefixes[::-1].index('inner')
+    assert set(prefixes[first_inner:last_inner]) == {'inner'}
+    assert 'outer' in prefixes[:first_inner]
+    assert 'outer' in prefixes[last_inner:]
@@ -0,0 +1,112 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import sys
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import monitoring, recording
+from .utils import get_output_lines
+
+BACKENDS = ['settrace'] + (['monitoring'] if monitoring.MONITORING_AVAILABLE
+                           else [])
+
+
+def _lookup(key):
+    table = {'a': 1}
+    return table[key]
+
+
+def _work(key):
+    found = []
+    for i in range(3):
+        found.append(i)
+    try:
+        _lookup(key * 2)
+    except KeyError:
+        pass
+    return _lookup(key)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_exceptions_only(backend):
+    string_io = io.StringIO()
+    snooped_work = dbgsnooper.snoop(string_io, color=False, depth=2,
+                                    backend=backend,
+                                    exceptions_only=True)(_work)
+    with pytest.raises(KeyError):
+        snooped_work('b')
+    assert get_output_lines(string_io.getvalue(), elapsed_time=False) == [
+        'Source path:... {}'.format(__file__),
+        # The frames that an exception got to, innermost first:
+        "Locals:........ key = 'bb', table = {'a': 1}",
+        'exception   19     return table[key]',
+        "Exception:..... KeyError: 'bb'",
+        "Locals:........ key = 'b', found = [0, 1, 2], i = 2",
+        'exception   27         _lookup(key * 2)',
+        "Exception:..... KeyError: 'bb'",
+        "Locals:........ key = 'b', table = {'a': 1}",
+        'exception   19     return table[key]',
+        "Exception:..... KeyError: 'b'",
+        "Locals:........ key = 'b', found = [0, 1, 2], i = 2",
+        'exception   30     return _lookup(key)',
+        "Exception:..... KeyError: 'b'",
+    ]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_no_line_events(backend):
+    string_io = io.StringIO()
+    seen = []
+
+    @dbgsnooper.snoop(string_io, color=False, backend=backend,
+                      exceptions_only=True)
+    def f():
+        if backend == 'settrace':
+            seen.append(sys._getframe().f_trace_lines)
+        else:
+            seen.append(sys.monitoring.get_events(
+                monitoring.get_monitor().tool_id
+            ) == monitoring.EXCEPTION_EVENTS)
+        try:
+            int('x')
+        except ValueError:
+            pass
+
+    f()
+    assert seen == [False if backend == 'settrace' else True]
+    lines = get_output_lines(string_io.getvalue(), elapsed_time=False)
+    assert [line.split()[0] for line in lines] == \
+                              ['Source', 'Locals:........', 'exception',
+                               'Exception:.....']
+
+
+def test_with_block():
+    string_io = io.StringIO()
+    with dbgsnooper.snoop(string_io, color=False, exceptions_only=True):
+        try:
+            _lookup('c')
+        except KeyError:
+            pass
+    lines = get_output_lines(string_io.getvalue(), elapsed_time=False)
+    # Only the block's frame is snooped:
+    assert [line for line in lines if line.startswith('exception')] == \
+                                   ["exception   90             _lookup('c')"]
+    assert lines[-1] == "Exception:..... KeyError: 'c'"
+
+
+def test_recording():
+    bytes_io = io.BytesIO()
+    snooped_lookup = dbgsnooper.snoop(bytes_io, format='binary',
+                                      exceptions_only=True)(_lookup)
+    with pytest.raises(KeyError):
+        snooped_lookup('d')
+    string_io = io.StringIO()
+    recording.render(bytes_io.getvalue(), string_io.write)
+    assert get_output_lines(string_io.getvalue(), elapsed_time=False)[1:] == [
+        "Locals:........ key = 'd', table = {'a': 1}",
+        'exception   19     return table[key]',
+        "Exception:..... KeyError: 'd'",
+    ]
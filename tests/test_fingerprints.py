@@ -0,0 +1,67 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+
+import dbgsnooper
+from dbgsnooper.fingerprints import (get_fingerprint, matches, ReprCache,
+                                     IMMUTABLE)
+
+
+class Plain(object):
+    pass
+
+
+class Fancy(object):
+    def __repr__(self):
+        return 'Fancy()'
+
+
+def test_get_fingerprint():
+    assert get_fingerprint(7) is IMMUTABLE
+    assert get_fingerprint(Fancy()) is None
+    assert get_fingerprint(Plain()) is Plain
+    assert get_fingerprint(Plain(), default_repr_is_stable=False) is None
+
+    x = [1, 'a', (2, 3), {'b': [4]}]
+    fingerprint = get_fingerprint(x)
+    assert matches(fingerprint, x)
+    x[3]['b'].append(5)
+    assert not matches(fingerprint, x)
+    fingerprint = get_fingerprint(x)
+    x[2] = tuple([2, 3])
+    assert not matches(fingerprint, x)
+
+    deep = []
+    deep.append(deep)
+    assert get_fingerprint(deep) is None
+
+
+def test_repr_cache():
+    repr_cache = ReprCache()
+    x = [1, 2]
+    assert repr_cache.get_repr('x', x) == '[1, 2]'
+    x[0] = 1.0
+    assert repr_cache.get_repr('x', x) == '[1.0, 2]'
+    x.append(True)
+    assert repr_cache.get_repr('x', x) == '[1.0, 2, True]'
+    assert repr_cache.get_repr('x', 3) == '3'
+    repr_cache.prune(())
+    assert not repr_cache.entries
+
+
+def test_mutations_are_reported():
+    string_io = io.StringIO()
+
+    @dbgsnooper.snoop(string_io, color=False)
+    def my_function():
+        x = {'a': [1]}
+        x['a'].append(2)
+        x['a'][0] = 1.0
+        return len(x)
+
+    my_function()
+    modified = [line.strip() for line in string_io.getvalue().splitlines()
+                if 'Modified var' in line]
+    assert modified == ["Modified var:.. x = {'a': [1, 2]}",
+                        "Modified var:.. x = {'a': [1.0, 2]}"]
@@ -0,0 +1,166 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import gc
+import io
+import sys
+import textwrap
+import weakref
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import monitoring
+from dbgsnooper.frame_states import FrameStates, FRAME_STATE_SIZE
+from .utils import temp_module
+
+BACKENDS = ['settrace']
+if monitoring.MONITORING_AVAILABLE:
+    BACKENDS.append('monitoring')
+
+
+class Thing(object):
+    pass
+
+
+def test_frame_states():
+    frame_states = FrameStates(max_size=2 * FRAME_STATE_SIZE)
+    frame = sys._getframe()
+    state = frame_states.get_or_add(frame)
+    assert frame_states.get_or_add(frame) is state
+    assert state.code is frame.f_code
+    assert frame_states.size == FRAME_STATE_SIZE
+
+    other_frames = []
+    def f():
+        other_frames.append(sys._getframe())
+    f()
+    f()
+    other_state = frame_states.get_or_add(other_frames[0])
+    assert other_state.serial > state.serial
+    frame_states.get_or_add(other_frames[1])
+    # The least recently used state went over the limit:
+    assert frame_states.get(frame) is None
+    assert frame_states.pop_new_evictions() == 1
+    assert frame_states.pop_new_evictions() == 0
+    assert frame_states.release(other_frames[0]) is other_state
+    assert frame_states.release(other_frames[0]) is None
+    assert len(frame_states) == 1
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_frames_are_released(backend):
+    string_io = io.StringIO()
+    things = []
+    tracer = dbgsnooper.snoop(string_io, color=False, depth=2,
+                              backend=backend)
+
+    def helper():
+        thing = Thing()
+        things.append(weakref.ref(thing))
+        return 1
+
+    @tracer
+    def my_function():
+        thing = Thing()
+        things.append(weakref.ref(thing))
+        return sum(helper() for _ in range(2))
+
+    def generator():
+        for i in range(3):
+            thing = Thing()
+            things.append(weakref.ref(thing))
+            yield i
+
+    assert my_function() == 2
+    for i in tracer(generator)():
+        pass
+    gc.collect()
+    assert len(tracer.frame_states) == 0
+    assert things and not any(thing() for thing in things)
+
+
+def test_state_ceiling():
+    string_io = io.StringIO()
+
+    def generator(n):
+        payload = ['x' * 100] * n
+        yield len(payload)
+
+    @dbgsnooper.snoop(string_io, color=False, normalize=True, depth=2,
+                      max_state_size=FRAME_STATE_SIZE * 3)
+    def my_function():
+        generators = [generator(n) for n in range(10)]
+        return sum(next(g) for g in generators)
+
+    assert my_function() == 45
+    lines = string_io.getvalue().splitlines()
+    assert lines[-1].strip().startswith('States dropped:...')
+
+
+def test_stale_state_is_dropped():
+    tracer = dbgsnooper.snoop(io.StringIO(), color=False, normalize=True)
+
+    def generator():
+        yield 1
+
+    gen = generator()
+    frame = gen.gi_frame
+    tracer.target_codes.add(frame.f_code)
+    # Left by an earlier frame that had the same id, and was never done:
+    stale_state = tracer.frame_states.get_or_add(frame)
+    stale_state.local_reprs = {'x': '1'}
+    tracer.trace(frame, 'call', None)
+    frame_state = tracer.frame_states.get(frame)
+    assert frame_state is not None and frame_state is not stale_state
+    assert frame_state.local_reprs == {}
+    # Resuming a frame keeps its state:
+    next(gen)
+    tracer.trace(frame, 'call', None)
+    assert tracer.frame_states.get(frame) is frame_state
+
+
+OBSERVED_SOURCE = textwrap.dedent('''\
+    def inner(n):
+        return [n] * n
+
+
+    def outer(n):
+        total = 0
+        for i in range(n):
+            total += len(inner(i))
+        return total
+''')
+
+
+def test_observed_file_with_dropped_states(tmp_path, capsys):
+    string_io = io.StringIO()
+    with temp_module(tmp_path, 'observed_module',
+                     OBSERVED_SOURCE) as observed_module:
+        tracer = dbgsnooper.snoop(string_io, color=False, normalize=True,
+                                  observed_file=observed_module.__file__,
+                                  start_line=6, end_line=10, depth=2,
+                                  max_state_size=1)
+        with tracer:
+            assert observed_module.outer(5) == 10
+    assert 'Return value:.. 10' in string_io.getvalue()
+    assert 'States dropped:...' in string_io.getvalue()
+    assert capsys.readouterr().out == ''
+
+
+def test_call_graph_with_dropped_states(monkeypatch, capsys):
+    tracer = dbgsnooper.snoop(io.StringIO(), color=False, depth=2,
+                              call_graph_mode=True, max_state_size=1)
+    monkeypatch.setattr(tracer, 'write_call_graph', lambda: None)
+
+    def helper(n):
+        return n + 1
+
+    @tracer
+    def my_function():
+        return sum(helper(i) for i in range(3))
+
+    assert my_function() == 6
+    assert capsys.readouterr().out == ''
+    assert any('Call ... ' in line for call_info in tracer.call_infos
+               for line in call_info['content'])
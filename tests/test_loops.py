@@ -0,0 +1,184 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import inspect
+import io
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import monitoring
+from dbgsnooper.code_info import find_loops
+from dbgsnooper.loops import FrameLoops
+from .utils import get_output_lines, get_snoop_lines
+
+BACKENDS = ['settrace']
+if monitoring.MONITORING_AVAILABLE:
+    BACKENDS.append('monitoring')
+
+
+def test_find_loops():
+    source = [
+        'def f(items):',
+        '    for item in items:',
+        '        try:',
+        '            item += 1',
+        '        except TypeError:',
+        '            pass',
+        '',
+        '        # Done.',
+        '    while items:',
+        '        items.pop()',
+        '    return [x for x in items]',
+    ]
+    namespace = {}
+    exec(compile('\n'.join(source), '<loops>', 'exec'), namespace)
+    loops = find_loops(namespace['f'].__code__, source)
+    assert loops[2] == set(range(2, 7))
+    assert loops[9] == {9, 10}
+    assert set(loops) <= {2, 9, 11}
+
+
+def test_frame_loops():
+    frame_loops = FrameLoops({2: frozenset((2, 3))}, 2, shown_iteration=4)
+    shown = [frame_loops.update(line_no) for line_no in (1, 2, 3, 2, 3, 2, 3)]
+    assert shown == [True, True, True, True, True, False, False]
+    assert frame_loops.suppressed_lines is None
+    assert frame_loops.update(2)
+    assert frame_loops.update(3)
+    assert not frame_loops.update(2)
+    assert frame_loops.suppressed_lines == {2, 3}
+    assert not frame_loops.left_suppressed_lines
+    assert frame_loops.update(4)
+    assert frame_loops.left_suppressed_lines
+    assert frame_loops.suppressed_lines is None
+
+
+
+def test_new_lines_past_the_limit():
+    frame_loops = FrameLoops({2: frozenset((2, 3, 4))}, 1)
+    shown = [frame_loops.update(line_no) for line_no in (1, 2, 3, 2, 3, 2)]
+    assert shown == [True, True, True, False, False, False]
+    assert frame_loops.suppressed_lines == {2, 3}
+    # A line the loop didn't run yet is shown, once:
+    assert frame_loops.update(4)
+    assert frame_loops.suppressed_lines == {2, 3, 4}
+    assert not frame_loops.update(2)
+    assert not frame_loops.update(4)
+
+def _looping(n):
+    total = 0
+    for i in range(n):
+        total += i
+        if i % 7 == 0:
+            total -= 1
+        j = 0
+        while j < 3:
+            j += 1
+            try:
+                if j == 2:
+                    raise ValueError
+            except ValueError:
+                continue
+        if i == n - 2:
+            break
+    squares = [k * k for k in range(n)]
+    after = total
+    return after, len(squares)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_loop_iterations_are_limited(backend):
+    lines = get_snoop_lines(_looping, (1000,), backend=backend)
+    assert len(lines) < 200
+    assert 'Modified var:.. total = 498358, i = 998' in lines
+    assert lines[-1] == 'Return value:.. (498358, 1000)'
+    assert lines == get_snoop_lines(_looping, (1000,), backend='settrace')
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_loops_without_source(backend):
+    namespace = {}
+    exec(compile(inspect.getsource(_looping), '<looping>', 'exec'), namespace)
+    lines = get_snoop_lines(namespace['_looping'], (1000,), backend=backend)
+    assert len(lines) < 200
+    assert 'Modified var:.. total = 498358, i = 998' in lines
+    assert lines[-1] == 'Return value:.. (498358, 1000)'
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_loops_with_all_variables_checked(backend, monkeypatch):
+    lines = get_snoop_lines(_looping, (10,), backend=backend)
+    monkeypatch.setattr(dbgsnooper.tracer.Tracer, 'get_dirty_names',
+                        lambda *args: None)
+    assert lines == get_snoop_lines(_looping, (10,), backend=backend)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_loop_in_recursion(backend):
+    def f(n):
+        result = 0
+        for i in range(5):
+            result += i
+            if n and i == 4:
+                result += f(n - 1)
+        return result
+
+    lines = get_snoop_lines(f, (2,), backend=backend)
+    assert lines[-1] == 'Return value:.. 30'
+    assert lines.count('Return value:.. 10') == 1
+    assert lines.count('Return value:.. 20') == 1
+    assert lines == get_snoop_lines(f, (2,), backend='settrace')
+
+
+def _raising_in_loop(n):
+    total = 0
+    for i in range(20):
+        total += i
+        if i == n:
+            raise ValueError(i)
+    return total
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_exception_after_the_loop_limit(backend):
+    string_io = io.StringIO()
+    with pytest.raises(ValueError):
+        dbgsnooper.snoop(string_io, color=False, normalize=True,
+                         backend=backend)(_raising_in_loop)(7)
+    lines = get_output_lines(string_io.getvalue())
+    assert '......Skipping repeated execution details......' in lines
+    assert lines[-4].startswith('exception')
+    assert lines[-4].endswith('raise ValueError(i)')
+    assert lines[-3] == 'Exception:..... ValueError: 7'
+    assert lines[-2] == 'Call ended by exception'
+
+
+def _returning_in_loop(n):
+    total = 0
+    for i in range(20):
+        total += i
+        if i == n:
+            return i
+    return total
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_new_line_after_the_loop_limit(backend, monkeypatch):
+    lines = get_snoop_lines(_returning_in_loop, (7,), backend=backend)
+    return_line_no = str(_returning_in_loop.__code__.co_firstlineno + 5)
+    assert lines[-5:-3] == [
+        '......Skipping repeated execution details......',
+        'Modified var:.. total = 28, i = 7',
+    ]
+    assert [line.split() for line in lines[-3:-1]] == [
+        ['line', return_line_no, 'return', 'i'],
+        ['return', return_line_no, 'return', 'i'],
+    ]
+    assert lines[-1] == 'Return value:.. 7'
+    assert lines == get_snoop_lines(_returning_in_loop, (7,),
+                                    backend='settrace')
+    monkeypatch.setattr(dbgsnooper.tracer.Tracer, 'get_dirty_names',
+                        lambda *args: None)
+    assert lines == get_snoop_lines(_returning_in_loop, (7,),
+                                    backend=backend)
@@ -0,0 +1,165 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import threading
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import monitoring
+from .utils import get_snoop_lines
+
+
+def _snoop_output(backend, depth):
+    string_io = io.StringIO()
+
+    def helper(x):
+        y = x * 2
+        return y
+
+    @dbgsnooper.snoop(string_io, color=False, normalize=True, depth=depth,
+                      backend=backend)
+    def my_function(foo):
+        total = 0
+        for i in range(5):
+            total += helper(i)
+        return total
+
+    assert my_function('baba') == 20
+    return string_io.getvalue().splitlines()
+
+
+@pytest.mark.skipif(not monitoring.MONITORING_AVAILABLE,
+                    reason='sys.monitoring needs Python 3.12+')
+@pytest.mark.parametrize('depth', (1, 2))
+def test_monitoring_matches_settrace(depth):
+    settrace_lines = _snoop_output('settrace', depth)
+    monitoring_lines = _snoop_output('monitoring', depth)
+    elapsed = [line for line in settrace_lines if 'Elapsed time' in line]
+    assert len(elapsed) == 1
+    assert [line for line in monitoring_lines if 'Elapsed time' not in line] \
+        == [line for line in settrace_lines if 'Elapsed time' not in line]
+
+
+def test_monitoring_unavailable():
+    if monitoring.MONITORING_AVAILABLE:
+        pytest.skip()
+    with pytest.raises(NotImplementedError):
+        dbgsnooper.snoop(backend='monitoring')
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        dbgsnooper.snoop(backend='ptrace')
+
+
+def _helper(x):
+    y = x + 1
+    return y
+
+
+@pytest.mark.skipif(not monitoring.MONITORING_AVAILABLE,
+                    reason='sys.monitoring needs Python 3.12+')
+def test_tracer_in_another_thread_sees_calls():
+    full_output, exceptions_output = io.StringIO(), io.StringIO()
+    started, done = threading.Event(), threading.Event()
+
+    @dbgsnooper.snoop(full_output, color=False, depth=2,
+                      backend='monitoring')
+    def snooped_in_thread():
+        started.set()
+        assert done.wait(5)
+        return _helper(1)
+
+    @dbgsnooper.snoop(exceptions_output, color=False, exceptions_only=True,
+                      backend='monitoring')
+    def snooped_for_exceptions():
+        # Of no interest to this tracer, but of interest to the other one:
+        return _helper(2)
+
+    thread = threading.Thread(target=snooped_in_thread)
+    thread.start()
+    assert started.wait(5)
+    assert snooped_for_exceptions() == 3
+    done.set()
+    thread.join()
+    assert 'def _helper(x):' in full_output.getvalue()
+    assert 'Return value:.. 2' in full_output.getvalue()
+
+
+@pytest.mark.skipif(not monitoring.MONITORING_AVAILABLE,
+                    reason='sys.monitoring needs Python 3.12+')
+def test_outer_tracer_sees_calls_after_inner_one():
+    string_io = io.StringIO()
+
+    @dbgsnooper.snoop(io.StringIO(), color=False, exceptions_only=True,
+                      backend='monitoring')
+    def inner():
+        return _helper(1)
+
+    @dbgsnooper.snoop(string_io, color=False, depth=2, backend='monitoring')
+    def outer():
+        x = inner()
+        return _helper(x)
+
+    assert outer() == 3
+    assert 'Return value:.. 3' in string_io.getvalue()
+    assert string_io.getvalue().count('def _helper(x):') == 1
+
+
+@pytest.mark.skipif(not monitoring.MONITORING_AVAILABLE,
+                    reason='sys.monitoring needs Python 3.12+')
+def test_tracers_in_many_threads():
+    outputs, errors = [], []
+
+    def run():
+        try:
+            for i in range(20):
+                string_io = io.StringIO()
+                outputs.append(string_io)
+
+                @dbgsnooper.snoop(string_io, color=False, depth=2,
+                                  backend='monitoring')
+                def my_function(x):
+                    return _helper(x) + _helper(x)
+
+                assert my_function(i) == 2 * i + 2
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(outputs) == 160
+    for string_io in outputs:
+        assert string_io.getvalue().count('def _helper(x):') == 2
+
+
+def _appending(items):
+    for item in items:
+        yield item
+        items.append(item * 2) if len(items) < 6 else None
+
+
+def _iterating_over_generator():
+    lst = [1, 2]
+    g = _appending(lst)
+    total = 0
+    for x in g:
+        total += x
+    return total
+
+
+@pytest.mark.skipif(not monitoring.MONITORING_AVAILABLE,
+                    reason='sys.monitoring needs Python 3.12+')
+def test_monitoring_sees_variables_changed_by_unseen_calls():
+    lines = get_snoop_lines(_iterating_over_generator, backend='monitoring',
+                            depth_expanded=False)
+    assert lines == get_snoop_lines(_iterating_over_generator,
+                                    backend='settrace', depth_expanded=False)
+    assert 'Modified var:.. lst = [1, 2, 2], x = 2' in lines
+
@@ -0,0 +1,109 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import sys
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import cli, recording
+
+
+class Thing(object):
+    pass
+
+
+def my_function(n):
+    things = []
+    for i in range(n):
+        things.append(i * 2)
+    thing = Thing()
+    return len(things)
+
+
+def _snoop_text(function, *args, **kwargs):
+    string_io = io.StringIO()
+    dbgsnooper.snoop(string_io, **kwargs)(function)(*args)
+    return _without_elapsed_time(string_io.getvalue())
+
+
+def _snoop_binary(function, *args, **kwargs):
+    bytes_io = io.BytesIO()
+    dbgsnooper.snoop(bytes_io, format='binary', **kwargs)(function)(*args)
+    return bytes_io.getvalue()
+
+
+def _render(data, **kwargs):
+    string_io = io.StringIO()
+    recording.render(data, string_io.write, **kwargs)
+    return _without_elapsed_time(string_io.getvalue())
+
+
+def _without_elapsed_time(text):
+    return [line for line in text.splitlines() if 'Elapsed time' not in line]
+
+
+def test_render_like_text():
+    data = _snoop_binary(my_function, 5, depth=2, normalize=True)
+    assert _render(data) == \
+             _snoop_text(my_function, 5, depth=2, color=False, normalize=True)
+    assert _render(data, color=True, prefix='ZZ ') == _snoop_text(
+        my_function, 5, depth=2, color=True, prefix='ZZ ', normalize=True
+    )
+    # Normalizing when rendering works too, as long as no repr was cut:
+    data = _snoop_binary(my_function, 5, depth=2)
+    assert 'object at 0x' in '\n'.join(_render(data))
+    assert _render(data, normalize=True) == \
+             _snoop_text(my_function, 5, depth=2, color=False, normalize=True)
+
+
+def test_events():
+    events = list(recording.read_events(_snoop_binary(my_function, 2)))
+    kinds = [event.kind for event in events]
+    assert kinds[:3] == ['source_path', 'starting_vars', 'call']
+    assert kinds[-2:] == ['return_value', 'elapsed_time']
+    call = events[2]
+    assert call.code.name == 'my_function'
+    assert call.code.path == __file__
+    assert call.line_no == call.code.first_line_no
+    timestamps = [event.timestamp for event in events]
+    assert timestamps == sorted(timestamps)
+
+
+def test_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(recording, 'MAX_TABLE_SIZE', 3)
+    path = str(tmp_path / 'foo.dbgsnoop')
+    dbgsnooper.snoop(path, format='binary')(my_function)(3)
+    dbgsnooper.snoop(path, format='binary')(my_function)(4)
+    with open(path, 'rb') as recording_file:
+        data = recording_file.read()
+    assert data.count(recording.MAGIC) > 2
+    lines = _render(data)
+    assert lines.count('Return value:.. 3') == 1
+    assert lines.count('Return value:.. 4') == 1
+
+    dbgsnooper.snoop(path, format='binary', overwrite=True)(my_function)(5)
+    with open(path, 'rb') as recording_file:
+        lines = _render(recording_file.read())
+    assert lines[-1] == 'Return value:.. 5'
+    assert 'Return value:.. 4' not in lines
+
+
+def test_render_command(tmp_path, monkeypatch):
+    path = str(tmp_path / 'foo.dbgsnoop')
+    dbgsnooper.snoop(path, format='binary')(my_function)(2)
+    output_path = str(tmp_path / 'foo.log')
+    monkeypatch.setattr(sys, 'argv', ['dbgsnooper', 'render', path,
+                                      '--normalize', '-o', output_path])
+    cli.main()
+    with open(output_path) as output_file:
+        lines = _without_elapsed_time(output_file.read())
+    assert lines == _snoop_text(my_function, 2, color=False, normalize=True)
+
+
+def test_not_a_recording():
+    with pytest.raises(recording.RecordingError):
+        list(recording.read_events(b'Source path:... foo.py\n'))
+    with pytest.raises(ValueError):
+        dbgsnooper.snoop(format='yaml')
@@ -0,0 +1,296 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import os
+import runpy
+import sys
+import textwrap
+
+import dbgsnooper
+from dbgsnooper import cli, replay, trace_var
+from dbgsnooper.utils import normalize_repr
+
+
+OBSERVED_SOURCE = textwrap.dedent('''\
+    import json
+
+    counter = 0
+
+
+    def helper(x):
+        return x * 2
+
+
+    def target(n):
+        global counter
+        total = 0
+        for i in range(n):
+            total += helper(i)
+            counter += 1
+        digits = ''.join(str(c) for c in range(n))
+        doubled = sum(double_all(n))
+        return json.dumps({'total': total})
+
+
+    def double_all(n):
+        for i in range(n):
+            yield helper(i)
+''')
+
+TEST_SOURCE = textwrap.dedent('''\
+    import observed_module
+    observed_module.target(6)
+    observed_module.target(2)
+''')
+
+TARGET_LINES = (10, 18)
+
+MUTATING_SOURCE = textwrap.dedent('''\
+    class P(object):
+        pass
+
+
+    def target():
+        p = P()
+        items = list(range(50))
+        for i in range(3):
+            p.a = i
+            items[25] = i
+        return p
+''')
+
+MUTATING_TEST_SOURCE = textwrap.dedent('''\
+    import observed_module
+    observed_module.target()
+''')
+
+
+def _write_files(tmp_path, observed_source=OBSERVED_SOURCE,
+                 test_source=TEST_SOURCE):
+    observed_path = tmp_path / 'observed_module.py'
+    observed_path.write_text(observed_source)
+    test_path = tmp_path / 'test_script.py'
+    test_path.write_text(test_source)
+    return str(test_path), str(observed_path)
+
+
+def _record(tmp_path, monkeypatch, **sources):
+    test_path, observed_path = _write_files(tmp_path, **sources)
+    recording_path = str(tmp_path / 'test.dbgsnoop')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    monkeypatch.delitem(sys.modules, 'observed_module', raising=False)
+    replay.record(test_path, [observed_path], recording_path)
+    sys.modules.pop('observed_module', None)
+    return test_path, observed_path, recording_path
+
+
+def _get_live_var_history(test_path, observed_path, name, line_no,
+                          is_global=False):
+    tracer = trace_var.VarTracer(name, test_path, is_global, observed_path,
+                                 line_no)
+    original_trace = sys.gettrace()
+    sys.settrace(tracer)
+    try:
+        runpy.run_path(test_path, run_name='__main__')
+    finally:
+        sys.settrace(original_trace)
+        sys.modules.pop('observed_module', None)
+    return tracer.history
+
+
+def _lines(text):
+    return [normalize_repr(line.strip()) for line in text.splitlines()
+            if not line.strip().startswith('Elapsed time')]
+
+
+def test_trace_method(tmp_path, monkeypatch):
+    test_path, observed_path, recording_path = _record(tmp_path, monkeypatch)
+    offline = io.StringIO()
+    with replay.Replay(recording_path) as recorded:
+        assert recorded.test_path == test_path
+        assert recorded.observed_files == set([observed_path])
+        recorded.write_trace_method(observed_path, TARGET_LINES[0],
+                                    TARGET_LINES[1], offline.write)
+    live = io.StringIO()
+    dbgsnooper.snoop(live, observed_file=observed_path,
+                     start_line=TARGET_LINES[0], end_line=TARGET_LINES[1],
+                     color=False)(runpy.run_path)(test_path)
+    sys.modules.pop('observed_module', None)
+    assert _lines(offline.getvalue()) == _lines(live.getvalue())
+    lines = _lines(offline.getvalue())
+    assert 'Starting var:.. n = 6' in lines
+    assert lines.count('......Skipping repeated execution details......') == 3
+    # The calls of helper and dumps, and of double_all and its resumptions:
+    assert lines.count('... (function body omitted)') == 5 + 2 + 2 + 5
+    # Globals are recorded for `trace_var`, but not shown like locals:
+    assert not [line for line in lines if 'counter =' in line]
+
+
+def _call_graph_lines(entries):
+    return [(entry['depth'], [normalize_repr(line) for line in entry['content']])
+            for entry in entries]
+
+
+def test_call_graph(tmp_path, monkeypatch):
+    test_path, observed_path, recording_path = _record(tmp_path, monkeypatch)
+    with replay.Replay(recording_path) as recorded:
+        entries = recorded.get_call_graph(observed_path, *TARGET_LINES)
+    tracer = dbgsnooper.snoop(io.StringIO(), observed_file=observed_path,
+                              start_line=TARGET_LINES[0],
+                              end_line=TARGET_LINES[1], call_graph_mode=True)
+    monkeypatch.setattr(tracer, 'write_call_graph', lambda: None)
+    tracer(runpy.run_path)(test_path)
+    sys.modules.pop('observed_module', None)
+    assert _call_graph_lines(entries) == _call_graph_lines(tracer.call_infos)
+    calls = [(entry['depth'], entry['content'][0]) for entry in entries]
+    assert calls[:6] == [
+        (1, 'Call ... def target(n):'),
+        (2, 'Call ... def helper(x):'),
+        (2, 'Call ... def helper(x):'),
+        (2, 'Call ... def helper(x):'),
+        (2, '......Skipping repeated (loop) calling details......'),
+        (2, "Call ...     digits = ''.join(str(c) for c in range(n))"),
+    ]
+    # Calls two levels down are in the recording too:
+    dumps_index = [call[1] for call in calls].index(
+        'Call ... def dumps(obj, *, skipkeys=False, ensure_ascii=True, '
+        'check_circular=True,'
+    )
+    assert calls[dumps_index + 1][0] == 3 and \
+                            'def encode(self, o):' in calls[dumps_index + 1][1]
+    assert calls[dumps_index + 2] == (1, 'Call ... def target(n):')
+    assert entries[0]['content'][2:] == [
+        'Starting var:.. n = 6', 'Return ...     return json.dumps('
+        "{'total': total})", 'Return value:.. \'{"total": 30}\''
+    ]
+    assert entries[1]['content'][2:] == [
+        'Starting var:.. x = 0', 'Return ...     return x * 2',
+        'Return value:.. 0'
+    ]
+    # A generator's entry has each time it was resumed, and what it yielded:
+    generator_content = entries[calls.index(
+        (2, 'Call ... def double_all(n):')
+    )]['content']
+    assert generator_content.count('Call ...         yield helper(i)') == 3
+    assert [line for line in generator_content
+            if line.startswith('Return value:..')] == [
+        'Return value:.. {}'.format(value) for value in (0, 2, 4, 6, 8, 10,
+                                                         None)
+    ]
+
+def test_var_history(tmp_path, monkeypatch):
+    test_path, observed_path, recording_path = _record(tmp_path, monkeypatch)
+    monkeypatch.setattr(trace_var, 'run_get_statement_range',
+                        lambda file_name, line_no: (line_no, line_no))
+    monkeypatch.setattr(trace_var, 'run_get_belonging_method',
+                        lambda file_name, line_no: TARGET_LINES)
+    with replay.Replay(recording_path) as recorded:
+        assert recorded.is_local(observed_path, 'total', *TARGET_LINES)
+        assert not recorded.is_local(observed_path, 'counter',
+                                     *TARGET_LINES)
+        history = recorded.get_var_history(observed_path, 'total',
+                                           *TARGET_LINES)
+        global_history = recorded.get_var_history(observed_path, 'counter',
+                                                  is_global=True)
+    assert history == _get_live_var_history(test_path, observed_path,
+                                            'total', 14)
+    assert [len(item) for item in history] == [4, 4, 4, 5, 5, 5, 4, 4, 4, 4]
+    assert global_history == _get_live_var_history(
+        test_path, observed_path, 'counter', 15, is_global=True
+    )
+    assert len(global_history) == 1 + 8
+
+
+def test_var_history_of_mutations(tmp_path, monkeypatch):
+    test_path, observed_path, recording_path = _record(
+        tmp_path, monkeypatch, observed_source=MUTATING_SOURCE,
+        test_source=MUTATING_TEST_SOURCE
+    )
+    monkeypatch.setattr(trace_var, 'run_get_statement_range',
+                        lambda file_name, line_no: (line_no, line_no))
+    monkeypatch.setattr(trace_var, 'run_get_belonging_method',
+                        lambda file_name, line_no: (5, 11))
+    with replay.Replay(recording_path) as recorded:
+        p_history = recorded.get_var_history(observed_path, 'p', 5, 11)
+        items_history = recorded.get_var_history(observed_path, 'items',
+                                                 5, 11)
+    # Changing an attribute or an item past what a repr shows is a change:
+    assert p_history == _get_live_var_history(test_path, observed_path, 'p',
+                                              9)
+    assert len(p_history) == 4
+    assert items_history == _get_live_var_history(test_path, observed_path,
+                                                  'items', 10)
+    assert len(items_history) == 4
+
+
+
+def test_live_var_history_with_dropped_states(tmp_path, monkeypatch):
+    test_path, observed_path = _write_files(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'path', [str(tmp_path)] + sys.path)
+    monkeypatch.delitem(sys.modules, 'observed_module', raising=False)
+    monkeypatch.setattr(trace_var, 'run_get_statement_range',
+                        lambda file_name, line_no: (line_no, line_no))
+    history = _get_live_var_history(test_path, observed_path, 'counter', 15,
+                                    is_global=True)
+    monkeypatch.setattr(trace_var, 'DEFAULT_MAX_STATE_SIZE', 1)
+    tracer = trace_var.VarTracer('counter', test_path, True, observed_path,
+                                 15)
+    assert tracer.frame_states.max_size == 1
+    original_trace = sys.gettrace()
+    sys.settrace(tracer)
+    try:
+        runpy.run_path(test_path, run_name='__main__')
+    finally:
+        sys.settrace(original_trace)
+        sys.modules.pop('observed_module', None)
+    assert tracer.frame_states.n_evicted
+    # Dropped states only lose the loop counts, not the values:
+    assert [item[2] for item in tracer.history] == \
+                                               [item[2] for item in history]
+
+
+def test_commands(tmp_path, monkeypatch, capsys):
+    test_path, observed_path = _write_files(tmp_path)
+    recording_path = str(tmp_path / 'test.dbgsnoop')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+    monkeypatch.delitem(sys.modules, 'observed_module', raising=False)
+    monkeypatch.setattr(cli, 'run_get_method_range',
+                        lambda file_name, method_name: TARGET_LINES)
+    monkeypatch.setattr(trace_var, 'run_get_statement_range',
+                        lambda file_name, line_no: (line_no, line_no))
+    monkeypatch.setattr(trace_var, 'run_get_belonging_method',
+                        lambda file_name, line_no: TARGET_LINES)
+    recordings = []
+    original_record = replay.record
+
+    def record(*args, **kwargs):
+        recordings.append(args)
+        sys.modules.pop('observed_module', None)
+        return original_record(*args, **kwargs)
+
+    monkeypatch.setattr(replay, 'record', record)
+    monkeypatch.setattr(sys, 'argv', [
+        'dbgsnooper', 'record', '--test_file', test_path, '--observed_file',
+        observed_path, '-o', recording_path
+    ])
+    cli.main()
+    assert os.path.exists(recording_path)
+
+    arguments = ['--test_file', test_path, '--observed_file', observed_path,
+                 '--recording', recording_path]
+    monkeypatch.setattr(sys, 'argv', ['/bin/call_graph', '--method_name',
+                                      'target'] + arguments)
+    cli.main()
+    assert 'Call ... def helper(x):' in capsys.readouterr().out
+    monkeypatch.setattr(sys, 'argv', ['trace_var', '--var_name', 'total',
+                                      '--lineno', '14'] + arguments)
+    cli.main()
+    output = capsys.readouterr().out
+    assert "Variable 'total' history:" in output
+    assert 'Value: [Value] 30' in output
+    # The recording had everything, so the test didn't run again:
+    assert len(recordings) == 1
@@ -0,0 +1,79 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import sys
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import sampling
+from dbgsnooper.sampling import Sampler
+
+
+def test_every():
+    sampler = Sampler(every=3)
+    assert [sampler.sample() for _ in range(7)] == \
+                                  [True, False, False, True, False, False, True]
+
+
+def test_probability(monkeypatch):
+    draws = iter([0.5, 0.05, 0.2, 0.09, 0.0])
+    monkeypatch.setattr(sampling.random, 'random', lambda: next(draws))
+    sampler = Sampler(probability=0.1)
+    assert [sampler.sample() for _ in range(4)] == [False, True, False, True]
+    assert Sampler(probability=0).sample() is False
+
+
+def test_max_calls(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(sampling.time, 'monotonic', lambda: now[0])
+    sampler = Sampler(max_calls=2, window=10)
+    assert [sampler.sample() for _ in range(3)] == [True, True, False]
+    now[0] += 9.9
+    assert sampler.sample() is False
+    now[0] += 0.1
+    assert [sampler.sample() for _ in range(3)] == [True, True, False]
+    # Only the calls that passed the other checks count:
+    sampler = Sampler(every=2, max_calls=2, window=10)
+    assert [sampler.sample() for _ in range(5)] == \
+                                              [True, False, True, False, False]
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        Sampler(every=0)
+    with pytest.raises(ValueError):
+        Sampler(probability=1.5)
+    with pytest.raises(ValueError):
+        Sampler(max_calls=1, window=0)
+
+
+def test_sampled_calls():
+    string_io = io.StringIO()
+    trace_functions = []
+
+    @dbgsnooper.snoop(string_io, color=False, sample_every=3)
+    def f(x):
+        trace_functions.append(sys.gettrace())
+        return x
+
+    @dbgsnooper.snoop(string_io, color=False, sample_every=2)
+    def g(n):
+        for i in range(n):
+            yield i
+
+    assert [f(x) for x in range(7)] == list(range(7))
+    output = string_io.getvalue()
+    lines = [line.strip() for line in output.splitlines()]
+    assert [line.split(',')[0] for line in lines
+            if line.startswith('Starting var')] == \
+           ['Starting var:.. x = 0', 'Starting var:.. x = 3',
+            'Starting var:.. x = 6']
+    # The calls that weren't sampled ran without tracing:
+    assert [trace_function is None for trace_function in trace_functions] == \
+                                  [False, True, True, False, True, True, False]
+    assert [list(g(2)) for _ in range(3)] == [[0, 1]] * 3
+    lines = [line.strip() for line in
+             string_io.getvalue()[len(output):].splitlines()]
+    assert lines.count('Starting var:.. n = 2') == 2
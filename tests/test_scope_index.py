@@ -0,0 +1,77 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import gc
+import textwrap
+import weakref
+
+from dbgsnooper.scope_index import (ScopeIndex, IN_SCOPE, PARTIALLY_IN_SCOPE,
+                                    OUT_OF_SCOPE)
+
+
+SOURCE = textwrap.dedent('''\
+    def decorate(function):
+        return function
+
+
+    @decorate
+    def foo(x):
+        y = x + 1
+        return y
+
+
+    def bar(x):
+        y = x * 2
+        z = y * 2
+        return z
+''')
+
+
+def _get_codes(path):
+    namespace = {}
+    exec(compile(SOURCE, str(path), 'exec'), namespace)
+    return namespace['decorate'].__code__, namespace['foo'].__code__, \
+                                                     namespace['bar'].__code__
+
+
+def test_verdicts(tmp_path):
+    path = tmp_path / 'observed.py'
+    path.write_text(SOURCE)
+    decorate, foo, bar = _get_codes(path)
+
+    scope_index = ScopeIndex(str(path), 5, 13)
+    assert scope_index.get_verdict(decorate) is OUT_OF_SCOPE
+    assert scope_index.get_verdict(foo) is IN_SCOPE
+    assert scope_index.get_verdict(bar) is PARTIALLY_IN_SCOPE
+    # The decorator line is reported as the `def` line on calls:
+    assert scope_index.get_call_line(foo, 5) == 6
+
+    other_index = ScopeIndex(str(tmp_path / 'other.py'), 1, 100)
+    assert other_index.get_verdict(foo) is OUT_OF_SCOPE
+
+
+def test_source_is_read_once(tmp_path):
+    path = tmp_path / 'observed.py'
+    path.write_text(SOURCE)
+    decorate, foo, bar = _get_codes(path)
+
+    scope_index = ScopeIndex(str(path), 1, 3)
+    assert scope_index.get_verdict(foo) is OUT_OF_SCOPE
+    path.unlink()
+    assert scope_index.get_verdict(decorate) is IN_SCOPE
+
+
+def test_verdicts_dont_keep_code_alive(tmp_path):
+    path = tmp_path / 'observed.py'
+    path.write_text(SOURCE)
+    scope_index = ScopeIndex(str(path), 5, 13)
+    codes = _get_codes(path)
+    for code in codes:
+        scope_index.get_verdict(code)
+    scope_index.get_call_line(codes[1], 5)
+    assert len(scope_index.verdicts) == 3
+    code_refs = [weakref.ref(code) for code in codes]
+    del codes, code
+    gc.collect()
+    assert not any(code_ref() for code_ref in code_refs)
+    assert len(scope_index.verdicts) == len(scope_index.call_lines) == 0
@@ -0,0 +1,110 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import asyncio
+import io
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import monitoring, speculation
+from dbgsnooper.speculation import Invocation, KeepPolicy
+from .utils import get_output_lines, temp_module
+
+BACKENDS = ['settrace'] + (['monitoring'] if monitoring.MONITORING_AVAILABLE
+                           else [])
+
+
+def _identity(value):
+    return value
+
+
+def test_keep_policy(monkeypatch):
+    now = [10.0]
+    monkeypatch.setattr(speculation.time, 'monotonic', lambda: now[0])
+    invocation = Invocation()
+    invocation.set_outcome(False, 3)
+    now[0] += 0.5
+    assert KeepPolicy(min_duration=0.5).keeps(invocation)
+    assert not KeepPolicy(min_duration=0.6).keeps(invocation)
+    assert KeepPolicy(predicate=lambda value: value == 3).keeps(invocation)
+    assert not KeepPolicy(predicate=lambda value: value == 4).keeps(invocation)
+    # Rather than hide a call that may have been asked for:
+    assert KeepPolicy(predicate=lambda value: 1 / 0).keeps(invocation)
+    invocation.set_outcome(True, None)
+    assert KeepPolicy(on_exception=True).keeps(invocation)
+    assert not KeepPolicy(predicate=lambda value: True).keeps(invocation)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_kept_calls(backend, monkeypatch):
+    string_io = io.StringIO()
+    durations = iter([0, 0, 0, 1.0, 0, 0, 0, 0, 0])
+    monkeypatch.setattr(Invocation, 'get_duration',
+                        lambda invocation: next(durations))
+
+    @dbgsnooper.snoop(string_io, color=False, backend=backend,
+                      keep_slower_than=0.5, keep_exceptions=True,
+                      keep_if=lambda result: result == 7)
+    def f(x):
+        if x == 5:
+            raise ValueError(x)
+        return _identity(x)
+
+    for x in range(9):
+        try:
+            f(x)
+        except ValueError:
+            pass
+    lines = get_output_lines(string_io.getvalue())
+    # The 4th call was slow, the 6th one raised, and the 8th one returned 7:
+    assert [line for line in lines if line.startswith('Starting var:.. x')] == \
+        ['Starting var:.. x = 3', 'Starting var:.. x = 5',
+         'Starting var:.. x = 7']
+    assert 'Exception:..... ValueError: 5' in lines
+    assert 'Return value:.. 7' in lines
+    assert 'Return value:.. 6' not in lines
+
+
+def test_observed_file(tmp_path):
+    string_io = io.StringIO()
+    with temp_module(tmp_path, 'speculated_module') as speculated_module:
+        with dbgsnooper.snoop(string_io,
+                              observed_file=speculated_module.__file__,
+                              start_line=1, end_line=3, color=False,
+                              keep_if=lambda total: total == 20):
+            for n in range(4):
+                speculated_module.work(n)
+    lines = get_output_lines(string_io.getvalue())
+    assert [line for line in lines if line.startswith('Return value')] == \
+                                                         ['Return value:.. 20']
+    assert 'New var:....... total = 20' in lines
+
+
+def test_tasks():
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False,
+                              keep_if=lambda result: result == 2)
+
+    @tracer
+    async def outer(n):
+        await asyncio.sleep(0)
+        result = await inner(n)
+        return result
+
+    @tracer
+    async def inner(n):
+        await asyncio.sleep(0)
+        return n
+
+    async def main():
+        return await asyncio.gather(*[outer(n) for n in range(4)])
+
+    assert asyncio.run(main()) == [0, 1, 2, 3]
+    tracer.flush()
+    # The whole task is kept, steps and awaited coroutines included:
+    lines = get_output_lines(string_io.getvalue())
+    assert set(line.split(',')[0] for line in lines
+               if line.startswith('Starting var:.. n =')) == \
+                                                set(['Starting var:.. n = 2'])
+    assert lines.count('Return value:.. 2') == 2
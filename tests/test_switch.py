@@ -0,0 +1,92 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import asyncio
+import io
+import os
+import signal
+import sys
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import tracer
+from .utils import get_output_lines
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(tracer, 'DISABLED', False)
+
+
+def test_switch(enabled):
+    string_io = io.StringIO()
+    trace_functions = []
+
+    @dbgsnooper.snoop(string_io, color=False)
+    def f(x):
+        trace_functions.append(sys.gettrace())
+        return x
+
+    @dbgsnooper.snoop(string_io, color=False)
+    def g(n):
+        for i in range(n):
+            yield i
+
+    dbgsnooper.disable()
+    assert not dbgsnooper.is_enabled()
+    assert f(1) == 1
+    assert list(g(2)) == [0, 1]
+    assert string_io.getvalue() == ''
+    # Disabled calls run without tracing:
+    assert trace_functions == [None]
+    dbgsnooper.enable()
+    assert dbgsnooper.is_enabled()
+    assert f(2) == 2
+    assert list(g(2)) == [0, 1]
+    lines = get_output_lines(string_io.getvalue())
+    assert 'Return value:.. 2' in lines
+    assert 'Starting var:.. n = 2' in lines
+    assert trace_functions[1] is not None
+
+
+def test_switching_in_scope(enabled):
+    string_io = io.StringIO()
+    snoop = dbgsnooper.snoop(string_io, color=False)
+    with snoop:
+        dbgsnooper.disable()
+    assert sys.gettrace() is None
+    with snoop:
+        dbgsnooper.enable()
+        x = 1
+    assert sys.gettrace() is None
+    assert not any(line.startswith('New var:....... x')
+                   for line in get_output_lines(string_io.getvalue()))
+
+
+def test_coroutines(enabled):
+    string_io = io.StringIO()
+    snoop = dbgsnooper.snoop(string_io, color=False)
+
+    @snoop
+    async def f(x):
+        await asyncio.sleep(0)
+        return x
+
+    dbgsnooper.disable()
+    assert asyncio.run(f(3)) == 3
+    snoop.flush()
+    assert string_io.getvalue() == ''
+    dbgsnooper.enable()
+    assert asyncio.run(f(4)) == 4
+    snoop.flush()
+    assert 'Return value:.. 4' in get_output_lines(string_io.getvalue())
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR2'), reason='Needs SIGUSR2.')
+def test_toggle_on_signal(enabled):
+    dbgsnooper.toggle_on_signal()
+    os.kill(os.getpid(), signal.SIGUSR2)
+    assert not dbgsnooper.is_enabled()
+    os.kill(os.getpid(), signal.SIGUSR2)
+    assert dbgsnooper.is_enabled()
@@ -0,0 +1,124 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import textwrap
+import threading
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import events, monitoring
+from dbgsnooper.events import Event, ThreadBuffers
+from .utils import temp_module
+
+
+OBSERVED_SOURCE = textwrap.dedent('''\
+    def work(n):
+        total = n * 10
+        return total
+
+
+    def run_threads(n_threads):
+        import threading
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(1, n_threads + 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+''')
+
+
+@pytest.fixture
+def observed_module(tmp_path):
+    with temp_module(tmp_path, 'threaded_module', OBSERVED_SOURCE) as module:
+        yield module
+
+
+def test_thread_buffers():
+    thread_buffers = ThreadBuffers()
+    barrier = threading.Barrier(3)
+
+    def emit(name):
+        barrier.wait()
+        for i in range(200):
+            thread_buffers.get().append(Event(events.TEXT, 0, data=name))
+
+    threads = [threading.Thread(target=emit, args=(name,))
+               for name in ('a', 'b')]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    merged = thread_buffers.drain()
+    assert len(merged) == 400
+    assert [event.timestamp for event in merged] == \
+                                   sorted(event.timestamp for event in merged)
+    assert [event.data for event in merged].count('a') == 200
+    # The buffers of threads that are done go once they're empty:
+    assert thread_buffers.drain() == []
+    assert thread_buffers.buffers == []
+
+
+@pytest.mark.parametrize('trace_threads', [False, True])
+def test_trace_threads(observed_module, trace_threads):
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, observed_file=observed_module.__file__,
+                              start_line=1, end_line=3, color=False,
+                              trace_threads=trace_threads)
+    with tracer:
+        observed_module.run_threads(3)
+    output = string_io.getvalue()
+    for n in range(1, 4):
+        assert ('Return value:.. {}'.format(n * 10) in output) == \
+                                                                 trace_threads
+    if trace_threads:
+        lines = [line.strip() for line in output.splitlines()]
+        assert sorted(line for line in lines
+                      if line.startswith('Starting var:..')) == \
+                        ['Starting var:.. n = {}'.format(n) for n in (1, 2, 3)]
+        assert len([line for line in lines if line.split()[-4:] ==
+                    ['return', '3', 'return', 'total']]) == 3
+        # Threads that are done don't keep being traced:
+        assert threading.gettrace() is None \
+                     if hasattr(threading, 'gettrace') else True
+
+
+def test_thread_state():
+    string_io = io.StringIO()
+    tracer = dbgsnooper.snoop(string_io, color=False, trace_threads=True)
+    barrier = threading.Barrier(2)
+    thread_states = []
+
+    @tracer
+    def f(x):
+        thread_states.append(tracer.get_thread_state())
+        barrier.wait()
+        y = x + 1
+        return y
+
+    threads = [threading.Thread(target=f, args=(x,)) for x in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tracer.flush()
+    # Both calls were snooped at once, each with state of its own:
+    assert thread_states[0] is not thread_states[1]
+    assert thread_states[0].frame_states is not thread_states[1].frame_states
+    output = string_io.getvalue()
+    assert 'Return value:.. 2' in output
+    assert 'Return value:.. 3' in output
+    assert output.count('New var:....... y = ') == 2
+
+
+@pytest.mark.skipif(not monitoring.MONITORING_AVAILABLE,
+                    reason='Needs `sys.monitoring`.')
+def test_trace_threads_backend():
+    with pytest.raises(NotImplementedError):
+        dbgsnooper.snoop(backend='monitoring', trace_threads=True)
+    tracer = dbgsnooper.snoop(io.StringIO(), backend='auto',
+                              trace_threads=True)
+    assert tracer.backend == 'settrace'
@@ -0,0 +1,173 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import os
+import sys
+import threading
+
+import dbgsnooper
+from dbgsnooper import cli, recording, writers
+from dbgsnooper.trace_reader import TraceReader, build_index, load_index
+
+
+def add(x, y):
+    z = x + y
+    return z
+
+
+def add_all(n):
+    if n == 0:
+        return 0
+    return add(add_all(n - 1), n)
+
+
+def _record(path, function, *args, **kwargs):
+    result = dbgsnooper.snoop(path, format='binary', depth=100,
+                              **kwargs)(function)(*args)
+    writers.flush_all()
+    return result
+
+
+def _return_values(events):
+    return [event.data for event in events if event.kind == 'return_value']
+
+
+def test_read_frame(tmp_path):
+    path = str(tmp_path / 'foo.dbgsnoop')
+    _record(path, add_all, 4)
+    assert os.path.exists(path + recording.INDEX_SUFFIX)
+    with TraceReader(path) as reader:
+        assert len(reader.frames) == 9
+        outer = reader.find_frames('add_all', path=__file__)[0]
+        assert reader.get_code(outer).first_line_no == \
+                                                add_all.__code__.co_firstlineno
+        assert _return_values(reader.read_frame(outer)) == \
+                                   ['0', '1', '1', '3', '3', '6', '6', '10', '10']
+        inner = reader.find_frames('add_all')[3]
+        assert _return_values(reader.read_frame(inner)) == ['0', '1', '1']
+        frames = reader.find_frames('add')
+        assert len(frames) == 4
+        events = list(reader.read_frame(frames[2]))
+        assert [event.kind for event in events] == [
+            'starting_vars', 'call', 'line', 'new_vars', 'line', 'return',
+            'return_value'
+        ]
+        assert events[-1].data == '6'
+        assert not reader.find_frames('add', line_no=1)
+
+
+def test_read_time_window(tmp_path):
+    path = str(tmp_path / 'foo.dbgsnoop')
+
+    def run():
+        _record(path, add_all, 200)
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with TraceReader(path) as reader:
+        everything = list(reader.read())
+        assert len(_return_values(everything)) == 3 * 401
+        timestamps = sorted(event.timestamp for event in everything)
+        for start, end in ((0, timestamps[-1]),
+                           (timestamps[10], timestamps[len(timestamps) // 2]),
+                           (timestamps[-1] + 1, timestamps[-1] + 10 ** 9)):
+            window = list(reader.read_time_window(start, end))
+            assert sorted(event.timestamp for event in window) == \
+                             [timestamp for timestamp in timestamps
+                              if start <= timestamp <= end]
+        # Each frame comes out whole, even with other threads in between:
+        calls = [_return_values(reader.read_frame(frame))
+                 for frame in reader.find_frames('add_all')]
+        whole_calls = [return_values for return_values in calls
+                       if return_values[-1] == '20100']
+        assert len(whole_calls) == 3
+        assert all(len(return_values) == 401 for return_values in whole_calls)
+
+
+
+def _run_threads(function, n_threads):
+    threads = [threading.Thread(target=function, args=(n, n))
+               for n in range(1, n_threads + 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_read_frames_of_threads(tmp_path):
+    path = str(tmp_path / 'foo.dbgsnoop')
+    tracer = dbgsnooper.snoop(path, format='binary', trace_threads=True)
+    snooped_add = tracer(add)
+    results = {}
+    # Idents of threads that are done get reused:
+    barrier = threading.Barrier(3)
+
+    def run(x, y):
+        results[threading.get_ident()] = str(snooped_add(x, y))
+        barrier.wait()
+
+    _run_threads(run, 3)
+    tracer.flush()
+    writers.flush_all()
+    with TraceReader(path) as reader:
+        # The serials of frames of different threads don't collide:
+        frames = reader.find_frames('add')
+        assert len(frames) == 3
+        # Events have the thread they happened in, whichever thread wrote
+        # them:
+        for frame in frames:
+            events = list(reader.read_frame(frame))
+            assert set(event.thread for event in events) == \
+                                                     set([events[0].thread])
+            assert _return_values(events) == [results[events[0].thread]]
+
+def test_build_index(tmp_path):
+    path = str(tmp_path / 'foo.dbgsnoop')
+    _record(path, add_all, 3)
+    _record(path, add_all, 5)
+    index = load_index(path)
+    assert len(index.segments) == 2
+    assert index.covered == os.path.getsize(path)
+    os.remove(path + recording.INDEX_SUFFIX)
+    assert load_index(path) is None
+    with TraceReader(path) as reader:
+        assert len(reader.find_frames('add_all')) == 10
+        assert [(frame.offset, frame.end) for frame in reader.frames] == \
+                    [(frame.offset, frame.end) for frame in index.frames.values()]
+    assert load_index(path).covered == index.covered
+
+    # An index that's behind its recording gets built again:
+    with open(path + recording.INDEX_SUFFIX, 'r+b') as index_file:
+        index_file.truncate(recording.INDEX_HEADER.size +
+                            recording.INDEX_ENTRY.size * 3 + 5)
+    with TraceReader(path) as reader:
+        assert reader.index.covered == index.covered
+        assert len(reader.find_frames('add')) == 8
+
+    _record(path, add_all, 1, overwrite=True)
+    with TraceReader(path) as reader:
+        assert len(reader.frames) == 3
+    assert len(build_index(path).frames) == 3
+
+
+def test_empty_recording(tmp_path):
+    path = tmp_path / 'foo.dbgsnoop'
+    path.write_bytes(b'')
+    with TraceReader(str(path)) as reader:
+        assert reader.frames == []
+        assert list(reader.read()) == []
+        assert list(reader.read_time_window(0, 10 ** 18)) == []
+
+
+def test_index_command(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'foo.dbgsnoop')
+    _record(path, add_all, 2)
+    os.remove(path + recording.INDEX_SUFFIX)
+    monkeypatch.setattr(sys, 'argv', ['dbgsnooper', 'index', path])
+    cli.main()
+    assert capsys.readouterr().out == \
+                            '{}: 1 segments, 5 frames, 1 runs\n'.format(path)
+    assert len(load_index(path).frames) == 5
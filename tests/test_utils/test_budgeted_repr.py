@@ -0,0 +1,77 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import collections
+import dataclasses
+
+import pytest
+
+from dbgsnooper.utils import (get_shortish_repr, get_budgeted_repr,
+                              normalize_repr, truncate)
+from dbgsnooper.tracer import format_var_reprs
+
+
+Point = collections.namedtuple('Point', 'x y')
+
+
+@dataclasses.dataclass
+class Pair(object):
+    left: object
+    right: object = None
+    hidden: int = dataclasses.field(default=0, repr=False)
+
+
+class Multiline(object):
+    def __repr__(self):
+        return 'multi\nline at 0x12345678'
+
+
+def _full_shortish_repr(item, max_length, normalize):
+    r = repr(item).replace('\r', '').replace('\n', '')
+    if normalize:
+        r = normalize_repr(r)
+    return truncate(r, max_length)
+
+
+@pytest.mark.parametrize('item', [
+    list(range(10000)),
+    tuple(range(3)),
+    (7,),
+    {str(i): [i] * i for i in range(300)},
+    set(range(1000)),
+    frozenset(),
+    frozenset('abc' * 100),
+    'x' * 1000,
+    "it's" * 500,
+    "it's \"quoted\"" * 500,
+    b'\x00\xff\'' * 500,
+    [Multiline()] * 100,
+    [Point(i, 'y' * i) for i in range(100)],
+    [Pair(i, Pair('z' * 500)) for i in range(20)],
+    [['a' * 300, 'b' * 300]] * 3,
+    {'k' * 1000: 'v' * 1000},
+])
+@pytest.mark.parametrize('max_length', (5, 10, 100, 1000))
+@pytest.mark.parametrize('normalize', (False, True))
+def test_budgeted_repr(item, max_length, normalize):
+    assert get_shortish_repr(item, max_length=max_length,
+                             normalize=normalize) == \
+                           _full_shortish_repr(item, max_length, normalize)
+
+
+def test_recursive_container():
+    x = [1, 2]
+    x.append(x)
+    assert get_budgeted_repr(x, 100) is None
+    assert get_shortish_repr(x, max_length=100) == '[1, 2, [...]]'
+
+
+def test_format_var_reprs():
+    var_reprs = [('a', '1'), ('b', '2')]
+    assert format_var_reprs(var_reprs, ',    ') == 'a = 1,    b = 2'
+    assert format_var_reprs([], ', ', prefix='Starting var:.. ') == \
+                                                             'Starting var:..'
+    long_var_reprs = [('x{}'.format(i), 'y' * 50) for i in range(10)]
+    assert format_var_reprs(long_var_reprs, ', ') == \
+               ', '.join('{} = {}'.format(*pair) for pair in long_var_reprs)[
+                                                               :94] + ' ......'
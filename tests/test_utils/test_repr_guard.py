@@ -0,0 +1,81 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import time
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper.utils import ReprGuard, get_shortish_repr
+
+
+class Slow(object):
+    def __repr__(self):
+        time.sleep(0.02)
+        return 'Slow()'
+
+
+class Fast(object):
+    def __repr__(self):
+        return 'Fast()'
+
+
+def test_repr_guard():
+    repr_guard = ReprGuard(max_repr_time=0.01)
+    slow = Slow()
+    assert get_shortish_repr(Fast(), repr_guard=repr_guard) == 'Fast()'
+    assert get_shortish_repr(slow, repr_guard=repr_guard) == 'Slow()'
+    assert get_shortish_repr(slow, repr_guard=repr_guard) == \
+                               '<Slow id={:#x} repr-suppressed>'.format(id(slow))
+    assert get_shortish_repr(slow, repr_guard=repr_guard, normalize=True) == \
+                                                    '<Slow repr-suppressed>'
+    assert get_shortish_repr(Fast(), repr_guard=repr_guard) == 'Fast()'
+    assert [item_type for item_type, _ in repr_guard.pop_new_demotions()] == \
+                                                                        [Slow]
+    assert repr_guard.pop_new_demotions() == []
+
+
+def test_total_repr_time():
+    repr_guard = ReprGuard(max_total_repr_time=0.05)
+    reprs = [get_shortish_repr(Slow(), repr_guard=repr_guard, normalize=True)
+             for _ in range(5)]
+    assert reprs[0] == 'Slow()'
+    assert reprs[-1] == '<Slow repr-suppressed>'
+    ((item_type, reason),) = repr_guard.pop_new_demotions()
+    assert item_type is Slow
+    assert 'in total' in reason
+
+
+@pytest.mark.parametrize('max_length', (100, None))
+def test_items_are_charged_to_their_own_types(max_length):
+    repr_guard = ReprGuard(max_repr_time=0.01)
+    slow = Slow()
+    assert get_shortish_repr([1, {'a': slow}], max_length=max_length,
+                             repr_guard=repr_guard) == "[1, {'a': Slow()}]"
+    assert [item_type for item_type, _ in repr_guard.pop_new_demotions()] == \
+                                                                        [Slow]
+    assert get_shortish_repr([2, slow], max_length=max_length,
+                             repr_guard=repr_guard, normalize=True) == \
+                                                '[2, <Slow repr-suppressed>]'
+    assert get_shortish_repr([Fast()], max_length=max_length,
+                             repr_guard=repr_guard) == '[Fast()]'
+    assert repr_guard.pop_new_demotions() == []
+
+
+def test_demotions_are_reported():
+    string_io = io.StringIO()
+
+    @dbgsnooper.snoop(string_io, color=False, normalize=True,
+                      max_repr_time=0.01)
+    def my_function():
+        x = Slow()
+        y = x
+        return y
+
+    my_function()
+    lines = [line.strip() for line in string_io.getvalue().splitlines()]
+    assert 'New var:....... x = Slow()' in lines
+    assert 'New var:....... y = <Slow repr-suppressed>' in lines
+    assert lines[-1].startswith('Repr suppressed:.. {}.Slow (one repr took '
+                                .format(__name__))
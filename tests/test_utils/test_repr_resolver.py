@@ -0,0 +1,87 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import abc
+import collections
+from unittest import mock
+
+from dbgsnooper.utils import ReprResolver, get_repr_function
+
+
+def repr_a(x):
+    return 'a'
+
+
+def repr_b(x):
+    return 'b'
+
+
+def repr_c(x):
+    return 'c'
+
+
+def test_repr_resolver_matches_get_repr_function():
+    custom_repr = (
+        (lambda x: x == 7, repr_a),
+        (int, repr_b),
+        (lambda x: isinstance(x, bool), repr_c),
+        (collections.abc.Sequence, repr_c),
+        (object, repr_a),
+    )
+    repr_resolver = ReprResolver(custom_repr)
+    assert list(repr_resolver) == list(custom_repr)
+    for item in (7, 8, True, [], 'x', object(), 2.5):
+        for _ in range(2):
+            assert repr_resolver.get_repr_function(item) is \
+                                        get_repr_function(item, custom_repr)
+            assert get_repr_function(item, repr_resolver) is \
+                                        get_repr_function(item, custom_repr)
+
+
+def test_empty_repr_resolver():
+    repr_resolver = ReprResolver()
+    assert not repr_resolver
+    assert repr_resolver.get_repr_function(object()) is repr
+
+
+def test_abc_registered_later():
+    class Marker(abc.ABC):
+        pass
+
+    class Thing(object):
+        pass
+
+    repr_resolver = ReprResolver(((Marker, repr_a),))
+    assert repr_resolver.get_repr_function(Thing()) is repr
+    Marker.register(Thing)
+    assert repr_resolver.get_repr_function(Thing()) is repr_a
+
+
+def test_predicates_see_each_item():
+    class Thing(object):
+        special = False
+
+    repr_resolver = ReprResolver(((lambda x: x.special, repr_a),
+                                  (Thing, repr_b)))
+    thing = Thing()
+    assert repr_resolver.get_repr_function(thing) is repr_b
+    thing.special = True
+    assert repr_resolver.get_repr_function(thing) is repr_a
+    assert repr_resolver.get_repr_function(Thing()) is repr_b
+
+
+def test_items_with_another_class():
+    class Thing(object):
+        pass
+
+    class Proxy(object):
+        __class__ = property(lambda self: Thing)
+
+    custom_repr = ((Thing, repr_a),)
+    repr_resolver = ReprResolver(custom_repr)
+    for item in (mock.Mock(spec=Thing), Proxy(), Thing()):
+        assert repr_resolver.get_repr_function(item) is repr_a
+        assert repr_resolver.get_repr_function(item) is \
+                                        get_repr_function(item, custom_repr)
+    assert repr_resolver.get_repr_function(mock.Mock()) is repr
+
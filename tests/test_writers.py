@@ -0,0 +1,256 @@
+# Copyright 2019 Ram Rachum and collaborators.
+# This program is distributed under the MIT license.
+
+import io
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import dbgsnooper
+from dbgsnooper import recording, writers
+from dbgsnooper.writers import FileWriter, AsyncWriter
+
+
+def test_file_writer_buffers(tmp_path):
+    path = tmp_path / 'foo.log'
+    writer = FileWriter(str(path), False, buffer_size=10, flush_interval=60)
+    writer.write(u'abc\n')
+    assert not path.exists()
+    writer.write(u'defghi\n')
+    assert path.read_text() == u'abc\ndefghi\n'
+    writer.write(u'jkl\n')
+    writer.flush()
+    assert path.read_text() == u'abc\ndefghi\njkl\n'
+
+
+def test_file_writer_flush_interval(tmp_path):
+    path = tmp_path / 'foo.log'
+    writer = FileWriter(str(path), False, flush_interval=0)
+    writer.write(u'abc\n')
+    assert path.read_text() == u'abc\n'
+
+
+def test_file_writer_flushes_when_idle(tmp_path):
+    path = tmp_path / 'foo.log'
+    writer = FileWriter(str(path), False, flush_interval=0.2)
+    writer.write(u'abc\n')
+    assert not path.exists()
+    # Nothing else gets written, like in a process that hangs:
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and \
+                      not (path.exists() and path.read_text() == u'abc\n'):
+        time.sleep(0.05)
+    assert path.read_text() == u'abc\n'
+
+
+def test_file_writer_fsync(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, 'fsync', synced.append)
+    path = tmp_path / 'foo.log'
+    writer = FileWriter(str(path), False, fsync=True)
+    writer.write(u'abc\n')
+    assert not synced
+    writer.flush()
+    assert len(synced) == 1
+
+
+def test_writers_of_the_same_file(tmp_path):
+    path = tmp_path / 'foo.log'
+    path.write_text(u'lala')
+    first = FileWriter(str(path), True)
+    second = FileWriter(str(tmp_path / '.' / 'foo.log'), False)
+    assert first.file is second.file
+    second.write(u'second\n')
+    # The first write of an overwriting writer drops what came before it:
+    first.write(u'first\n')
+    second.write(u'second\n')
+    first.write(u'first\n')
+    writers.flush_all()
+    assert path.read_text() == u'first\nsecond\nfirst\n'
+
+
+def test_tracers_of_the_same_file(tmp_path):
+    path = str(tmp_path / 'foo.log')
+
+    @dbgsnooper.snoop(path, color=False, prefix='inner ')
+    def inner(x):
+        return x + 1
+
+    @dbgsnooper.snoop(path, color=False, prefix='outer ')
+    def outer():
+        return inner(1)
+
+    assert outer() == 2
+    with open(path) as output_file:
+        lines = output_file.read().splitlines()
+    prefixes = [line.split()[0] for line in lines]
+    first_inner = prefixes.index('inner')
+    last_inner = len(prefixes) - prefixes[::-1].index('inner')
+    assert set(prefixes[first_inner:last_inner]) == {'inner'}
+    assert prefixes[0] == prefixes[-1] == 'outer'
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGTERM') or sys.platform == 'win32',
+                    reason='Needs POSIX signals.')
+def test_flush_on_sigterm(tmp_path):
+    path = tmp_path / 'foo.log'
+    script = (
+        'import os, signal\n'
+        'from dbgsnooper.writers import FileWriter\n'
+        'writer = FileWriter({!r}, False, flush_interval=60)\n'
+        'writer.write(u"before the signal\\n")\n'
+        'os.kill(os.getpid(), signal.SIGTERM)\n'
+        'writer.write(u"after the signal\\n")\n'
+    ).format(str(path))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run([sys.executable, '-c', script], cwd=root)
+    assert process.returncode == -signal.SIGTERM
+    assert path.read_text() == u'before the signal\n'
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGTERM') or sys.platform == 'win32',
+                    reason='Needs POSIX signals.')
+@pytest.mark.parametrize('options', ("format='text'",
+                                     "format='text', trace_threads=True",
+                                     "format='binary'"))
+def test_snooped_function_flushes_on_sigterm(tmp_path, options):
+    path = tmp_path / 'foo.log'
+    script = (
+        'import os, signal\n'
+        'import dbgsnooper\n'
+        '@dbgsnooper.snoop({!r}, color=False, flush_interval=60, {})\n'
+        'def my_function():\n'
+        '    x = 7\n'
+        '    os.kill(os.getpid(), signal.SIGTERM)\n'
+        '    y = 8\n'
+        'my_function()\n'
+    ).format(str(path), options)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run([sys.executable, '-c', script], cwd=root)
+    assert process.returncode == -signal.SIGTERM
+    if 'binary' in options:
+        string_io = io.StringIO()
+        recording.render(path.read_bytes(), string_io.write)
+        output = string_io.getvalue()
+    else:
+        output = path.read_text()
+    lines = [line.strip() for line in output.splitlines()]
+    assert 'New var:....... x = 7' in lines
+    assert 'New var:....... y = 8' not in lines
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGTERM') or sys.platform == 'win32',
+                    reason='Needs POSIX signals.')
+def test_sigterm_while_holding_the_lock(tmp_path):
+    path = tmp_path / 'foo.log'
+    script = (
+        'import os, signal\n'
+        'from dbgsnooper.writers import FileWriter, _SharedFile\n'
+        'writer = FileWriter({!r}, False, flush_interval=60)\n'
+        'writer.write(u"before the signal\\n")\n'
+        'with _SharedFile._instances_lock:\n'
+        '    os.kill(os.getpid(), signal.SIGTERM)\n'
+    ).format(str(path))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run([sys.executable, '-c', script], cwd=root,
+                             timeout=30)
+    assert process.returncode == -signal.SIGTERM
+    assert path.read_text() == u'before the signal\n'
+
+
+class BlockedWrite(object):
+    def __init__(self):
+        self.lines = []
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def __call__(self, s):
+        self.started.set()
+        self.release.wait()
+        self.lines.append(s)
+
+
+def _write_while_blocked(overflow):
+    write = BlockedWrite()
+    writer = AsyncWriter(write, queue_size=2, overflow=overflow)
+    writer.write(u'0\n')
+    # The writer thread took the first line, and waits:
+    assert write.started.wait(5)
+    for i in range(1, 6):
+        writer.write(u'{}\n'.format(i))
+    assert writer.n_dropped == 3
+    write.release.set()
+    assert writer.join(5)
+    return write.lines
+
+
+def test_async_writer_drop_newest():
+    assert _write_while_blocked('drop-newest') == [
+        u'0\n', u'1\n', u'2\n',
+        u'......3 lines dropped, the output queue was full......\n',
+    ]
+
+
+def test_async_writer_drop_oldest():
+    assert _write_while_blocked('drop-oldest') == [
+        u'0\n', u'......3 lines dropped, the output queue was full......\n',
+        u'4\n', u'5\n',
+    ]
+
+
+def test_async_writer_blocks():
+    lines = []
+    writer = AsyncWriter(lines.append, queue_size=3)
+    for i in range(100):
+        writer.write(u'{}\n'.format(i))
+    assert writer.join(5)
+    assert lines == [u'{}\n'.format(i) for i in range(100)]
+    assert writer.n_dropped == 0
+    with pytest.raises(ValueError):
+        AsyncWriter(lines.append, overflow='explode')
+
+
+def test_async_output():
+    def my_function(x):
+        y = x * 2
+        return y
+
+    outputs = []
+    for async_output in (False, True):
+        string_io = io.StringIO()
+        tracer = dbgsnooper.snoop(string_io, color=False, normalize=True,
+                                  async_output=async_output)
+        assert tracer(my_function)(3) == 6
+        tracer.flush()
+        outputs.append([line.strip() for line in
+                        string_io.getvalue().splitlines()
+                        if 'Elapsed time' not in line])
+    assert outputs[0] == outputs[1]
+    assert outputs[0][-1] == 'Return value:.. 6'
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGTERM') or sys.platform == 'win32',
+                    reason='Needs POSIX signals.')
+@pytest.mark.parametrize('output', ('', 'io.StringIO()',
+                                    "{!r}, buffer_size=0"))
+def test_signals_are_left_alone_without_buffers(tmp_path, output):
+    script = (
+        'import io, signal\n'
+        'import dbgsnooper\n'
+        'handlers = [signal.getsignal(signum) for signum in\n'
+        '            (signal.SIGTERM, signal.SIGHUP)]\n'
+        '@dbgsnooper.snoop({})\n'
+        'def my_function():\n'
+        '    return 7\n'
+        'my_function()\n'
+        'assert [signal.getsignal(signum) for signum in\n'
+        '        (signal.SIGTERM, signal.SIGHUP)] == handlers\n'
+    ).format(output.format(str(tmp_path / 'foo.log')))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', script], cwd=root, check=True,
+                   stderr=subprocess.DEVNULL)
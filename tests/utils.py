@@ -3,10 +3,15 @@
 import os
 import re
 import abc
+import contextlib
+import importlib
 import inspect
+import io
 import sys
+import textwrap
 
-from pysnooper.utils import DEFAULT_REPR_RE
+import dbgsnooper
+from dbgsnooper.utils import DEFAULT_REPR_RE
 
 try:
     from itertools import zip_longest
@@ -15,7 +20,7 @@ except ImportError:
 
 from . import mini_toolbox
 
-import pysnooper.pycompat
+from dbgsnooper import pycompat
 
 
 def get_function_arguments(function, exclude=()):
@@ -30,7 +35,7 @@ def get_function_arguments(function, exclude=()):
     return result
 
 
-class _BaseEntry(pysnooper.pycompat.ABC):
+class _BaseEntry(pycompat.ABC):
     def __init__(self, prefix='', min_python_version=None, max_python_version=None):
         self.prefix = prefix
         self.min_python_version = min_python_version
@@ -110,7 +115,7 @@ class ElapsedTimeEntry(_BaseEntry):
         match = self.line_pattern.match(s)
         if not match:
             return False
-        timedelta = pysnooper.pycompat.timedelta_parse(match.group('time'))
+        timedelta = pycompat.timedelta_parse(match.group('time'))
         if self.elapsed_time_value:
             return abs(timedelta.total_seconds() - self.elapsed_time_value) \
                                                               <= self.tolerance
@@ -430,3 +435,47 @@ def assert_sample_output(module):
         raise  # show pytest diff (may need -vv flag to see in full)
 
 
+def get_output_lines(text, elapsed_time=True):
+    '''
+    Get the lines of the snoop output `text`, stripped of their indentation.
+    Without `elapsed_time`, the `Elapsed time` lines, which change from run to
+    run, are left out.
+    '''
+    return [line.strip() for line in text.splitlines()
+            if elapsed_time or 'Elapsed time' not in line]
+
+
+def get_snoop_lines(function, args=(), **kwargs):
+    '''
+    Call `function` with `args`, snooped with the `Tracer` arguments
+    `kwargs`, and get the lines of the output, see `get_output_lines`.
+    '''
+    string_io = io.StringIO()
+    dbgsnooper.snoop(string_io, color=False, normalize=True,
+                     **kwargs)(function)(*args)
+    return get_output_lines(string_io.getvalue(), elapsed_time=False)
+
+
+WORK_SOURCE = textwrap.dedent('''\
+    def work(n):
+        total = n * 10
+        return total
+''')
+
+
+@contextlib.contextmanager
+def temp_module(folder, name, source=WORK_SOURCE):
+    '''
+    Write `source` to the module `name` in `folder`, and import it afresh,
+    with `folder` on `sys.path` until the context exits.
+    '''
+    with open(os.path.join(str(folder), name + '.py'), 'w') as module_file:
+        module_file.write(source)
+    sys.modules.pop(name, None)
+    importlib.invalidate_caches()
+    with mini_toolbox.TempSysPathAdder(folder):
+        try:
+            yield importlib.import_module(name)
+        finally:
+            sys.modules.pop(name, None)
+